@@ -1,25 +1,46 @@
 # --- Supervertaler (v2.3.0) - Multi-LLM AI-powered Translator & Proofreader with Project Management ---
-import tkinter as tk
-from tkinter import filedialog, scrolledtext, messagebox, ttk
+import time  # For timestamp in saved prompts
+_MODULE_LOAD_STARTED = time.perf_counter()  # first thing, so the startup report covers every import
+try:
+    import tkinter as tk
+    from tkinter import filedialog, scrolledtext, messagebox, ttk
+    TKINTER_AVAILABLE = True
+except ImportError:  # headless Python builds (servers, slim containers) ship without Tk; the CLI still works
+    tk = filedialog = scrolledtext = messagebox = ttk = None
+    TKINTER_AVAILABLE = False
 import threading
 import queue
+import concurrent.futures  # For concurrent LLM chunk dispatch
+import concurrent.futures.process  # For the CPU worker pool
+import multiprocessing
+import itertools
+import asyncio  # For the async (single event loop) dispatch engine
+import atexit  # For closing the shared dispatch loop and its clients
+import collections  # For the FIFO of async concurrency waiters
 import os
 import re
 import math
+import random  # For retry backoff jitter
 import xml.etree.ElementTree as ET 
 import io 
 import sys
+import importlib  # For lazy loading of optional libraries
+import importlib.util
+import argparse  # For the headless command line
+import hashlib  # For API key digests and content hashing
 import zipfile  # Added for DOCX parsing
 # ADD: base64 for image encoding (Claude/OpenAI multimodal)
 import base64
 import json  # For custom prompt management
-import time  # For timestamp in saved prompts
+import types  # For attribute access to decoded batch API responses
+import datetime  # For context cache TTLs
+import weakref  # For the encoded-image cache
+import contextvars  # For attributing request metrics to their run
 import webbrowser  # For clickable email link
 import subprocess  # For opening folder in file manager
 
 # ADD: central version constant (was missing, caused NameError)
 APP_VERSION = "2.3.0"
-print(f"=== Supervertaler v{APP_VERSION} starting ===")
 
 # --- Changelog (v2.1.1) ---
 # - Bumped version to 2.1.1.
@@ -40,69 +61,73 @@ print(f"=== Supervertaler v{APP_VERSION} starting ===")
 #   • Improved multimodal image handling (Gemini: PIL.Image; Claude: base64).
 # --- End Changelog ---
 
-PIL_AVAILABLE = False
-try:
-    from PIL import Image 
-    PIL_AVAILABLE = True
-except ImportError:
-    print("WARNING: Pillow (PIL) library not found. Drawings Image Folder feature will be disabled.")
+GUI_ACTIVE = False  # set when the Tk window is running; agents only pop up dialogs then
 
-# --- Library Import Checks ---
-GOOGLE_AI_AVAILABLE = False
-GOOGLE_AI_IMPORT_ERROR_MESSAGE = ""
-GENAI_VERSION = "unknown"
+def show_error_dialog(title, message):
+    """Error dialog for agent failures in the GUI; headless callers already get the message via log_queue"""
+    if GUI_ACTIVE and messagebox is not None:
+        messagebox.showerror(title, message)
 
-print("--- Supervertaler Script: Attempting to import google.generativeai ---")
-try:
-    import google.generativeai as genai
+# --- Startup Timing ---
+# Batch workers start a fresh process per job, so startup cost is measured: module load, API key
+# loading, and each optional library the first time it is actually imported.
+STARTUP_TIMINGS = []  # (label, seconds), in the order they happened
+
+def record_startup_timing(label, seconds):
+    STARTUP_TIMINGS.append((label, seconds))
+
+def startup_report():
+    return "Startup: " + ", ".join(f"{label} {seconds * 1000:.0f} ms" for label, seconds in STARTUP_TIMINGS)
+
+# --- Optional Libraries (imported on first use) ---
+def module_available(name):
+    """Whether a module can be imported, without importing it (only parent packages are loaded)"""
     try:
-        from google.generativeai.types import GenerationConfig 
-    except ImportError:
-        print("Note: Could not import GenerationConfig from google.generativeai.types (may not be needed for this script version).")
-    
-    GENAI_VERSION = getattr(genai, '__version__', 'unknown')
-    print(f"SUCCESS: google.generativeai imported. Version: {GENAI_VERSION}")
-    GOOGLE_AI_AVAILABLE = True
-except ImportError as e:
-    GOOGLE_AI_IMPORT_ERROR_MESSAGE = f"ImportError: {e}\nThe library 'google-generativeai' could not be found by this script."
-    print(f"FAIL: {GOOGLE_AI_IMPORT_ERROR_MESSAGE}")
-except Exception as e_other:
-    GOOGLE_AI_IMPORT_ERROR_MESSAGE = f"An unexpected error occurred during import: {e_other}"
-    print(f"FAIL: {GOOGLE_AI_IMPORT_ERROR_MESSAGE}")
-
-CLAUDE_AVAILABLE = False
-CLAUDE_IMPORT_ERROR_MESSAGE = ""
-ANTHROPIC_VERSION = "unknown"
-
-print("--- Supervertaler Script: Attempting to import anthropic ---")
-try:
-    import anthropic
-    ANTHROPIC_VERSION = getattr(anthropic, '__version__', 'unknown')
-    print(f"SUCCESS: anthropic imported. Version: {ANTHROPIC_VERSION}")
-    CLAUDE_AVAILABLE = True
-except ImportError as e:
-    CLAUDE_IMPORT_ERROR_MESSAGE = f"ImportError: {e}\nThe library 'anthropic' could not be found by this script."
-    print(f"FAIL: {CLAUDE_IMPORT_ERROR_MESSAGE}")
-except Exception as e_other:
-    CLAUDE_IMPORT_ERROR_MESSAGE = f"An unexpected error occurred during import: {e_other}"
-    print(f"FAIL: {CLAUDE_IMPORT_ERROR_MESSAGE}")
-
-OPENAI_AVAILABLE = False
-OPENAI_IMPORT_ERROR_MESSAGE = ""
-OPENAI_VERSION = "unknown"
-
-print("--- Supervertaler Script: Attempting to import openai ---")
-try:
-    import openai
-    OPENAI_VERSION = getattr(openai, '__version__', 'unknown')
-    print(f"SUCCESS: openai imported. Version: {OPENAI_VERSION}")
-    OPENAI_AVAILABLE = True
-except ImportError as e:
-    OPENAI_IMPORT_ERROR_MESSAGE = f"ImportError: {e}\nThe library 'openai' could not be found by this script."
-    print(f"FAIL: {OPENAI_IMPORT_ERROR_MESSAGE}")
-except Exception as e_other:
-    OPENAI_IMPORT_ERROR_MESSAGE = f"An unexpected error occurred during import: {e_other}"
-    print(f"FAIL: {OPENAI_IMPORT_ERROR_MESSAGE}")
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+class LazyModule:
+    """Stand-in for an optional library that imports it on first attribute access.
+
+    Provider SDKs and Pillow take a noticeable share of startup; a run only pays for the ones it uses.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                started = time.perf_counter()
+                module = importlib.import_module(self._name)
+                record_startup_timing(f"import {self._name}", time.perf_counter() - started)
+                self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._module if self._module is not None else self._load(), attr)
+
+def _missing_library_message(package):
+    return f"ImportError: No module named '{package}'\nThe library '{package}' could not be found by this script."
+
+PIL_AVAILABLE = module_available("PIL")
+Image = LazyModule("PIL.Image")
+
+# --- Library Availability Checks ---
+GOOGLE_AI_AVAILABLE = module_available("google.generativeai")
+GOOGLE_AI_IMPORT_ERROR_MESSAGE = "" if GOOGLE_AI_AVAILABLE else _missing_library_message("google-generativeai")
+genai = LazyModule("google.generativeai")
+
+CLAUDE_AVAILABLE = module_available("anthropic")
+CLAUDE_IMPORT_ERROR_MESSAGE = "" if CLAUDE_AVAILABLE else _missing_library_message("anthropic")
+anthropic = LazyModule("anthropic")
+
+OPENAI_AVAILABLE = module_available("openai")
+OPENAI_IMPORT_ERROR_MESSAGE = "" if OPENAI_AVAILABLE else _missing_library_message("openai")
+httpx = LazyModule("httpx")  # installed with anthropic/openai; used to tune their connection pools
+openai = LazyModule("openai")
 
 # --- API Key Configuration ---
 def load_api_keys():
@@ -152,8 +177,21 @@ def load_api_keys():
     
     return api_keys
 
-# Load API keys
-API_KEYS = load_api_keys()
+_API_KEYS = None
+
+def get_api_keys():
+    """API keys from api_keys.txt, read (and the template created) on first use rather than at import"""
+    global _API_KEYS
+    if _API_KEYS is None:
+        started = time.perf_counter()
+        _API_KEYS = load_api_keys()
+        record_startup_timing("api keys", time.perf_counter() - started)
+    return _API_KEYS
+
+def provider_api_key(api_keys, provider):
+    """The key from api_keys (as loaded by load_api_keys) for a provider name; "" if there is none"""
+    return {"Claude": api_keys.get("claude", ""), "Gemini": api_keys.get("google", ""), "OpenAI": api_keys.get("openai", ""),
+            "Mock": MOCK_API_KEY}.get(provider, "")
 
 # --- Model Definitions ---
 GEMINI_MODELS = [
@@ -185,6 +223,28 @@ OPENAI_MODELS = [
     "gpt-3.5-turbo"
 ]
 
+# --- Concurrency Defaults ---
+# Max LLM chunk requests in flight at once, per provider. The GUI "Parallel Requests"
+# field overrides this; "auto" (or blank) falls back to these values.
+PROVIDER_MAX_IN_FLIGHT = {
+    "Gemini": 4,
+    "Claude": 4,
+    "OpenAI": 4,
+    "Mock": 8
+}
+DEFAULT_MAX_IN_FLIGHT = 2
+
+def get_provider_max_in_flight(provider, override=None):
+    """Resolve the max number of concurrent chunk requests for a provider"""
+    if override:
+        try:
+            value = int(override)
+            if value > 0:
+                return value
+        except (TypeError, ValueError):
+            pass
+    return PROVIDER_MAX_IN_FLIGHT.get(provider, DEFAULT_MAX_IN_FLIGHT)
+
 # --- DOCX Change Reference Parser (Integrated from your original code) ---
 W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
 
@@ -287,15 +347,23 @@ class TrackedChangesAgent:
         self.change_data = []  # List of (original_text, final_text) tuples
         self.files_loaded = []  # Track which files have been loaded
     
-    def load_docx_changes(self, docx_path):
-        """Load tracked changes from a DOCX file"""
+    def load_docx_changes(self, docx_path, parsed=None):
+        """Load tracked changes from a DOCX file
+
+        parsed: (pairs, error) already extracted by docx_changes_task (see load_files)
+        """
         if not docx_path:
             return False
             
         self.log_queue.put(f"[Tracked Changes] Loading changes from: {docx_path}")
         
         try:
-            new_changes = parse_docx_pairs(docx_path)
+            if parsed is None:
+                new_changes = parse_docx_pairs(docx_path)
+            else:
+                new_changes, error = parsed
+                if error:
+                    raise ValueError(error)
             
             # Add to existing changes
             self.change_data.extend(new_changes)
@@ -307,7 +375,7 @@ class TrackedChangesAgent:
             return True
         except Exception as e:
             self.log_queue.put(f"[Tracked Changes] Error loading {docx_path}: {e}")
-            messagebox.showerror("Tracked Changes Error", f"Failed to load tracked changes from {os.path.basename(docx_path)}: {e}")
+            show_error_dialog("Tracked Changes Error", f"Failed to load tracked changes from {os.path.basename(docx_path)}: {e}")
             return False
     
     def load_tsv_changes(self, tsv_path):
@@ -348,9 +416,25 @@ class TrackedChangesAgent:
             return True
         except Exception as e:
             self.log_queue.put(f"[Tracked Changes] Error loading {tsv_path}: {e}")
-            messagebox.showerror("Tracked Changes Error", f"Failed to load tracked changes from {os.path.basename(tsv_path)}: {e}")
+            show_error_dialog("Tracked Changes Error", f"Failed to load tracked changes from {os.path.basename(tsv_path)}: {e}")
             return False
     
+    def load_files(self, paths, pool=None):
+        """Load several DOCX/TSV files (anything not .docx is read as TSV); returns how many loaded.
+
+        With a CPU pool the DOCX files are parsed in worker processes, in parallel.
+        """
+        docx_paths = [path for path in paths if path.lower().endswith(".docx")]
+        parsed = dict(zip(docx_paths, run_cpu_tasks(docx_changes_task, [(path,) for path in docx_paths], pool, self.log_queue)
+                          if pool is not None and len(docx_paths) > 1 else [None] * len(docx_paths)))
+        loaded = 0
+        for path in paths:
+            if path in parsed:
+                loaded += bool(self.load_docx_changes(path, parsed[path]))
+            else:
+                loaded += bool(self.load_tsv_changes(path))
+        return loaded
+
     def clear_changes(self):
         """Clear all loaded tracked changes"""
         self.change_data.clear()
@@ -679,30 +763,1345 @@ def format_tracked_changes_context(tracked_changes_list, max_length=1000):
     
     return "\n".join(context_parts) + "\n"
 
+_PNG_BASE64_CACHE = {}  # id(image) -> (weakref to the image, base64 PNG)
+
+def remember_base64_png(img, encoded):
+    """Cache an image's base64 PNG for as long as the image lives (see pil_image_to_base64_png)"""
+    key = id(img)
+    _PNG_BASE64_CACHE[key] = (weakref.ref(img, lambda ref, key=key: _PNG_BASE64_CACHE.pop(key, None)), encoded)
+
 def pil_image_to_base64_png(img):
-    """Encode a PIL image to base64 PNG (ascii) for Claude/OpenAI data URLs."""
+    """Encode a PIL image to base64 PNG (ascii) for Claude/OpenAI data URLs.
+
+    Each image is encoded once: chunks citing the same figure reuse the cached string.
+    """
+    cached = _PNG_BASE64_CACHE.get(id(img))
+    if cached is not None and cached[0]() is img:
+        return cached[1]
     try:
-        buf = io.BytesIO()
-        img.save(buf, format="PNG")
-        return base64.b64encode(buf.getvalue()).decode("ascii")
+        with trace_span("png_encode", "cpu", size=list(getattr(img, "size", ()))):
+            buf = io.BytesIO()
+            img.save(buf, format="PNG")
+            encoded = base64.b64encode(buf.getvalue()).decode("ascii")
     except Exception:
         return None
+    try:
+        remember_base64_png(img, encoded)
+    except TypeError:
+        pass  # not weak-referenceable; just don't cache
+    return encoded
+
+# --- CPU Worker Pool ---
+# Parsing input files, TMX/DOCX and encoding drawings is CPU-bound Python that holds the GIL,
+# so on large queues it runs in worker processes while the main process keeps the LLM requests
+# going. Tasks are module-level functions taking and returning plain data (segment lists,
+# TM dicts, base64 strings), so results hand over to the dispatcher unchanged.
+_CPU_POOLS = {}
+_CPU_POOLS_LOCK = threading.Lock()
+
+def resolve_cpu_workers(value=None):
+    """CPU worker processes: a number, or "auto"/blank/0 for one per core"""
+    if value in (None, "", 0, "0", "auto"):
+        return os.cpu_count() or 1
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid CPU workers value '{value}' (use a number or 'auto').")
+
+def get_cpu_pool(workers=None):
+    """Process-wide worker pool for CPU-bound stages, or None when there would be a single worker
+    (then the stages run in-process, as before)"""
+    workers = resolve_cpu_workers(workers)
+    if workers <= 1:
+        return None
+    with _CPU_POOLS_LOCK:
+        pool = _CPU_POOLS.get(workers)
+        if pool is None:
+            pool = _CPU_POOLS[workers] = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        return pool
+
+def run_cpu_tasks(fn, args_list, pool=None, log_queue=None):
+    """fn(*args) for each args tuple, in the pool when there is one; results in input order.
+
+    If the pool breaks (a worker process died), the remaining work runs in-process.
+    """
+    if pool is None:
+        return [fn(*args) for args in args_list]
+    try:
+        futures = [pool.submit(fn, *args) for args in args_list]
+        return [future.result() for future in futures]
+    except concurrent.futures.process.BrokenProcessPool as e:
+        if log_queue is not None:
+            log_queue.put(f"[Workers] Process pool failed ({e}); continuing in-process.")
+        return [fn(*args) for args in args_list]
+
+class MessageBuffer:
+    """log_queue stand-in for worker processes: collects messages to replay in the parent"""
+    def __init__(self):
+        self.messages = []
+
+    def put(self, message):
+        self.messages.append(message)
+
+def ingest_task(input_f, mode):
+    """Read one input file; returns (segment data, log messages)"""
+    log = MessageBuffer()
+    return BilingualFileIngestionAgent().process(input_f, log, mode=mode), log.messages
+
+def tm_file_task(tm_fp, gui_src, gui_tgt):
+    """Parse one TM file; returns (tm_data, log messages)"""
+    log = MessageBuffer()
+    return parse_tm_file(tm_fp, gui_src, gui_tgt, log), log.messages
+
+def docx_changes_task(docx_path):
+    """Extract tracked-change pairs from one DOCX; returns (pairs, error message or None)"""
+    try:
+        return parse_docx_pairs(docx_path), None
+    except Exception as e:
+        return [], str(e)
+
+def drawing_task(image_path):
+    """Encode one figure image as base64 PNG; returns (encoded or None, error message or None)"""
+    try:
+        with Image.open(image_path) as img:
+            encoded = pil_image_to_base64_png(img)
+        return encoded, None if encoded else "PNG encoding failed"
+    except Exception as e:
+        return None, str(e)
+
+# --- Token Estimation ---
+CHARS_PER_TOKEN = 4          # rough average for Latin-script text
+IMAGE_TOKEN_ESTIMATE = 1600  # typical cost of one drawing page
+OUTPUT_EXPANSION = 1.3       # translations run somewhat longer than their source
+
+def estimate_tokens(text):
+    """Cheap token estimate for budgeting (no tokenizer dependency)"""
+    if not text:
+        return 0
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def estimate_payload_tokens(payload):
+    """Estimate the input tokens of a provider payload (Gemini parts list, Claude/OpenAI message dicts)"""
+    if isinstance(payload, str):
+        return estimate_tokens(payload)
+    if isinstance(payload, (list, tuple)):
+        return sum(estimate_payload_tokens(p) for p in payload)
+    if isinstance(payload, dict):
+        if payload.get("type") in ("image", "image_url"):
+            return IMAGE_TOKEN_ESTIMATE
+        return sum(estimate_payload_tokens(v) for k, v in payload.items() if k in ("contents", "messages", "content", "text", "system"))
+    if isinstance(payload, (int, float, bool)) or payload is None:
+        return 0
+    return IMAGE_TOKEN_ESTIMATE  # e.g. a PIL.Image in a Gemini parts list
+
+def estimate_output_tokens(texts):
+    """Estimate the completion size for a chunk: one numbered line per segment"""
+    return sum(math.ceil(estimate_tokens(t) * OUTPUT_EXPANSION) + 4 for t in texts)
+
+# --- Model Token Limits ---
+# (context window, max output tokens), matched by longest model-name prefix
+MODEL_TOKEN_LIMITS = {
+    "gemini-2.5": (1048576, 65536),
+    "gemini-1.5": (1048576, 8192),
+    "claude-opus-4": (200000, 32000),
+    "claude-sonnet-4": (200000, 64000),
+    "claude-3-7-sonnet": (200000, 64000),
+    "claude-3-5-sonnet": (200000, 8192),
+    "claude-3-5-haiku": (200000, 8192),
+    "claude-3": (200000, 4096),
+    "gpt-5": (400000, 128000),
+    "gpt-4o": (128000, 16384),
+    "gpt-4-turbo": (128000, 4096),
+    "gpt-4": (8192, 4096),
+    "gpt-3.5-turbo": (16385, 4096)
+}
+DEFAULT_TOKEN_LIMITS = (128000, 4096)
+MIN_OUTPUT_TOKENS = 1024
+OUTPUT_TOKEN_HEADROOM = 1.5  # max_tokens = estimate x headroom, so normal variance never truncates
+
+def get_model_token_limits(model_name):
+    """Return {"context": ..., "output": ...} token limits for a model name"""
+    name = (model_name or "").split('/')[-1]
+    for prefix in sorted(MODEL_TOKEN_LIMITS, key=len, reverse=True):
+        if name.startswith(prefix):
+            context, output = MODEL_TOKEN_LIMITS[prefix]
+            return {"context": context, "output": output}
+    return {"context": DEFAULT_TOKEN_LIMITS[0], "output": DEFAULT_TOKEN_LIMITS[1]}
+
+def size_max_output_tokens(model_name, est_output_tokens):
+    """max_tokens for a request: the chunk's estimated output plus headroom, within the model limit"""
+    wanted = max(MIN_OUTPUT_TOKENS, int(est_output_tokens * OUTPUT_TOKEN_HEADROOM) + 256)
+    return min(wanted, get_model_token_limits(model_name)["output"])
+
+# --- Chunk Planning ---
+PROMPT_OVERHEAD_TOKENS = 2000  # system prompt, instructions, tracked changes, headings
+
+def plan_chunks(indices, source_segments, model_name, max_segments, context_tokens=0, target_segments=None):
+    """Pack document indices into contiguous, balanced chunks by estimated tokens.
+
+    Each chunk's estimated output must fit the model's output limit (with the headroom
+    size_max_output_tokens adds) and its input must fit the context window next to the
+    document context sent with every chunk. Within those limits the chunk count is the
+    smallest that works, and chunks aim at an equal share of the total output so they
+    finish at similar times. max_segments (the "Chunk Size" setting) caps the line count.
+    """
+    if not indices:
+        return []
+    limits = get_model_token_limits(model_name)
+    output_budget = max(MIN_OUTPUT_TOKENS, int((limits["output"] - 256) / OUTPUT_TOKEN_HEADROOM))
+    input_budget = max(1, limits["context"] - context_tokens - PROMPT_OVERHEAD_TOKENS - limits["output"])
+    max_segments = max(1, int(max_segments or len(indices)))
+
+    out_tokens, in_tokens = [], []
+    for idx in indices:
+        text = target_segments[idx] if target_segments else source_segments[idx]
+        out_tokens.append(estimate_output_tokens([text]))
+        in_tokens.append(estimate_tokens(source_segments[idx]) + (estimate_tokens(target_segments[idx]) if target_segments else 0) + 4)
+
+    total_out, total_in = sum(out_tokens), sum(in_tokens)
+    num_chunks = max(math.ceil(total_out / output_budget), math.ceil(total_in / input_budget),
+                     math.ceil(len(indices) / max_segments), 1)
+
+    chunks, current, cur_out, cur_in = [], [], 0, 0
+    remaining_out, remaining_count = total_out, len(indices)
+    for idx, seg_out, seg_in in zip(indices, out_tokens, in_tokens):
+        if current and (cur_out + seg_out > output_budget or cur_in + seg_in > input_budget or len(current) >= max_segments):
+            chunks.append(current)
+            current, cur_out, cur_in = [], 0, 0
+        current.append(idx)
+        cur_out += seg_out
+        cur_in += seg_in
+        remaining_out -= seg_out
+        remaining_count -= 1
+        # Close once this chunk has its share of the output still to be placed, provided the
+        # remaining lines still fit in the remaining chunks
+        chunks_left = max(1, num_chunks - len(chunks))
+        if chunks_left > 1 and cur_out >= (cur_out + remaining_out) / chunks_left \
+                and remaining_count <= (chunks_left - 1) * max_segments:
+            chunks.append(current)
+            current, cur_out, cur_in = [], 0, 0
+    if current:
+        chunks.append(current)
+    return chunks
+
+def describe_chunk_plan(chunks, source_segments, target_segments=None):
+    sizes = [sum(estimate_output_tokens([(target_segments or source_segments)[idx]]) for idx in chunk) for chunk in chunks]
+    if not sizes:
+        return "no chunks"
+    return (f"{len(chunks)} chunk(s), {min(len(c) for c in chunks)}-{max(len(c) for c in chunks)} lines, "
+            f"est. output {min(sizes)}-{max(sizes)} tokens per chunk")
+
+# --- Prompt Caching ---
+# Prompts are laid out as [system prompt, instructions, document context] + [tracked changes, chunk lines]
+# so the first part is byte-identical across chunks and can be served from the provider's prompt cache.
+# The cache boundary only includes the document context when it is the same for every chunk
+# (context_shared, i.e. the "full" strategy); otherwise it sits after the instructions.
+ANTHROPIC_CACHE_CONTROL = {"type": "ephemeral"}
+GEMINI_CACHE_MIN_TOKENS = 4096  # Gemini rejects cached contents below the model minimum
+GEMINI_CACHE_TTL_SECONDS = 900
+
+# --- Document Context Strategies ---
+CONTEXT_STRATEGIES = ("full", "window", "summary", "retrieval")
+DEFAULT_CONTEXT_TOKEN_CAP = 8000
+SUMMARY_MAX_WORDS = 600
+SUMMARY_MAX_CAP_SHARE = 0.5  # the summary gets at most this share of the cap; neighbours get the rest
+RETRIEVAL_NEIGHBOURS = 2  # segments either side of the chunk always included in retrieval mode
+WORD_RE = re.compile(r"\w{3,}", re.UNICODE)
+
+class DocumentContextBuilder:
+    """Builds the per-chunk document context sent alongside the lines being processed.
+
+    full      - the whole numbered document (falls back to window if it exceeds the cap)
+    window    - the chunk's own span plus neighbouring segments, grown outwards up to the cap
+    summary   - a one-time LLM summary of the document, then a neighbour window in the rest of the cap
+    retrieval - the segments most similar to the chunk (TF-IDF over words) plus close neighbours
+    Every strategy keeps each chunk's context within token_cap (estimated tokens): a summary is cut
+    to its share of the cap, and a chunk span larger than what is left is trimmed from both ends
+    (those lines are sent with the chunk itself anyway).
+    """
+    def __init__(self, strategy, source_segments, target_segments=None, token_cap=DEFAULT_CONTEXT_TOKEN_CAP,
+                 summarizer=None, log_queue=None):
+        self.strategy = strategy if strategy in CONTEXT_STRATEGIES else "full"
+        self.source_segments = source_segments
+        self.target_segments = target_segments or None
+        self.token_cap = max(500, int(token_cap or DEFAULT_CONTEXT_TOKEN_CAP))
+        self.summarizer = summarizer
+        self.log_queue = log_queue
+        self.summary = None
+        self.summary_lock = threading.Lock()
+        self.segment_tokens = [estimate_tokens(s) + estimate_tokens(self.target_segments[i] if self.target_segments else "") + 4
+                               for i, s in enumerate(source_segments)]
+        self.full_source = None
+        self.full_target = None
+        self.index = None
+        if self.strategy == "full":
+            if sum(self.segment_tokens) > self.token_cap:
+                self._log(f"[Context] Full document (~{sum(self.segment_tokens)} tokens) exceeds the {self.token_cap}-token cap; using window context.")
+                self.strategy = "window"
+            else:
+                self.full_source = self._numbered(self.source_segments, range(len(self.source_segments)))
+                self.full_target = self._numbered(self.target_segments, range(len(self.source_segments))) if self.target_segments else ""
+        elif self.strategy == "retrieval":
+            self._build_index()
+
+    def _log(self, msg):
+        if self.log_queue is not None:
+            self.log_queue.put(msg)
+
+    @staticmethod
+    def _numbered(segments, indices):
+        return "\n".join(f"{i+1}. {segments[i]}" for i in indices)
+
+    def same_for_every_chunk(self):
+        """True if every chunk gets the same context (so it can sit in the cached prompt prefix)"""
+        return self.strategy == "full"
+
+    def max_context_tokens(self):
+        """Upper bound of the per-chunk context, for chunk planning"""
+        if self.strategy == "full":
+            return sum(self.segment_tokens)
+        return self.token_cap
+
+    def prepare(self):
+        """Do one-time work (the summary call) before chunks are dispatched"""
+        if self.strategy == "summary":
+            self._get_summary()
+
+    def _get_summary(self):
+        with self.summary_lock:
+            if self.summary is None:
+                if self.summarizer is None:
+                    self.summary = ""
+                else:
+                    self._log("[Context] Building one-time document summary...")
+                    try:
+                        self.summary = self.summarizer(self.source_segments) or ""
+                    except Exception as e:
+                        self._log(f"[Context] Summary failed ({e}); using window context only.")
+                        self.summary = ""
+                    budget = int(self.token_cap * SUMMARY_MAX_CAP_SHARE)
+                    if estimate_tokens(self.summary) > budget:
+                        self._log(f"[Context] Summary (~{estimate_tokens(self.summary)} tokens) cut to {budget} tokens "
+                                  f"to stay within the context cap.")
+                        self.summary = self.summary[:budget * CHARS_PER_TOKEN].rstrip()
+                    self._log(f"[Context] Summary ready (~{estimate_tokens(self.summary)} tokens).")
+            return self.summary
+
+    def _span(self, indices, budget):
+        """The chunk's own span, trimmed from both ends until it fits budget: (lo, hi, tokens used)"""
+        lo, hi = min(indices), max(indices)
+        used = sum(self.segment_tokens[lo:hi + 1])
+        while used > budget and lo <= hi:
+            if (hi - lo) % 2:
+                used -= self.segment_tokens[hi]; hi -= 1
+            else:
+                used -= self.segment_tokens[lo]; lo += 1
+        return lo, hi, used
+
+    def _window(self, indices, budget):
+        """Chunk span plus neighbours alternately before/after, within budget tokens"""
+        n = len(self.source_segments)
+        lo, hi, used = self._span(indices, budget)
+        if (lo, hi) != (min(indices), max(indices)):
+            return set(range(lo, hi + 1))  # the span alone fills the budget
+        selected = set(range(lo, hi + 1))
+        before, after = lo - 1, hi + 1
+        while before >= 0 or after < n:
+            grew = False
+            for side in ("before", "after"):
+                i = before if side == "before" else after
+                if 0 <= i < n and used + self.segment_tokens[i] <= budget:
+                    selected.add(i)
+                    used += self.segment_tokens[i]
+                    grew = True
+                    if side == "before":
+                        before -= 1
+                    else:
+                        after += 1
+            if not grew:
+                break
+        return selected
+
+    def _build_index(self):
+        self.index = {}
+        self.segment_terms = []
+        for i, seg in enumerate(self.source_segments):
+            terms = {}
+            for word in WORD_RE.findall(seg.lower()):
+                terms[word] = terms.get(word, 0) + 1
+            self.segment_terms.append(terms)
+            for word in terms:
+                self.index.setdefault(word, []).append(i)
+        n = max(1, len(self.source_segments))
+        self.idf = {word: math.log(n / len(postings)) + 1.0 for word, postings in self.index.items()}
+        self.norms = [math.sqrt(sum((tf * self.idf[w]) ** 2 for w, tf in terms.items())) or 1.0 for terms in self.segment_terms]
+
+    def _retrieve(self, indices, budget):
+        n = len(self.source_segments)
+        lo, hi, used = self._span(indices, budget)
+        selected = set(range(lo, hi + 1))
+        if (lo, hi) == (min(indices), max(indices)):
+            for distance in range(1, RETRIEVAL_NEIGHBOURS + 1):
+                for i in (lo - distance, hi + distance):
+                    if 0 <= i < n and used + self.segment_tokens[i] <= budget:
+                        selected.add(i)
+                        used += self.segment_tokens[i]
+        query = {}
+        for idx in indices:
+            for word, tf in self.segment_terms[idx].items():
+                query[word] = query.get(word, 0) + tf
+        scores = {}
+        for word, qtf in query.items():
+            weight = qtf * self.idf[word] ** 2
+            for i in self.index.get(word, ()):
+                if i not in selected:
+                    scores[i] = scores.get(i, 0.0) + weight * self.segment_terms[i][word]
+        for i in sorted(scores, key=lambda i: scores[i] / self.norms[i], reverse=True):
+            if used + self.segment_tokens[i] > budget:
+                continue
+            selected.add(i)
+            used += self.segment_tokens[i]
+        return selected
+
+    def for_chunk(self, indices):
+        """Return (source_context, target_context) strings for a chunk's original-document indices"""
+        if self.strategy == "full":
+            return self.full_source, self.full_target
+        if self.strategy == "retrieval":
+            prefix = "(Excerpts: segments most relevant to this batch, in document order)\n"
+            selected = sorted(self._retrieve(indices, self.token_cap - estimate_tokens(prefix)))
+        elif self.strategy == "summary":
+            summary = self._get_summary()
+            prefix = f"DOCUMENT SUMMARY:\n{summary}\n\nNEIGHBOURING SEGMENTS:\n" if summary else ""
+            selected = sorted(self._window(indices, self.token_cap - estimate_tokens(prefix)))
+        else:
+            prefix = "(Excerpt: segments surrounding this batch)\n"
+            selected = sorted(self._window(indices, self.token_cap - estimate_tokens(prefix)))
+        source_ctx = prefix + self._numbered(self.source_segments, selected)
+        target_ctx = self._numbered(self.target_segments, selected) if self.target_segments else ""
+        return source_ctx, target_ctx
+
+# --- Rate Limiting ---
+# Per-minute quotas used by the shared limiters. Keys: rpm (requests), tpm (input+output
+# tokens), input_tpm, output_tpm; omit a key to leave it unmetered. MODEL_RATE_LIMITS entries
+# (matched by model-name prefix) override the provider defaults; adjust both to your account tier.
+PROVIDER_RATE_LIMITS = {
+    "Gemini": {"rpm": 150, "input_tpm": 2000000},
+    "Claude": {"rpm": 50, "input_tpm": 30000, "output_tpm": 8000},
+    "OpenAI": {"rpm": 500, "tpm": 30000}
+}
+MODEL_RATE_LIMITS = {}
+
+class TokenBucket:
+    """Token bucket refilled continuously at per_minute/60 units per second.
+
+    reserve() debits immediately (the balance may go negative) and returns how long the
+    caller must wait, so concurrent callers are served in arrival order without polling.
+    """
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # A single request larger than the whole bucket only has to wait for a full bucket
+        self.tokens -= min(float(amount), self.capacity)
+        return max(0.0, -self.tokens / self.rate)
+
+    def adjust(self, delta):
+        """Correct an earlier reservation once the real usage is known (positive delta = refund)"""
+        self.tokens = min(self.capacity, self.tokens + delta)
+
+class ProviderRateLimiter:
+    """Meters requests and estimated input/output tokens for one provider/model/API key"""
+    def __init__(self, name, limits):
+        self.name = name
+        self.lock = threading.Lock()
+        self.buckets = {key: TokenBucket(value) for key, value in limits.items() if value}
+
+    def reserve(self, input_tokens, output_tokens):
+        amounts = {"rpm": 1, "tpm": input_tokens + output_tokens,
+                   "input_tpm": input_tokens, "output_tpm": output_tokens}
+        with self.lock:
+            now = time.monotonic()
+            return max([bucket.reserve(amounts[key], now) for key, bucket in self.buckets.items()] or [0.0])
+
+    def acquire(self, input_tokens, output_tokens):
+        """Block until the request fits the quota; returns the seconds waited"""
+        wait = self.reserve(input_tokens, output_tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def aacquire(self, input_tokens, output_tokens):
+        wait = self.reserve(input_tokens, output_tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def settle(self, estimated_input, estimated_output, actual_input, actual_output):
+        """Refund or charge the difference between the estimate and the reported usage"""
+        deltas = {"tpm": (estimated_input + estimated_output) - (actual_input + actual_output),
+                  "input_tpm": estimated_input - actual_input,
+                  "output_tpm": estimated_output - actual_output}
+        with self.lock:
+            for key, delta in deltas.items():
+                if key in self.buckets:
+                    self.buckets[key].adjust(delta)
+
+def get_rate_limits(provider, model_name):
+    limits = dict(PROVIDER_RATE_LIMITS.get(provider, {}))
+    for prefix in sorted(MODEL_RATE_LIMITS, key=len, reverse=True):
+        if model_name and model_name.startswith(prefix):
+            limits.update(MODEL_RATE_LIMITS[prefix])
+            break
+    return limits
+
+_RATE_LIMITERS = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+def get_rate_limiter(provider, model_name, api_key):
+    """Return the process-wide limiter for (provider, model, API key), creating it on first use"""
+    key_digest = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+    registry_key = (provider, model_name, key_digest)
+    with _RATE_LIMITERS_LOCK:
+        limiter = _RATE_LIMITERS.get(registry_key)
+        if limiter is None:
+            limiter = ProviderRateLimiter(f"{provider}/{model_name}", get_rate_limits(provider, model_name))
+            _RATE_LIMITERS[registry_key] = limiter
+        return limiter
+
+# --- Adaptive Concurrency ---
+def get_error_status_code(exc):
+    """Best-effort HTTP status from Anthropic/OpenAI (status_code) or Google api_core (code) errors"""
+    for candidate in (getattr(exc, "status_code", None), getattr(exc, "code", None),
+                      getattr(getattr(exc, "response", None), "status_code", None)):
+        if isinstance(candidate, int):
+            return candidate
+    return None
+
+RATE_LIMIT_ERROR_NAMES = ("RateLimitError", "OverloadedError", "ResourceExhausted", "ServiceUnavailable", "TooManyRequests")
+
+def is_rate_limit_error(exc):
+    """True for throttling/overload responses (429, 503, 529) from any of the provider SDKs"""
+    if get_error_status_code(exc) in (429, 503, 529):
+        return True
+    if type(exc).__name__ in RATE_LIMIT_ERROR_NAMES:
+        return True
+    text = str(exc).lower()
+    return any(marker in text for marker in ("rate limit", "rate_limit", "overloaded", "resource exhausted", "too many requests"))
+
+class AdaptiveConcurrencyController:
+    """AIMD limit on in-flight requests for one provider/model/API key.
+
+    Starts low and grows by one slot per healthy call (slow start) until the first
+    congestion signal, then by 1/limit per healthy call. Rate-limit/overload errors halve
+    the limit; latency well above the observed baseline trims it by 20%. Decreases are
+    spaced by DECREASE_COOLDOWN so a burst of concurrent 429s counts as one signal.
+    """
+    DECREASE_COOLDOWN = 2.0   # seconds
+    LATENCY_TOLERANCE = 2.5   # x baseline seconds-per-output-token
+    BASELINE_WINDOW = 50      # latency samples kept for the baseline
+
+    def __init__(self, name, max_limit=DEFAULT_MAX_IN_FLIGHT, min_limit=1, initial_limit=2):
+        self.name = name
+        self.cond = threading.Condition()
+        self.min_limit = min_limit
+        self.max_limit = max(min_limit, max_limit)
+        self.limit = float(max(min_limit, min(initial_limit, self.max_limit)))
+        self.in_flight = 0
+        self.waiters = collections.deque()  # (loop, future) of aacquire() calls, in arrival order
+        self.slow_start = True
+        self.last_decrease = 0.0
+        self.latency_samples = []
+        self.successes = 0
+        self.throttled = 0
+        self.errors = 0
+        self.reported_limit = int(self.limit)
+
+    def set_max_limit(self, max_limit):
+        with self.cond:
+            self.max_limit = max(self.min_limit, int(max_limit))
+            self.limit = min(self.limit, float(self.max_limit))
+            self._wake_waiters()
+            self.cond.notify_all()
+
+    def _try_enter(self):
+        if self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return True
+        return False
+
+    def acquire(self):
+        with self.cond:
+            while not self._try_enter():
+                self.cond.wait()
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        with self.cond:
+            if not self.waiters and self._try_enter():
+                return
+            waiter = (loop, loop.create_future())
+            self.waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self.cond:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                    raise
+                if waiter[1].cancelled():
+                    raise  # _grant gives the slot back
+                self._leave()  # granted just before the cancellation
+            raise
+
+    def _wake_waiters(self):
+        """Hand free slots to waiting aacquire() calls in arrival order (lock held)"""
+        while self.waiters and self.in_flight < int(self.limit):
+            loop, future = self.waiters.popleft()
+            self.in_flight += 1
+            loop.call_soon_threadsafe(self._grant, future)
+
+    def _grant(self, future):
+        if not future.done():
+            future.set_result(None)
+            return
+        with self.cond:
+            self._leave()  # the waiter was cancelled after its slot was handed over
+
+    def _leave(self):
+        """Free one slot (lock held)"""
+        self.in_flight -= 1
+        self._wake_waiters()
+        self.cond.notify_all()
+
+    def _decrease(self, factor, now):
+        if now - self.last_decrease < self.DECREASE_COOLDOWN:
+            return
+        self.last_decrease = now
+        self.slow_start = False
+        self.limit = max(float(self.min_limit), self.limit * factor)
+
+    def release(self, latency, est_output_tokens=0, error=None, log_queue=None):
+        """Record the outcome of one call and adapt the limit"""
+        with self.cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if isinstance(error, (asyncio.CancelledError, RequestCancelledError)):
+                pass  # abandoned by the caller: says nothing about the provider
+            elif error is not None:
+                if is_rate_limit_error(error):
+                    self.throttled += 1
+                    self._decrease(0.5, now)
+                else:
+                    self.errors += 1
+            else:
+                self.successes += 1
+                per_token = latency / max(1, est_output_tokens)
+                baseline = min(self.latency_samples) if self.latency_samples else per_token
+                self.latency_samples = (self.latency_samples + [per_token])[-self.BASELINE_WINDOW:]
+                if len(self.latency_samples) >= 5 and per_token > baseline * self.LATENCY_TOLERANCE:
+                    self._decrease(0.8, now)
+                elif self.slow_start:
+                    self.limit = min(float(self.max_limit), self.limit + 1.0)
+                else:
+                    self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self._wake_waiters()
+            self.cond.notify_all()
+            changed = int(self.limit) != self.reported_limit
+            self.reported_limit = int(self.limit)
+        if changed and log_queue is not None:
+            log_queue.put(f"[Concurrency] {self.describe()}")
+
+    def snapshot(self):
+        with self.cond:
+            return {"name": self.name, "limit": int(self.limit), "max_limit": self.max_limit,
+                    "in_flight": self.in_flight, "successes": self.successes,
+                    "throttled": self.throttled, "errors": self.errors}
+
+    def describe(self):
+        snap = self.snapshot()
+        return (f"{snap['name']}: limit {snap['limit']}/{snap['max_limit']}, in flight {snap['in_flight']}, "
+                f"ok {snap['successes']}, throttled {snap['throttled']}, errors {snap['errors']}")
+
+_CONCURRENCY_CONTROLLERS = {}
+_CONCURRENCY_CONTROLLERS_LOCK = threading.Lock()
+
+def get_concurrency_controller(provider, model_name, api_key):
+    """Return the process-wide AIMD controller for (provider, model, API key)"""
+    key_digest = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+    registry_key = (provider, model_name, key_digest)
+    with _CONCURRENCY_CONTROLLERS_LOCK:
+        controller = _CONCURRENCY_CONTROLLERS.get(registry_key)
+        if controller is None:
+            controller = AdaptiveConcurrencyController(f"{provider}/{model_name}",
+                                                       max_limit=get_provider_max_in_flight(provider))
+            _CONCURRENCY_CONTROLLERS[registry_key] = controller
+        return controller
+
+# --- Telemetry ---
+# Estimated USD per million tokens: (input, output, cache read, cache write), matched by longest model-name prefix.
+# List prices when this table was written; good for budgeting, but the provider's invoice is what counts.
+MODEL_PRICES = {
+    "gemini-2.5-pro": (1.25, 10.00, 0.31, 0.0),
+    "gemini-2.5-flash": (0.30, 2.50, 0.075, 0.0),
+    "gemini-1.5-pro": (1.25, 5.00, 0.3125, 0.0),
+    "gemini-1.5-flash": (0.075, 0.30, 0.01875, 0.0),
+    "claude-opus-4": (15.00, 75.00, 1.50, 18.75),
+    "claude-sonnet-4": (3.00, 15.00, 0.30, 3.75),
+    "claude-3-7-sonnet": (3.00, 15.00, 0.30, 3.75),
+    "claude-3-5-sonnet": (3.00, 15.00, 0.30, 3.75),
+    "claude-3-5-haiku": (0.80, 4.00, 0.08, 1.00),
+    "claude-3-opus": (15.00, 75.00, 1.50, 18.75),
+    "claude-3-sonnet": (3.00, 15.00, 0.30, 3.75),
+    "claude-3-haiku": (0.25, 1.25, 0.03, 0.30),
+    "gpt-5": (1.25, 10.00, 0.125, 0.0),
+    "gpt-4o-mini": (0.15, 0.60, 0.075, 0.0),
+    "gpt-4o": (2.50, 10.00, 1.25, 0.0),
+    "gpt-4-turbo": (10.00, 30.00, 10.00, 0.0),
+    "gpt-4": (30.00, 60.00, 30.00, 0.0),
+    "gpt-3.5-turbo": (0.50, 1.50, 0.50, 0.0),
+    "mock-": (0.0, 0.0, 0.0, 0.0)
+}
+USAGE_FIELDS = ("input_tokens", "output_tokens", "cache_read_tokens", "cache_write_tokens")
+METRICS_SUFFIX = ".metrics.jsonl"
+METRICS_SECONDS_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)  # Prometheus histogram bounds
+
+def get_model_prices(model_name):
+    """(input, output, cache read, cache write) USD per million tokens, or None for an unknown model"""
+    name = (model_name or "").split('/')[-1]
+    for prefix in sorted(MODEL_PRICES, key=len, reverse=True):
+        if name.startswith(prefix):
+            return MODEL_PRICES[prefix]
+    return None
+
+def estimate_request_cost(model_name, usage):
+    """Estimated USD for one response's usage dict; None when the model has no price or nothing was reported"""
+    prices = get_model_prices(model_name)
+    if prices is None or not usage:
+        return None
+    return sum((usage.get(field) or 0) * price for field, price in zip(USAGE_FIELDS, prices)) / 1e6
+
+def metrics_path_for(output_path):
+    return output_path + METRICS_SUFFIX
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers (None when empty)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+# What the dispatcher knows about the requests an agent is about to send (run metrics, job label, chunk,
+# attempt, when the chunk was queued). A context variable, so concurrent chunks on shared agents
+# (threads or asyncio tasks) each report to their own run.
+_REQUEST_CONTEXT = contextvars.ContextVar("supervertaler_request_context", default=None)
+
+def request_context(metrics=None, label="", chunk=None, attempt=0, queued_at=None):
+    return {"metrics": metrics, "label": label, "chunk": chunk, "attempt": attempt, "queued_at": queued_at}
+
+class RunMetrics:
+    """Per-request telemetry of one run (or job queue).
+
+    record() takes the dicts built by BaseLLMAgent._record_request; each is appended to the
+    JSONL file (if any) as it arrives and added to the run totals. close() appends a summary line.
+    parent: another RunMetrics (e.g. the whole queue) that also receives every record.
+    """
+    def __init__(self, path=None, log_queue=None, label="", parent=None):
+        self.path = path
+        self.log_queue = log_queue
+        self.label = label
+        self.parent = parent
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.elapsed = None
+        self.totals = dict({"requests": 0, "cached": 0, "errors": 0, "throttled": 0, "retries": 0, "segments": 0,
+                            "cost_usd": 0.0, "unpriced_requests": 0}, **{field: 0 for field in USAGE_FIELDS})
+        self.samples = {"latency_s": [], "ttft_s": [], "queue_wait_s": []}
+        self.file = None
+        if path:
+            try:
+                self.file = open(path, "w", encoding="utf-8")
+            except OSError as e:
+                self._warn(f"cannot write {path} ({e}); metrics are only summarised in the log.")
+
+    def _warn(self, text):
+        if self.log_queue is not None:
+            self.log_queue.put(f"[Metrics] WARN: {text}")
+
+    def _write(self, entry):
+        if self.file is None:
+            return
+        try:
+            self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.file.flush()
+        except (OSError, ValueError) as e:
+            self._warn(f"stopped writing {self.path} ({e}).")
+            self.file = None
+
+    def record(self, entry):
+        with self.lock:
+            totals = self.totals
+            totals["requests"] += 1
+            totals["cached"] += entry["cached"]
+            totals["errors"] += entry["status"] == "error"
+            totals["throttled"] += entry["status"] == "throttled"
+            totals["retries"] += entry["attempt"] > 0
+            if entry["status"] == "ok":
+                totals["segments"] += entry["segments"]
+            for field in USAGE_FIELDS:
+                totals[field] += entry[field] or 0
+            if entry["cost_usd"] is None:
+                totals["unpriced_requests"] += entry["status"] == "ok" and not entry["cached"]
+            else:
+                totals["cost_usd"] += entry["cost_usd"]
+            if not entry["cached"]:
+                for key, values in self.samples.items():
+                    if entry[key] is not None:
+                        values.append(entry[key])
+            self._write(entry)
+        if self.parent is not None:
+            self.parent.record(entry)
+
+    def summary(self):
+        with self.lock:
+            elapsed = self.elapsed if self.elapsed is not None else time.monotonic() - self.started
+            summary = dict(self.totals, cost_usd=round(self.totals["cost_usd"], 6), elapsed_s=round(elapsed, 3),
+                           segments_per_s=round(self.totals["segments"] / elapsed, 3) if elapsed > 0 else None)
+            for key, values in self.samples.items():
+                for name, fraction in (("p50", 0.5), ("p95", 0.95)):
+                    value = percentile(values, fraction)
+                    summary[f"{key[:-2]}_{name}_s"] = round(value, 3) if value is not None else None
+            return summary
+
+    def describe(self, summary=None):
+        s = summary or self.summary()
+        text = (f"{s['requests']} request(s) ({s['cached']} cached, {s['retries']} retries, {s['errors'] + s['throttled']} failed), "
+                f"{s['input_tokens']} in / {s['output_tokens']} out / {s['cache_read_tokens']} cache-read tokens, "
+                f"~${s['cost_usd']:.4f}{' + unpriced' if s['unpriced_requests'] else ''}; "
+                f"{s['segments_per_s'] or 0:.1f} segments/s")
+        if s["latency_p50_s"] is not None:
+            text += f", latency p50 {s['latency_p50_s']:.2f}s / p95 {s['latency_p95_s']:.2f}s"
+        if s["ttft_p50_s"] is not None:
+            text += f", first token p50 {s['ttft_p50_s']:.2f}s"
+        if s["queue_wait_p95_s"]:
+            text += f", queue wait p95 {s['queue_wait_p95_s']:.2f}s"
+        return text + "."
+
+    def close(self):
+        """Stop the clock, append the summary line and close the file; returns the summary dict"""
+        with self.lock:
+            if self.elapsed is None:
+                self.elapsed = time.monotonic() - self.started
+        summary = self.summary()
+        with self.lock:
+            self._write(dict({"event": "summary", "label": self.label.strip()}, **summary))
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        return summary
+
+def _prometheus_labels(labels):
+    escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}" if labels else ""
+
+class MetricsRegistry:
+    """Process-wide LLM request counters and histograms per provider/model, in the Prometheus text format"""
+    HISTOGRAMS = {"latency_s": ("supervertaler_llm_request_seconds", "Time from send to complete response."),
+                  "ttft_s": ("supervertaler_llm_time_to_first_token_seconds", "Time to the first streamed text."),
+                  "queue_wait_s": ("supervertaler_llm_queue_wait_seconds", "Time queued for the dispatcher, rate limiter and concurrency limit.")}
+
+    def __init__(self, buckets=METRICS_SECONDS_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}  # (provider, model) -> counters and histograms
+
+    def record(self, entry):
+        with self.lock:
+            series = self.series.get((entry["provider"], entry["model"]))
+            if series is None:
+                series = {"requests": {}, "retries": 0, "segments": 0, "cost_usd": 0.0,
+                          "tokens": {field: 0 for field in USAGE_FIELDS},
+                          "histograms": {key: {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0} for key in self.HISTOGRAMS}}
+                self.series[(entry["provider"], entry["model"])] = series
+            status = "cached" if entry["cached"] else entry["status"]
+            series["requests"][status] = series["requests"].get(status, 0) + 1
+            series["retries"] += entry["attempt"] > 0
+            series["segments"] += entry["segments"] if entry["status"] == "ok" else 0
+            series["cost_usd"] += entry["cost_usd"] or 0.0
+            for field in USAGE_FIELDS:
+                series["tokens"][field] += entry[field] or 0
+            for key, histogram in series["histograms"].items():
+                value = entry[key]
+                if value is None or entry["cached"]:
+                    continue
+                histogram["counts"][next((n for n, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))] += 1
+                histogram["sum"] += value
+
+    def render(self, gauges=()):
+        """Prometheus text exposition; gauges: extra (name, help, [(labels dict, value)]) to append"""
+        lines = []
+        def family(name, kind, help_text, samples):
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"])
+            lines.extend(f"{sample_name}{_prometheus_labels(labels)} {value:g}" for sample_name, labels, value in samples)
+        with self.lock:
+            series = sorted(self.series.items())
+            family("supervertaler_llm_requests_total", "counter", "LLM requests by outcome (ok, error, throttled, cached).",
+                   [("supervertaler_llm_requests_total", {"provider": p, "model": m, "status": status}, count)
+                    for (p, m), s in series for status, count in sorted(s["requests"].items())])
+            family("supervertaler_llm_retries_total", "counter", "Follow-up requests for lines that failed in an earlier attempt.",
+                   [("supervertaler_llm_retries_total", {"provider": p, "model": m}, s["retries"]) for (p, m), s in series])
+            family("supervertaler_llm_tokens_total", "counter", "Tokens reported by the provider.",
+                   [("supervertaler_llm_tokens_total", {"provider": p, "model": m, "kind": field[:-7]}, s["tokens"][field])
+                    for (p, m), s in series for field in USAGE_FIELDS])
+            family("supervertaler_llm_segments_total", "counter", "Segments sent in successful requests.",
+                   [("supervertaler_llm_segments_total", {"provider": p, "model": m}, s["segments"]) for (p, m), s in series])
+            family("supervertaler_llm_cost_usd_total", "counter", "Estimated cost from MODEL_PRICES (USD).",
+                   [("supervertaler_llm_cost_usd_total", {"provider": p, "model": m}, s["cost_usd"]) for (p, m), s in series])
+            for key, (name, help_text) in self.HISTOGRAMS.items():
+                samples = []
+                for (p, m), s in series:
+                    histogram, cumulative = s["histograms"][key], 0
+                    for bound, count in zip(list(self.buckets) + ["+Inf"], histogram["counts"]):
+                        cumulative += count
+                        samples.append((f"{name}_bucket", {"provider": p, "model": m, "le": bound}, cumulative))
+                    samples.append((f"{name}_sum", {"provider": p, "model": m}, histogram["sum"]))
+                    samples.append((f"{name}_count", {"provider": p, "model": m}, cumulative))
+                family(name, "histogram", help_text, samples)
+        for name, help_text, samples in gauges:
+            family(name, "gauge", help_text, [(name, labels, value) for labels, value in samples])
+        return "\n".join(lines) + "\n"
+
+LLM_METRICS = MetricsRegistry()  # every request in this process, for the job service's GET /metrics
+
+# --- Tracing and Profiling ---
+TRACE_SUFFIX = ".trace.json"      # Chrome trace event format: open in ui.perfetto.dev or chrome://tracing
+PROFILE_SUFFIX = ".profile.txt"
+PROFILERS = ("off", "cprofile", "sampling")
+PROFILE_SAMPLE_INTERVAL = 0.005   # seconds between stack samples of the sampling profiler
+PROFILE_TOP = 40                  # functions listed per table in the profile reports
+
+class Tracer:
+    """Spans of one run as Chrome trace "complete" events, one track per thread.
+
+    Chunks sent by the asyncio dispatcher share a thread, so each in-flight chunk borrows
+    a lane (a track of its own, see acquire_lane) to keep its spans nested correctly.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+        self.events = [{"ph": "M", "name": "process_name", "pid": self.pid, "tid": 0, "args": {"name": f"Supervertaler {name}"}}]
+        self.threads = set()
+        self.free_lanes = []
+        self.lane_count = 0
+
+    def _name_track(self, tid, name):
+        self.events.append({"ph": "M", "name": "thread_name", "pid": self.pid, "tid": tid, "args": {"name": name}})
+
+    def thread_track(self):
+        tid = threading.get_ident()
+        with self.lock:
+            if tid not in self.threads:
+                self.threads.add(tid)
+                self._name_track(tid, threading.current_thread().name)
+        return tid
+
+    def acquire_lane(self):
+        with self.lock:
+            if self.free_lanes:
+                return self.free_lanes.pop()
+            self.lane_count += 1
+            tid = -self.lane_count  # negative ids never clash with thread idents
+            self._name_track(tid, f"Async lane {self.lane_count}")
+            return tid
+
+    def release_lane(self, tid):
+        with self.lock:
+            self.free_lanes.append(tid)
+
+    def add(self, name, cat, start, end, tid, args=None):
+        event = {"ph": "X", "name": name, "cat": cat, "pid": self.pid, "tid": tid,
+                 "ts": round((start - self.origin) * 1e6, 1), "dur": round((end - start) * 1e6, 1)}
+        if args:
+            event["args"] = args
+        with self.lock:
+            self.events.append(event)
+
+    def save(self, path):
+        with self.lock:
+            events = list(self.events)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms",
+                       "otherData": {"app_version": APP_VERSION, "run": self.name}}, f, ensure_ascii=False, default=str)
+        return len(events)
+
+_TRACE = contextvars.ContextVar("supervertaler_trace", default=None)        # (Tracer, lane track or None)
+_PROFILER = contextvars.ContextVar("supervertaler_profiler", default=None)  # profiler of the current run
+_ACTIVE_TRACERS = []  # tracers currently recording, for threads outside any run (the Tk log pump)
+
+class _Span:
+    __slots__ = ("tracer", "tid", "name", "cat", "args", "start")
+
+    def __init__(self, tracer, tid, name, cat, args):
+        self.tracer, self.tid, self.name, self.cat, self.args = tracer, tid, name, cat, args
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args["error"] = f"{exc_type.__name__}: {exc}"[:200]
+        self.tracer.add(self.name, self.cat, self.start, time.perf_counter(), self.tid, self.args)
+        return False
+
+class _NullSpan:
+    __slots__ = ()
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+def trace_span(name, cat="stage", **args):
+    """Context manager timing one stage in the current run's trace; a shared no-op when not tracing"""
+    active = _TRACE.get()
+    if active is None:
+        return _NULL_SPAN
+    tracer, lane = active
+    return _Span(tracer, lane if lane is not None else tracer.thread_track(), name, cat, args)
+
+def trace_span_everywhere(name, cat, start, end, **args):
+    """Record an already measured span in every trace being recorded (for work outside the runs' threads)"""
+    for tracer in list(_ACTIVE_TRACERS):
+        tracer.add(name, cat, start, end, tracer.thread_track(), args)
+
+class CProfileCollector:
+    """Deterministic profile of a run: cProfile only sees the thread that enabled it, so the
+    engine thread and every dispatcher thread get their own profile, merged in the report"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles = []
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def thread_begin(self):
+        import cProfile  # only loaded for --profile cprofile runs
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # Python 3.12+: the profile already enabled covers every thread
+            return None
+        with self.lock:
+            self.profiles.append(profile)
+        return profile
+
+    def thread_end(self, profile):
+        if profile is not None:
+            profile.disable()
+
+    def write_report(self, base_path):
+        with self.lock:
+            profiles = list(self.profiles)
+        if not profiles:
+            return []
+        import pstats
+        report = io.StringIO()
+        stats = pstats.Stats(profiles[0], stream=report)
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.strip_dirs()
+        for key in ("cumulative", "tottime"):
+            stats.sort_stats(key).print_stats(PROFILE_TOP)
+        with open(base_path + PROFILE_SUFFIX, "w", encoding="utf-8") as f:
+            f.write(f"cProfile of {len(profiles)} thread profile(s), merged\n")
+            f.write(report.getvalue())
+        stats.dump_stats(base_path + ".prof")  # for snakeviz, gprof2dot or pstats
+        return [base_path + PROFILE_SUFFIX, base_path + ".prof"]
+
+class SamplingProfiler:
+    """Low-overhead statistical profile: a background thread samples the stacks of all threads"""
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = {}  # (thread name, frames from the outermost) -> samples
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._sample, name="SamplingProfiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def thread_begin(self):
+        return None
+
+    def thread_end(self, handle):
+        pass
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                key = (names.get(ident, str(ident)), tuple(reversed(stack)))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def write_report(self, base_path):
+        inclusive, own = {}, {}
+        for (thread_name, stack), count in self.stacks.items():
+            for frame in set(stack):
+                inclusive[frame] = inclusive.get(frame, 0) + count
+            if stack:
+                own[stack[-1]] = own.get(stack[-1], 0) + count
+        total = max(1, sum(self.stacks.values()))
+        with open(base_path + PROFILE_SUFFIX, "w", encoding="utf-8") as f:
+            f.write(f"Sampling profile: {self.samples} sample(s) every {self.interval * 1000:.0f} ms across all threads "
+                    f"(waiting counts too: time in socket reads is network time)\n")
+            for title, table in (("inclusive (function or its callees on the stack)", inclusive), ("self (function on top of the stack)", own)):
+                f.write(f"\nTop {PROFILE_TOP} by {title}:\n")
+                for frame, count in sorted(table.items(), key=lambda kv: -kv[1])[:PROFILE_TOP]:
+                    f.write(f"{count:8d} {100.0 * count / total:6.1f}%  {frame}\n")
+        # Folded stacks (one "thread;outer;...;inner count" line each) for flamegraph.pl or speedscope
+        with open(base_path + ".folded", "w", encoding="utf-8") as f:
+            for (thread_name, stack), count in sorted(self.stacks.items()):
+                f.write(";".join((thread_name,) + stack).replace(" ", "_") + f" {count}\n")
+        return [base_path + PROFILE_SUFFIX, base_path + ".folded"]
+
+def create_profiler(kind):
+    if kind == "cprofile":
+        return CProfileCollector()
+    if kind == "sampling":
+        return SamplingProfiler()
+    return None
+
+class RunDiagnostics:
+    """Optional tracing and profiling around one run or job queue (a with-block in the engine thread).
+
+    With trace, stages and agent calls record spans (see trace_span) saved to
+    <base_path>.trace.json; with profile "cprofile" or "sampling" the report is saved to
+    <base_path>.profile.txt (plus .prof / .folded for other tools).
+    """
+    def __init__(self, base_path, name, trace=False, profile="off", log_queue=None):
+        self.base_path = base_path
+        self.name = name
+        self.log_queue = log_queue
+        self.tracer = Tracer(name) if trace else None
+        self.profiler = create_profiler(profile)
+        self.tokens = []
+        self.root_span = _NULL_SPAN
+        self.profile_handle = None
+
+    def __enter__(self):
+        if self.tracer is not None:
+            _ACTIVE_TRACERS.append(self.tracer)
+            self.tokens.append((_TRACE, _TRACE.set((self.tracer, None))))
+            self.root_span = trace_span(self.name, "run")
+            self.root_span.__enter__()
+        if self.profiler is not None:
+            self.tokens.append((_PROFILER, _PROFILER.set(self.profiler)))
+            self.profiler.start()
+            self.profile_handle = self.profiler.thread_begin()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.profiler is not None:
+            self.profiler.thread_end(self.profile_handle)
+            self.profiler.stop()
+        self.root_span.__exit__(exc_type, exc, tb)
+        for var, token in reversed(self.tokens):
+            var.reset(token)
+        if self.tracer is not None:
+            _ACTIVE_TRACERS.remove(self.tracer)
+            try:
+                count = self.tracer.save(self.base_path + TRACE_SUFFIX)
+                self.log_queue.put(f"[Trace] {count} events saved to {self.base_path + TRACE_SUFFIX} (open in ui.perfetto.dev or chrome://tracing).")
+            except OSError as e:
+                self.log_queue.put(f"[Trace] WARN: cannot write {self.base_path + TRACE_SUFFIX} ({e}).")
+        if self.profiler is not None:
+            try:
+                written = self.profiler.write_report(self.base_path)
+                self.log_queue.put(f"[Profile] Report saved to {', '.join(written) or '(nothing recorded)'}.")
+            except OSError as e:
+                self.log_queue.put(f"[Profile] WARN: cannot write the report next to {self.base_path} ({e}).")
+        return False
+
+# --- Response Cache ---
+RESPONSE_CACHE_FILENAME = "response_cache.sqlite3"
+RESPONSE_CACHE_MAX_BYTES = 500 * 1024 * 1024
+RESPONSE_CACHE_MAX_AGE_DAYS = 30
+RESPONSE_CACHE_EVICT_EVERY = 200  # puts between eviction passes
+
+def _cache_key_default(obj):
+    """JSON fallback for payload objects: images are reduced to a digest of their pixels"""
+    if hasattr(obj, "tobytes") and hasattr(obj, "size"):
+        return {"image_sha256": hashlib.sha256(obj.tobytes()).hexdigest(), "size": list(obj.size),
+                "mode": getattr(obj, "mode", "")}
+    return repr(obj)
+
+def response_cache_key(provider, model_name, payload):
+    """Content address of a request: provider, model and the fully rendered payload (prompt, images, parameters)"""
+    rendered = json.dumps({"provider": provider, "model": model_name, "payload": payload},
+                          sort_keys=True, ensure_ascii=False, default=_cache_key_default)
+    return hashlib.sha256(rendered.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """SQLite store of LLM responses keyed by response_cache_key, with age and size eviction"""
+    def __init__(self, path, max_bytes=RESPONSE_CACHE_MAX_BYTES, max_age_days=RESPONSE_CACHE_MAX_AGE_DAYS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 86400
+        self.lock = threading.Lock()
+        self.puts = 0
+        self.hits = 0
+        self.misses = 0
+        import sqlite3  # only runs that use the response cache need it
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, provider TEXT, model TEXT, "
+                              "created REAL, accessed REAL, size INTEGER, response TEXT)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.evict()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self.conn:
+                self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, provider, model_name, response):
+        data = json.dumps(response, ensure_ascii=False)
+        now = time.time()
+        with self.lock:
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  (key, provider, model_name, now, now, len(data.encode("utf-8")), data))
+            self.puts += 1
+            evict_now = self.puts % RESPONSE_CACHE_EVICT_EVERY == 0
+        if evict_now:
+            self.evict()
+
+    def evict(self):
+        """Drop entries unused for max_age, then least recently used ones until under max_bytes"""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM responses WHERE accessed < ?", (time.time() - self.max_age,))
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                target = self.max_bytes * 0.9
+                stale = []
+                for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY accessed"):
+                    if total <= target:
+                        break
+                    stale.append((key,))
+                    total -= size
+                self.conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM responses")
+
+    def describe(self):
+        return f"{self.hits} hit(s), {self.misses} miss(es)"
+
+_RESPONSE_CACHES = {}
+_RESPONSE_CACHES_LOCK = threading.Lock()
+
+def get_response_cache(path):
+    """Return the process-wide ResponseCache for a database path"""
+    path = os.path.abspath(path)
+    with _RESPONSE_CACHES_LOCK:
+        cache = _RESPONSE_CACHES.get(path)
+        if cache is None:
+            cache = ResponseCache(path)
+            _RESPONSE_CACHES[path] = cache
+        return cache
+
+# --- Retry / Repair ---
+FAILED_TRANSLATION_MARKERS = ("[TL Missing line", "[TL Err line")
+
+def is_failed_result(mode, value):
+    """True when a per-line result is a placeholder that a follow-up request could fix"""
+    if value is None:
+        return True
+    if mode == "Translate":
+        return isinstance(value, str) and value.startswith(FAILED_TRANSLATION_MARKERS)
+    if not isinstance(value, dict):
+        return True
+    return bool(value.get("missing")) or str(value.get("changes_summary") or "").startswith("[Proofread Err")
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, capped per chunk and by a run-wide request budget"""
+    def __init__(self, max_attempts=3, base_delay=2.0, max_delay=60.0, budget=20):
+        self.max_attempts = max(0, int(max_attempts))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.used = 0
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def try_consume(self):
+        """Reserve one retry request from the budget; False once it is spent"""
+        with self.lock:
+            if self.budget is not None and self.used >= self.budget:
+                return False
+            self.used += 1
+            return True
 
 # --- TMX Generator Class ---
+def tmx_unit_ok(src, tgt):
+    """Whether a source/target pair belongs in the TMX (failed or empty translations are left out)"""
+    return bool(src.strip() and tgt and '[ERR' not in str(tgt) and '[Missing' not in str(tgt)
+                and not str(tgt).startswith(FAILED_TRANSLATION_MARKERS))
+
 class TMXGenerator:
     """Helper class for generating TMX files"""
     def __init__(self):
         pass
-    
-    def generate_tmx(self, source_segments, target_segments, source_lang, target_lang):
-        """Generate TMX content from parallel segments"""
+
+    def _header(self, source_lang):
         from datetime import datetime
-        
-        # Basic TMX structure
-        tmx = ET.Element('tmx')
-        tmx.set('version', '1.4')
-        
-        header = ET.SubElement(tmx, 'header')
+
+        header = ET.Element('header')
         header.set('creationdate', datetime.now().strftime('%Y%m%dT%H%M%SZ'))
         header.set('srclang', get_simple_lang_code(source_lang))
         header.set('adminlang', 'en')
@@ -710,70 +2109,190 @@ class TMXGenerator:
         header.set('creationtool', 'Supervertaler')
         header.set('creationtoolversion', APP_VERSION)
         header.set('datatype', 'plaintext')
-        
+        return header
+
+    def _tu(self, src, tgt, source_lang, target_lang):
+        tu = ET.Element('tu')
+
+        # Source segment
+        tuv_src = ET.SubElement(tu, 'tuv')
+        tuv_src.set('xml:lang', get_simple_lang_code(source_lang))
+        seg_src = ET.SubElement(tuv_src, 'seg')
+        seg_src.text = src.strip()
+
+        # Target segment
+        tuv_tgt = ET.SubElement(tu, 'tuv')
+        tuv_tgt.set('xml:lang', get_simple_lang_code(target_lang))
+        seg_tgt = ET.SubElement(tuv_tgt, 'seg')
+        seg_tgt.text = str(tgt).strip()
+        return tu
+
+    def generate_tmx(self, source_segments, target_segments, source_lang, target_lang):
+        """Generate TMX content from parallel segments"""
+        # Basic TMX structure
+        tmx = ET.Element('tmx')
+        tmx.set('version', '1.4')
+        tmx.append(self._header(source_lang))
         body = ET.SubElement(tmx, 'body')
-        
+
         # Add translation units
         for src, tgt in zip(source_segments, target_segments):
-            if not src.strip() or not tgt or '[ERR' in str(tgt) or '[Missing' in str(tgt):
-                continue
-                
-            tu = ET.SubElement(body, 'tu')
-            
-            # Source segment
-            tuv_src = ET.SubElement(tu, 'tuv')
-            tuv_src.set('xml:lang', get_simple_lang_code(source_lang))
-            seg_src = ET.SubElement(tuv_src, 'seg')
-            seg_src.text = src.strip()
-            
-            # Target segment
-            tuv_tgt = ET.SubElement(tu, 'tuv')
-            tuv_tgt.set('xml:lang', get_simple_lang_code(target_lang))
-            seg_tgt = ET.SubElement(tuv_tgt, 'seg')
-            seg_tgt.text = str(tgt).strip()
-        
+            if tmx_unit_ok(src, tgt):
+                body.append(self._tu(src, tgt, source_lang, target_lang))
+
         return ET.ElementTree(tmx)
 
+    def open_stream(self, tmx_path, source_lang, target_lang):
+        """Start a StreamingTMXWriter: <tu> elements are written one at a time instead of building a tree"""
+        return StreamingTMXWriter(self, tmx_path, source_lang, target_lang)
+
+class AtomicTextFile:
+    """Text file written to a temp file in the same folder and renamed over the target on commit"""
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = f"{path}.{os.getpid()}.tmp"
+        self.file = open(self.tmp_path, 'w', encoding='utf-8', newline='')
+
+    def write(self, text):
+        self.file.write(text)
+
+    def commit(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        if not self.file.closed:
+            self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+class StreamingTMXWriter:
+    """Writes the TMX envelope up front, appends <tu> elements as they arrive, closes it on commit"""
+    def __init__(self, generator, tmx_path, source_lang, target_lang):
+        self.generator = generator
+        self.source_lang = source_lang
+        self.target_lang = target_lang
+        self.units = 0
+        self.out = AtomicTextFile(tmx_path)
+        self.out.write("<?xml version='1.0' encoding='utf-8'?>\n<tmx version=\"1.4\">")
+        self.out.write(ET.tostring(generator._header(source_lang), encoding="unicode"))
+        self.out.write("<body>")
+
+    def write_unit(self, src, tgt):
+        if tmx_unit_ok(src, tgt):
+            self.out.write(ET.tostring(self.generator._tu(src, tgt, self.source_lang, self.target_lang), encoding="unicode"))
+            self.units += 1
+
+    def commit(self):
+        self.out.write("</body></tmx>")
+        self.out.commit()
+
+    def abort(self):
+        self.out.abort()
+
 # === NEW: Output file writer ===
 class OutputGenerationAgent:
     """Writes TXT output and, for Translate mode, TMX alongside it."""
+    def open_stream(self, output_path, log_queue, mode, source_lang=None, target_lang=None):
+        """Start a StreamingOutputWriter for rows that arrive out of order while a run is in progress"""
+        return StreamingOutputWriter(output_path, log_queue, mode, source_lang, target_lang)
+
     def process(self, source_list, target_list, output_path, log_queue, mode, comments_list_for_output=None, source_lang=None, target_lang=None):
+        # Normalize lengths
+        n = min(len(source_list), len(target_list))
+        comments = comments_list_for_output or []
         try:
-            # Normalize lengths
-            n = min(len(source_list), len(target_list))
-            src = source_list[:n]
-            tgt = [(t if t is not None else "") for t in target_list[:n]]
-
-            # Write TXT
-            with open(output_path, 'w', encoding='utf-8', newline='') as f:
-                if mode == "Translate":
-                    for s, t in zip(src, tgt):
-                        f.write(f"{s}\t{t}\n")
-                else:  # Proofread
-                    comments = comments_list_for_output or []
-                    # pad comments to length n
-                    if len(comments) < n:
-                        comments = comments + [None] * (n - len(comments))
-                    for i in range(n):
-                        comment = comments[i] if comments[i] is not None else ""
-                        f.write(f"{src[i]}\t{tgt[i]}\t{comment}\n")
-            log_queue.put(f"[Output] TXT written: {output_path}")
-
-            # Write TMX in Translate mode
-            if mode == "Translate":
-                try:
-                    tmx_path = os.path.splitext(output_path)[0] + ".tmx"
-                    tree = TMXGenerator().generate_tmx(src, tgt, source_lang or "en", target_lang or "en")
-                    # Pretty print (optional); ensure we write UTF-8
-                    tree.write(tmx_path, encoding='utf-8', xml_declaration=True)
-                    log_queue.put(f"[Output] TMX written: {tmx_path}")
-                except Exception as te:
-                    log_queue.put(f"[Output] WARN: TMX not written: {te}")
-
-            return True
+            writer = self.open_stream(output_path, log_queue, mode, source_lang, target_lang)
         except Exception as e:
             log_queue.put(f"[Output] ERROR writing files: {e}")
             return False
+        for i in range(n):
+            writer.add(i, source_list[i], target_list[i], comments[i] if i < len(comments) else None)
+        return writer.close()
+
+class StreamingOutputWriter:
+    """Ordered, incremental TXT (and TMX in Translate mode) writer.
+
+    Rows can be added in any order as chunks finish; a reorder buffer holds rows that arrive
+    early and flushes every contiguous run, so only out-of-order rows are kept in memory.
+    Both files are written to temp files and renamed into place by close().
+    """
+    def __init__(self, output_path, log_queue, mode, source_lang=None, target_lang=None):
+        self.output_path = output_path
+        self.log_queue = log_queue
+        self.mode = mode
+        self.next_index = 0
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.failed = False
+        self.txt = AtomicTextFile(output_path)
+        self.tmx = None
+        self.tmx_path = None  # set once the TMX is committed; an older .tmx next to the output is not ours
+        if mode == "Translate":
+            try:
+                self.tmx = TMXGenerator().open_stream(os.path.splitext(output_path)[0] + ".tmx",
+                                                      source_lang or "en", target_lang or "en")
+            except Exception as te:
+                log_queue.put(f"[Output] WARN: TMX not written: {te}")
+
+    def add(self, index, source, target, comment=None):
+        """Queue row `index` (0-based); rows are written as soon as all earlier rows are in"""
+        with self.lock:
+            if self.failed or index < self.next_index or index in self.pending:
+                return
+            self.pending[index] = (source, target if target is not None else "", comment)
+            while self.next_index in self.pending:
+                self._write_row(*self.pending.pop(self.next_index))
+                self.next_index += 1
+
+    def _write_row(self, source, target, comment):
+        try:
+            if self.mode == "Translate":
+                self.txt.write(f"{source}\t{target}\n")
+            else:  # Proofread
+                self.txt.write(f"{source}\t{target}\t{comment if comment is not None else ''}\n")
+        except Exception as e:
+            self.failed = True
+            self.log_queue.put(f"[Output] ERROR writing files: {e}")
+            return
+        if self.tmx is not None:
+            try:
+                self.tmx.write_unit(source, target)
+            except Exception as te:
+                self.log_queue.put(f"[Output] WARN: TMX not written: {te}")
+                self.tmx.abort()
+                self.tmx = None
+
+    def close(self):
+        """Commit both files; returns False (leaving any previous output untouched) if the TXT failed"""
+        with self.lock:
+            if self.pending:
+                self.log_queue.put(f"[Output] WARN: {len(self.pending)} row(s) after a gap at row {self.next_index + 1} were not written.")
+            if self.failed:
+                self.txt.abort()
+                if self.tmx is not None:
+                    self.tmx.abort()
+                return False
+            try:
+                self.txt.commit()
+            except Exception as e:
+                self.log_queue.put(f"[Output] ERROR writing files: {e}")
+                self.txt.abort()
+                if self.tmx is not None:
+                    self.tmx.abort()
+                return False
+            self.log_queue.put(f"[Output] TXT written: {self.output_path}")
+            if self.tmx is not None:
+                try:
+                    self.tmx.commit()
+                    self.tmx_path = self.tmx.out.path
+                    self.log_queue.put(f"[Output] TMX written: {self.tmx.out.path}")
+                except Exception as te:
+                    self.log_queue.put(f"[Output] WARN: TMX not written: {te}")
+                    self.tmx.abort()
+            return True
 
 # === RESTORE: Agents, TM, factories (required by GUI) ===
 
@@ -814,19 +2333,62 @@ class BilingualFileIngestionAgent:
         log_queue.put(f"[Ingestor] Done. {len(data)} entries/lines loaded.")
         return data
 
+def _parse_tmx_lang_xml_code(lang_attr_val):
+    if lang_attr_val:
+        return lang_attr_val.split('-')[0].split('_')[0].lower()
+    return ""
+
+def parse_tm_file(tm_fp, gui_src, gui_tgt, log_queue):
+    """Parse a TMX (units with both languages) or TXT (source<TAB>target) memory into {source: target}"""
+    tm_data = {}
+    loaded_count = 0
+    if tm_fp.lower().endswith(".tmx"):
+        tree = ET.parse(tm_fp)
+        root = tree.getroot()
+        xml_ns = "http://www.w3.org/XML/1998/namespace"
+        for tu in root.findall('.//tu'):
+            src_tuv, tgt_tuv = None, None
+            for tuv_node in tu.findall('tuv'):
+                lang_attr = tuv_node.get(f'{{{xml_ns}}}lang')
+                if not lang_attr:
+                    continue
+                tmx_simple_code = _parse_tmx_lang_xml_code(lang_attr)
+                if tmx_simple_code == gui_src:
+                    src_tuv = tuv_node
+                elif tmx_simple_code == gui_tgt:
+                    tgt_tuv = tuv_node
+            # FIX: explicit None checks (avoid deprecation)
+            if src_tuv is not None and tgt_tuv is not None:
+                src_seg_node, tgt_seg_node = src_tuv.find('seg'), tgt_tuv.find('seg')
+                if src_seg_node is not None and tgt_seg_node is not None:
+                    try:
+                        src_txt = ET.tostring(src_seg_node, encoding='unicode', method='text').strip()
+                        tgt_txt = ET.tostring(tgt_seg_node, encoding='unicode', method='text').strip()
+                    except Exception:
+                        src_txt = "".join(src_seg_node.itertext()).strip()
+                        tgt_txt = "".join(tgt_seg_node.itertext()).strip()
+                    if src_txt:
+                        tm_data[src_txt] = tgt_txt or ""
+                        loaded_count += 1
+        log_queue.put(f"[TM Load] Loaded {loaded_count} from TMX.")
+    else:
+        with open(tm_fp, 'r', encoding='utf-8') as f:
+            for line in f:
+                parts = line.strip().split('\t', 1)
+                if len(parts) == 2:
+                    tm_data[parts[0]] = parts[1]
+                    loaded_count += 1
+        log_queue.put(f"[TM Load] Loaded {loaded_count} from TXT.")
+    return tm_data
+
 class TMAgent:
     def __init__(self, log_queue):
         self.log_queue = log_queue
         self.tm_data = {}
 
-    def _parse_tmx_lang_xml_code(self, lang_attr_val):
-        if lang_attr_val:
-            return lang_attr_val.split('-')[0].split('_')[0].lower()
-        return ""
-
-    def load_tm(self, tm_fp, src_lang_gui, tgt_lang_gui):
+    def load_tm(self, tm_fp, src_lang_gui, tgt_lang_gui, pool=None):
+        """Load a TMX or tab-separated TXT memory; with a CPU pool the file is parsed in a worker process"""
         self.tm_data = {}
-        loaded_count = 0
         if not tm_fp:
             return
         _, ext = os.path.splitext(tm_fp)
@@ -836,119 +2398,1119 @@ class TMAgent:
         self.log_queue.put(f"[TM Load] GUI Langs for TM: Src='{gui_src}', Tgt='{gui_tgt}'")
         if not gui_src or not gui_tgt:
             self.log_queue.put("[TM Load] Err: GUI langs for TM not set.")
-            messagebox.showerror("TM Error", "Set GUI Source/Target Langs for TM.")
+            show_error_dialog("TM Error", "Set GUI Source/Target Langs for TM.")
+            return
+        if ext.lower() not in (".tmx", ".txt"):
+            self.log_queue.put(f"[TM Load] Err: Unsupported TM ext: {ext}")
+            show_error_dialog("TM Error", f"Unsupported TM type: {ext}.")
             return
         try:
-            if ext.lower() == ".tmx":
-                tree = ET.parse(tm_fp)
-                root = tree.getroot()
-                xml_ns = "http://www.w3.org/XML/1998/namespace"
-                for tu in root.findall('.//tu'):
-                    src_tuv, tgt_tuv = None, None
-                    for tuv_node in tu.findall('tuv'):
-                        lang_attr = tuv_node.get(f'{{{xml_ns}}}lang')
-                        if not lang_attr:
-                            continue
-                        tmx_simple_code = self._parse_tmx_lang_xml_code(lang_attr)
-                        if tmx_simple_code == gui_src:
-                            src_tuv = tuv_node
-                        elif tmx_simple_code == gui_tgt:
-                            tgt_tuv = tuv_node
-                    # FIX: explicit None checks (avoid deprecation)
-                    if src_tuv is not None and tgt_tuv is not None:
-                        src_seg_node, tgt_seg_node = src_tuv.find('seg'), tgt_tuv.find('seg')
-                        if src_seg_node is not None and tgt_seg_node is not None:
-                            try:
-                                src_txt = ET.tostring(src_seg_node, encoding='unicode', method='text').strip()
-                                tgt_txt = ET.tostring(tgt_seg_node, encoding='unicode', method='text').strip()
-                            except Exception:
-                                src_txt = "".join(src_seg_node.itertext()).strip()
-                                tgt_txt = "".join(tgt_seg_node.itertext()).strip()
-                            if src_txt:
-                                self.tm_data[src_txt] = tgt_txt or ""
-                                loaded_count += 1
-                self.log_queue.put(f"[TM Load] Loaded {loaded_count} from TMX.")
-            elif ext.lower() == ".txt":
-                with open(tm_fp, 'r', encoding='utf-8') as f:
-                    for line in f:
-                        parts = line.strip().split('\t', 1)
-                        if len(parts) == 2:
-                            self.tm_data[parts[0]] = parts[1]
-                            loaded_count += 1
-                self.log_queue.put(f"[TM Load] Loaded {loaded_count} from TXT.")
+            if pool is None:
+                self.tm_data = parse_tm_file(tm_fp, gui_src, gui_tgt, self.log_queue)
             else:
-                self.log_queue.put(f"[TM Load] Err: Unsupported TM ext: {ext}")
-                messagebox.showerror("TM Error", f"Unsupported TM type: {ext}.")
+                self.tm_data, messages = run_cpu_tasks(tm_file_task, [(tm_fp, gui_src, gui_tgt)], pool, self.log_queue)[0]
+                for message in messages:
+                    self.log_queue.put(message)
         except Exception as e:
             self.log_queue.put(f"[TM Load] Err: {e}")
-            messagebox.showerror("TM Load Error", f"TM Load Error: {e}")
+            show_error_dialog("TM Load Error", f"TM Load Error: {e}")
 
     def get_translation(self, src_seg):
         return self.tm_data.get(src_seg.strip())
 
+# --- Response Parsing Helpers ---
+NUMBERED_LINE_RE = re.compile(r"^\s*(\d+)\.\s*(.*)$")
+CHANGES_SUMMARY_START = "---CHANGES SUMMARY START---"
+CHANGES_SUMMARY_END = "---CHANGES SUMMARY END---"
+
+def parse_numbered_translations(raw_text, line_nums, log_queue, log_label, truncated=False):
+    """Parse a numbered-list response into {line_num: translation}, with placeholders for missing lines.
+
+    When the response was cut off at max_tokens and ends inside a numbered line, that
+    line may be incomplete, so it is discarded and treated as missing.
+    """
+    wanted = set(line_nums)
+    translations = {}
+    tail_num = None
+    for line in (raw_text or "").splitlines():
+        if not line.strip():
+            continue
+        tail_num = None
+        m = NUMBERED_LINE_RE.match(line.strip())
+        if m:
+            num = int(m.group(1))
+            if num in wanted:
+                translations[num] = m.group(2).strip()
+                tail_num = num
+    if truncated and tail_num is not None:
+        del translations[tail_num]
+    for num in line_nums:
+        if num not in translations:
+            log_queue.put(f"{log_label} Warn: Missing TL line {num}. Placeholder.")
+            translations[num] = f"[TL Missing line {num}]"
+    return translations
+
+# --- Streaming ---
+STREAM_FIRST_TOKEN_TIMEOUT = 300  # seconds to wait for the first streamed text (long prompts, reasoning models)
+STREAM_INACTIVITY_TIMEOUT = 90    # seconds without new text before a stream counts as stalled
+
+class StreamStalledError(TimeoutError):
+    """A streamed completion stopped sending data; handled like any other failed request"""
+
+class RequestCancelledError(Exception):
+    """The caller stopped waiting for this request (e.g. the losing side of a hedged call).
+
+    running: a concurrent.futures.Future of the provider call when it could not be stopped and still
+    runs on its worker thread (it is still billed); None when the request was really ended.
+    """
+    def __init__(self, message, running=None):
+        super().__init__(message)
+        self.running = running
+
+class RequestCancel:
+    """Cancellation signal for the requests made in one context (see _REQUEST_CANCEL).
+
+    A blocking call cannot be interrupted, so the waits around it register a callback that
+    wakes them up and they raise RequestCancelledError. A stream also stops reading at its next
+    delta. The request's concurrency slot and rate reservation are only given back once the
+    provider call has really ended (see BaseLLMAgent._release_abandoned).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.callbacks = []
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback):
+        """Run callback when cancelled (at once if that already happened)"""
+        with self.lock:
+            if not self.cancelled:
+                self.callbacks.append(callback)
+                return
+        callback()
+
+# Set by HedgedAgent in the context each of its calls runs in; None elsewhere
+_REQUEST_CANCEL = contextvars.ContextVar("supervertaler_request_cancel", default=None)
+
+class StreamingLineParser:
+    """Incremental numbered-line parser for streamed completions.
+
+    Calls on_line(num, text) once per requested line as soon as its newline arrives. This only
+    drives live progress; the chunk result still comes from the full-text parsers afterwards.
+    """
+    def __init__(self, line_nums, on_line, stop_marker=None):
+        self.wanted = set(line_nums)
+        self.on_line = on_line
+        self.stop_marker = stop_marker
+        self.buffer = ""
+        self.seen = set()
+        self.stopped = False
+
+    def feed(self, delta):
+        self.buffer += delta
+        while "\n" in self.buffer and not self.stopped:
+            line, self.buffer = self.buffer.split("\n", 1)
+            self._line(line)
+
+    def close(self, truncated=False):
+        # The text after the last newline is only a complete line if the model finished normally
+        if not truncated and not self.stopped and self.buffer.strip():
+            self._line(self.buffer)
+        self.buffer = ""
+
+    def _line(self, line):
+        if self.stop_marker and self.stop_marker in line:
+            self.stopped = True
+            return
+        m = NUMBERED_LINE_RE.match(line.strip())
+        if m:
+            num = int(m.group(1))
+            if num in self.wanted and num not in self.seen:
+                self.seen.add(num)
+                if self.on_line is not None:
+                    self.on_line(num, m.group(2).strip())
+
+def parse_proofreading_response(raw_text, lines_to_proofread_map, line_nums, log_queue, log_label, truncated=False):
+    """Parse revised translations plus the optional CHANGES SUMMARY block into per-line result dicts"""
+    raw_text = raw_text or ""
+    translations_block = raw_text
+    summary_block = ""
+    if CHANGES_SUMMARY_START in raw_text:
+        parts = raw_text.split(CHANGES_SUMMARY_START, 1)
+        translations_block = parts[0].strip()
+        remainder = parts[1]
+        summary_block = remainder.split(CHANGES_SUMMARY_END, 1)[0].strip() if CHANGES_SUMMARY_END in remainder else remainder.strip()
+
+    wanted = set(line_nums)
+    results = {}
+    tail_num = None
+    for line in translations_block.splitlines():
+        if not line.strip():
+            continue
+        tail_num = None
+        m = NUMBERED_LINE_RE.match(line.strip())
+        if m:
+            num = int(m.group(1))
+            if num in wanted:
+                results.setdefault(num, {})["revised_target"] = m.group(2).strip()
+                tail_num = num
+    if truncated and tail_num is not None and not summary_block:
+        del results[tail_num]  # response ended inside this line, so it may be cut mid-sentence
+
+    parsed_summaries = {}
+    if summary_block and "No changes made to any segment in this batch." not in summary_block:
+        for line in summary_block.splitlines():
+            m = NUMBERED_LINE_RE.match(line.strip())
+            if m:
+                parsed_summaries[m.group(1)] = m.group(2).strip()
+
+    for num in line_nums:
+        original_target = lines_to_proofread_map[num]["target_original"]
+        entry = results.setdefault(num, {})
+        if "revised_target" not in entry or not entry["revised_target"].strip():
+            entry["revised_target"] = original_target
+            entry["missing"] = True
+            log_queue.put(f"{log_label} Note: Using original translation for line {num} (missing or empty revised output).")
+        entry["changes_summary"] = parsed_summaries.get(str(num))
+        entry["original_target"] = original_target
+
+    log_queue.put(f"{log_label} Proofreading parse complete. Segments: {len(results)}.")
+    return results
+
+def find_figure_refs(text):
+    return re.findall(r"(?:figure|figuur|fig\.?)\s*([\w\d]+(?:[\s\.\-]*[\w\d]+)?)", text, re.IGNORECASE)
+
+# --- Provider Client Registry ---
+CLIENT_MAX_CONNECTIONS = 64         # per client (provider + API key); the concurrency controller keeps far fewer in flight
+CLIENT_MAX_KEEPALIVE = 32           # idle connections kept open for the next chunk, run or job
+CLIENT_KEEPALIVE_SECONDS = 120.0    # httpx closes idle connections after 5s by default, i.e. between most runs
+CLIENT_CONNECT_TIMEOUT_SECONDS = 10.0
+CLIENT_TIMEOUT_SECONDS = 600.0      # read/write: long completions can take minutes
+CLIENT_POOL_TIMEOUT_SECONDS = 60.0  # waiting for a free connection
+
+class ProviderClientRegistry:
+    """Process-wide SDK clients per (provider, API key), shared by every agent, run and job.
+
+    Anthropic/OpenAI clients get an httpx connection pool with keep-alive, so chunks, back-to-back
+    runs and service jobs reuse warm TLS connections. Async clients are kept per event loop, since
+    an httpx AsyncClient belongs to the loop that opened its connections; asyncio-dispatched runs
+    all use the long-lived DISPATCH_LOOP, so theirs stay warm too. The Gemini SDK has one global
+    configuration, so genai.configure is only called again when the API key changes.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}        # (provider, key digest) -> client
+        self.async_clients = {}  # (id(loop), provider, key digest) -> (weakref to the loop, client)
+        self.genai_key = None
+        self.created = 0
+        self.reused = 0
+
+    def _key(self, provider, api_key):
+        return provider, hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+    def _http_options(self, sdk, use_async):
+        """http_client for an Anthropic/OpenAI client: the SDK's default httpx client (keeps its proxy and
+        redirect settings) with the pool limits and timeouts above; {} for SDKs without one"""
+        factory = getattr(sdk, "DefaultAsyncHttpxClient" if use_async else "DefaultHttpxClient", None)
+        if factory is None:
+            return {}
+        return {"http_client": factory(
+            limits=httpx.Limits(max_connections=CLIENT_MAX_CONNECTIONS, max_keepalive_connections=CLIENT_MAX_KEEPALIVE,
+                                keepalive_expiry=CLIENT_KEEPALIVE_SECONDS),
+            timeout=httpx.Timeout(CLIENT_TIMEOUT_SECONDS, connect=CLIENT_CONNECT_TIMEOUT_SECONDS, pool=CLIENT_POOL_TIMEOUT_SECONDS))}
+
+    def _create(self, provider, api_key, use_async):
+        if provider == "Claude":
+            if use_async:
+                return anthropic.AsyncAnthropic(api_key=api_key, **self._http_options(anthropic, True))
+            if not hasattr(anthropic, "Anthropic"):
+                return anthropic.Client(api_key=api_key)  # very old SDKs
+            return anthropic.Anthropic(api_key=api_key, **self._http_options(anthropic, False))
+        if provider == "OpenAI":
+            if use_async:
+                return openai.AsyncOpenAI(api_key=api_key, **self._http_options(openai, True))
+            return openai.OpenAI(api_key=api_key, **self._http_options(openai, False))
+        raise ValueError(f"No pooled client for provider {provider}")
+
+    def _log(self, log_queue, provider, reused):
+        if log_queue is None:
+            return
+        if reused:
+            log_queue.put(f"[Clients] Reusing the warm {provider} client.")
+        else:
+            log_queue.put(f"[Clients] New {provider} client (up to {CLIENT_MAX_CONNECTIONS} connections, "
+                          f"idle ones kept {CLIENT_KEEPALIVE_SECONDS:.0f}s).")
+
+    def client(self, provider, api_key, log_queue=None):
+        """The shared blocking client for provider ("Claude" or "OpenAI") and API key, created on first use"""
+        key = self._key(provider, api_key)
+        with self.lock:
+            client = self.clients.get(key)
+            reused = client is not None
+            if client is None:
+                client = self.clients[key] = self._create(provider, api_key, use_async=False)
+                self.created += 1
+            else:
+                self.reused += 1
+        self._log(log_queue, provider, reused)
+        return client
+
+    def async_client(self, provider, api_key):
+        """The shared async client for the running event loop.
+
+        A loop's clients should be closed with aclose_loop_clients() before the loop ends; any left
+        behind by a loop that closed without it can only be dropped.
+        """
+        loop = asyncio.get_running_loop()
+        key = (id(loop),) + self._key(provider, api_key)
+        with self.lock:
+            for stale in [k for k, (loop_ref, _) in self.async_clients.items()
+                          if loop_ref() is None or loop_ref().is_closed()]:
+                del self.async_clients[stale]
+            entry = self.async_clients.get(key)
+            if entry is None or entry[0]() is not loop:
+                entry = self.async_clients[key] = (weakref.ref(loop), self._create(provider, api_key, use_async=True))
+                self.created += 1
+            return entry[1]
+
+    async def aclose_loop_clients(self):
+        """Close the async clients of the running loop (their connection pools and sockets)"""
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            keys = [k for k, (loop_ref, _) in self.async_clients.items() if loop_ref() is loop]
+            clients = [self.async_clients.pop(k)[1] for k in keys]
+        for client in clients:
+            try:
+                await client.close()
+            except Exception:
+                pass  # the process is shutting the loop down anyway
+
+    def configure_genai(self, api_key):
+        """genai.configure, skipped when this API key is already the configured one"""
+        digest = self._key("Gemini", api_key)[1]
+        with self.lock:
+            if self.genai_key != digest:
+                genai.configure(api_key=api_key)
+                self.genai_key = digest
+                self.created += 1
+            else:
+                self.reused += 1
+
+PROVIDER_CLIENTS = ProviderClientRegistry()
+
+class DispatchLoop:
+    """One long-lived event loop on a daemon thread for every asyncio-dispatched run and job.
+
+    A fresh asyncio.run() per run would also mean fresh async SDK clients per run (their
+    connection pools belong to the loop), so runs are submitted here instead. close(), called
+    at exit, closes the loop's clients before stopping it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+
+    def _ensure_loop(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, name="LLMDispatchLoop", daemon=True)
+                self.thread.start()
+            return self.loop
+
+    def run(self, coro):
+        """Run coro on the loop in a copy of the caller's context (run metrics, trace, profiler); blocks until done"""
+        loop = self._ensure_loop()
+        if threading.current_thread() is self.thread:
+            raise RuntimeError("DispatchLoop.run() called from the dispatch loop itself; await the coroutine instead")
+        done = concurrent.futures.Future()
+        def finished(task):
+            if task.cancelled():
+                done.cancel()
+            elif task.exception() is not None:
+                done.set_exception(task.exception())
+            else:
+                done.set_result(task.result())
+        def start():
+            loop.create_task(coro).add_done_callback(finished)  # the task copies this callback's (the caller's) context
+        loop.call_soon_threadsafe(start, context=contextvars.copy_context())
+        return done.result()
+
+    def close(self, timeout=10.0):
+        with self.lock:
+            loop, thread, self.loop, self.thread = self.loop, self.thread, None, None
+        if loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(PROVIDER_CLIENTS.aclose_loop_clients(), loop).result(timeout)
+        except Exception:
+            pass
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout)
+        if not loop.is_running():
+            loop.close()
+
+DISPATCH_LOOP = DispatchLoop()
+atexit.register(DISPATCH_LOOP.close)
+
 # --- Base Agent Classes ---
-class BaseTranslationAgent:
-    def __init__(self, api_key, log_queue, model_name, provider):
-        self.log_queue = log_queue
-        self.model = None
-        self.model_name = model_name
-        self.provider = provider
-        self.api_key = api_key
+class BaseLLMAgent:
+    """Request flow shared by all provider agents.
+
+    Provider subclasses implement the payload builders and the client calls
+    (_generate for the blocking SDK, _agenerate for the async SDK); the sync and
+    async entry points both go through the same build -> invoke -> parse steps.
+    """
+    role_label = "Agent"
+    response_cache = None  # ResponseCache set by the pipeline; None bypasses caching
+    streaming = False      # consume provider token streams instead of waiting for the whole completion
+    on_line = None         # on_line(line_num, text) called as streamed lines complete
+    stream_stop_marker = None
 
-class BaseProofreadingAgent:
     def __init__(self, api_key, log_queue, model_name, provider):
         self.log_queue = log_queue
         self.model = None
         self.model_name = model_name
         self.provider = provider
         self.api_key = api_key
-
-# --- Gemini Agents ---
-class GeminiTranslationAgent(BaseTranslationAgent):
-    def __init__(self, api_key, log_queue, model_name='gemini-2.5-pro-preview-05-06'):
-        super().__init__(api_key, log_queue, model_name, "Gemini")
-        self.model_name = model_name.split('/')[-1] if model_name.startswith("models/") else model_name
-        if not GOOGLE_AI_AVAILABLE:
-            self.log_queue.put("[Gemini Translator] ERROR: Google AI library not available.")
-            return
-        if not api_key:
-            self.log_queue.put("[Gemini Translator] ERROR: API Key is missing.")
+        self.log_label = f"[{provider} {self.role_label}]"
+
+    def _apply_output_budget(self, payload, est_output_tokens):
+        """Set the provider's max output tokens field from the chunk estimate"""
+        payload["max_tokens"] = size_max_output_tokens(self.model_name, est_output_tokens)
+
+    def _log_truncation(self, response, line_nums, remaining):
+        self.log_queue.put(f"{self.log_label} Output truncated at max_tokens ({response.get('finish_reason')}); "
+                           f"continuing with {len(remaining)} of {len(line_nums)} line(s) in a new request.")
+
+    def _get_rate_limiter(self):
+        return get_rate_limiter(self.provider, self.model_name, self.api_key)
+
+    def _settle_rate_limit(self, request, input_tokens, response):
+        """Correct the rate-limit reservation made before the call with the usage the provider reported"""
+        usage = response.get("usage") or {}
+        actual_input = sum(usage.get(field) or 0 for field in ("input_tokens", "cache_read_tokens", "cache_write_tokens"))
+        actual_output = usage.get("output_tokens") or 0
+        if actual_input or actual_output:  # nothing reported: keep the estimate
+            self._get_rate_limiter().settle(input_tokens, request["est_output_tokens"], actual_input, actual_output)
+
+    def _log_rate_limit_wait(self, waited):
+        if waited >= 1.0:
+            self.log_queue.put(f"{self.log_label} Rate limit: waited {waited:.1f}s for {self.provider}/{self.model_name} quota.")
+
+    def _get_concurrency_controller(self):
+        return get_concurrency_controller(self.provider, self.model_name, self.api_key)
+
+    def _tracked_changes_text(self, tracked_changes_data, all_source_segments_original_list, line_nums):
+        """Tracked changes relevant to this chunk (goes after the cacheable prompt prefix)"""
+        if not tracked_changes_data:
+            return ""
+        current_src = [all_source_segments_original_list[n-1] for n in line_nums]
+        rel = tracked_changes_data.find_relevant_changes(current_src)
+        if not rel:
+            return ""
+        self.log_queue.put(f"{self.log_label} Added {len(rel)} relevant tracked changes as context")
+        return format_tracked_changes_context(rel)
+
+    def _log_cache_usage(self, response):
+        usage = response.get("usage") or {}
+        read, written = usage.get("cache_read_tokens") or 0, usage.get("cache_write_tokens") or 0
+        if read or written:
+            self.log_queue.put(f"{self.log_label} Prompt cache: {read} tokens read, {written} written "
+                               f"({usage.get('input_tokens') or 0} uncached input tokens).")
+
+    def _cached_response(self, request):
+        if self.response_cache is None:
+            return None
+        request["cache_key"] = response_cache_key(self.provider, self.model_name, request["payload"])
+        try:
+            response = self.response_cache.get(request["cache_key"])
+        except Exception as e:
+            self.log_queue.put(f"{self.log_label} Response cache read failed: {e}")
+            return None
+        if response is not None:
+            response["cached"] = True
+            self.log_queue.put(f"{self.log_label} Response cache hit; request not sent.")
+        return response
+
+    def _store_response(self, request, response):
+        if self.response_cache is None or not response.get("text"):
             return
         try:
-            genai.configure(api_key=api_key)
-            self.model = genai.GenerativeModel(self.model_name)
-            self.log_queue.put(f"[Gemini Translator] Agent with model '{self.model_name}' initialized.")
+            self.response_cache.put(request["cache_key"], self.provider, self.model_name, response)
+        except Exception as e:
+            self.log_queue.put(f"{self.log_label} Response cache write failed: {e}")
+
+    def _record_request(self, request, response, entered, start, error=None):
+        """Report one request to the run metrics set by the dispatcher (if any) and to LLM_METRICS"""
+        end = time.monotonic()
+        context = _REQUEST_CONTEXT.get()
+        queued_at = context.pop("queued_at", None) if context else None  # only the chunk's first request waited for the pool
+        usage = (response or {}).get("usage") or {}
+        cached = bool(response and response.get("cached"))
+        cancelled = isinstance(error, (asyncio.CancelledError, RequestCancelledError))  # e.g. the losing side of a hedged call
+        segments = len(request.get("line_nums") or [])
+        latency = None if cached or cancelled else end - start
+        entry = {"event": "request", "time": datetime.datetime.now().isoformat(timespec="milliseconds"),
+                 "label": context["label"].strip() if context else "", "chunk": context["chunk"] if context else None,
+                 "attempt": context["attempt"] if context else 0, "provider": self.provider, "model": self.model_name,
+                 "status": "ok" if error is None else "cancelled" if cancelled else "throttled" if is_rate_limit_error(error) else "error",
+                 "error": str(error)[:200] if error is not None else None, "cached": cached, "segments": segments,
+                 "queue_wait_s": round(start - (queued_at if queued_at is not None else entered), 4),
+                 "latency_s": round(latency, 4) if latency is not None else None,
+                 "ttft_s": round(request["first_text_s"], 4) if request.get("first_text_s") is not None else None,
+                 "finish_reason": str((response or {}).get("finish_reason")) if response and response.get("finish_reason") is not None else None,
+                 "truncated": bool(response and response.get("truncated")),
+                 "cost_usd": None if cached or error is not None else estimate_request_cost(self.model_name, usage),
+                 "segments_per_s": round(segments / latency, 3) if latency and error is None else None}
+        entry.update({field: 0 if cached else usage.get(field) for field in USAGE_FIELDS})
+        for sink in (context["metrics"] if context else None, LLM_METRICS):
+            if sink is None:
+                continue
+            try:
+                sink.record(entry)
+            except Exception as e:
+                self.log_queue.put(f"{self.log_label} Metrics not recorded: {e}")
+
+    def _invoke(self, request):
+        """Send one prepared request with the blocking client. Returns {"text": ...}."""
+        entered = time.monotonic()
+        with trace_span("cache_lookup", "agent"):
+            cached = self._cached_response(request)
+        if cached is not None:
+            self._record_request(request, cached, entered, time.monotonic())
+            return cached
+        input_tokens = estimate_payload_tokens(request["payload"])
+        with trace_span("rate_limit_wait", "agent"):
+            self._log_rate_limit_wait(self._get_rate_limiter().acquire(input_tokens, request["est_output_tokens"]))
+        controller = self._get_concurrency_controller()
+        with trace_span("concurrency_wait", "agent"):
+            controller.acquire()
+        start, error, response = time.monotonic(), None, None
+        try:
+            with trace_span("llm_request", "network", provider=self.provider, model=self.model_name,
+                            segments=len(request.get("line_nums") or []), est_input_tokens=input_tokens) as span:
+                response = self._call(request)
+                span.set(usage=response.get("usage"), finish_reason=str(response.get("finish_reason")))
+            self._settle_rate_limit(request, input_tokens, response)
+            request["first_text_s"] = response.pop("first_text_s", None)
+            self._log_cache_usage(response)
+            self._store_response(request, response)
+            return response
+        except RequestCancelledError as e:
+            error = e
+            if e.running is None:  # ended before any output: give back the output budget
+                self._get_rate_limiter().settle(input_tokens, request["est_output_tokens"], input_tokens, 0)
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._release(request, input_tokens, controller, start, error)
+            self._record_request(request, response, entered, start, error)
+
+    async def _ainvoke(self, request):
+        """Send one prepared request with the async client. Returns {"text": ...}."""
+        entered = time.monotonic()
+        with trace_span("cache_lookup", "agent"):
+            cached = self._cached_response(request)
+        if cached is not None:
+            self._record_request(request, cached, entered, time.monotonic())
+            return cached
+        input_tokens = estimate_payload_tokens(request["payload"])
+        with trace_span("rate_limit_wait", "agent"):
+            self._log_rate_limit_wait(await self._get_rate_limiter().aacquire(input_tokens, request["est_output_tokens"]))
+        controller = self._get_concurrency_controller()
+        with trace_span("concurrency_wait", "agent"):
+            await controller.aacquire()
+        start, error, response = time.monotonic(), None, None
+        try:
+            with trace_span("llm_request", "network", provider=self.provider, model=self.model_name,
+                            segments=len(request.get("line_nums") or []), est_input_tokens=input_tokens) as span:
+                response = await self._acall(request)
+                span.set(usage=response.get("usage"), finish_reason=str(response.get("finish_reason")))
+            self._settle_rate_limit(request, input_tokens, response)
+            request["first_text_s"] = response.pop("first_text_s", None)
+            self._log_cache_usage(response)
+            self._store_response(request, response)
+            return response
+        except (RequestCancelledError, asyncio.CancelledError) as e:
+            error = e
+            if getattr(e, "running", None) is None:  # the async request is aborted with its task
+                self._get_rate_limiter().settle(input_tokens, request["est_output_tokens"], input_tokens, 0)
+            raise
         except Exception as e:
-            self.log_queue.put(f"[Gemini Translator] ERROR init ('{self.model_name}'): {e}.")
-
-    def translate_specific_lines_with_drawings_context(self,
-                                                       lines_map_to_translate,
-                                                       full_document_context_text_str,
-                                                       source_lang, target_lang,
-                                                       all_source_segments_original_list,
-                                                       drawings_images_map,
-                                                       user_custom_instructions="",
-                                                       tracked_changes_data=None,
-                                                       custom_system_prompt=None):
+            error = e
+            raise
+        finally:
+            self._release(request, input_tokens, controller, start, error)
+            self._record_request(request, response, entered, start, error)
+
+    def _release(self, request, input_tokens, controller, start, error):
+        """Give back the concurrency slot, or leave it to an abandoned call that still runs"""
+        running = getattr(error, "running", None)
+        if running is not None:
+            running.add_done_callback(lambda call: self._release_abandoned(request, input_tokens, controller, start, call))
+        else:
+            controller.release(time.monotonic() - start, request["est_output_tokens"], error, self.log_queue)
+
+    def _release_abandoned(self, request, input_tokens, controller, start, call):
+        """An abandoned provider call has returned: settle its rate reservation and free its slot"""
+        error = call.exception()
+        if error is None:
+            self._settle_rate_limit(request, input_tokens, call.result())
+        controller.release(time.monotonic() - start, request["est_output_tokens"], error, self.log_queue)
+
+    def _call(self, request):
+        cancel = _REQUEST_CANCEL.get()
+        if cancel is not None and cancel.cancelled:
+            raise RequestCancelledError(f"{self.provider} request cancelled before it was sent")
+        if self.streaming and request.get("line_nums"):
+            return self._generate_streaming(request["payload"], request["line_nums"], cancel)
+        if cancel is not None:
+            return self._generate_cancellable(request["payload"], cancel)
+        return self._generate(request["payload"])
+
+    async def _acall(self, request):
+        if self.streaming and request.get("line_nums"):
+            return await self._agenerate_streaming(request["payload"], request["line_nums"])
+        return await self._agenerate(request["payload"])
+
+    def _generate_cancellable(self, payload, cancel):
+        """_generate on a worker thread, abandoned as soon as cancel is set.
+
+        The SDK call itself cannot be stopped: the RequestCancelledError carries its future, so
+        _invoke keeps the slot and rate reservation until it returns.
+        """
+        running, woken = concurrent.futures.Future(), concurrent.futures.Future()
+        context = contextvars.copy_context()
+        def worker():
+            try:
+                response = context.run(self._generate, payload)
+            except Exception as e:
+                running.set_exception(e)
+            else:
+                running.set_result(response)
+        threading.Thread(target=worker, name="LLMRequest", daemon=True).start()
+        cancel.on_cancel(lambda: woken.done() or woken.set_result(None))
+        concurrent.futures.wait((running, woken), return_when=concurrent.futures.FIRST_COMPLETED)
+        if running.done():
+            return running.result()
+        raise RequestCancelledError(f"{self.provider} request cancelled (abandoned while it runs)", running)
+
+    def _generate_streaming(self, payload, line_nums, cancel=None):
+        """Stream one completion, feeding lines to on_line as they complete.
+
+        The SDK stream is read on a separate thread so a stalled connection can be detected
+        here with a plain queue timeout; the abandoned reader thread ends with its connection.
+        cancel: a RequestCancel that ends the wait at once and stops the reader at its next delta
+        (the connection, and the request's slot, are held until then).
+        """
+        parser = StreamingLineParser(line_nums, self.on_line, self.stream_stop_marker)
+        deltas = queue.Queue()
+        outcome = {}
+        running = concurrent.futures.Future()  # the reader's outcome
+
+        def on_delta(text):
+            if cancel is not None and cancel.cancelled:
+                raise RequestCancelledError(f"{self.provider} stream cancelled")  # leaves the SDK stream, closing it
+            deltas.put(text)
+
+        def reader():
+            try:
+                outcome["response"] = self._stream(payload, on_delta)
+            except Exception as e:
+                outcome["error"] = e
+                running.set_exception(e)
+            else:
+                running.set_result(outcome["response"])
+            finally:
+                deltas.put(None)
+
+        threading.Thread(target=reader, name="LLMStreamReader", daemon=True).start()
+        if cancel is not None:
+            cancel.on_cancel(lambda: deltas.put(RequestCancelledError(f"{self.provider} stream cancelled", running)))
+        start = time.monotonic()
+        first_text_at = None
+        while True:
+            timeout = STREAM_FIRST_TOKEN_TIMEOUT if first_text_at is None else STREAM_INACTIVITY_TIMEOUT
+            try:
+                delta = deltas.get(timeout=timeout)
+            except queue.Empty:
+                raise StreamStalledError(f"{self.provider} stream sent no data for {timeout}s")
+            if delta is None:
+                break
+            if isinstance(delta, RequestCancelledError):
+                raise delta
+            if first_text_at is None:
+                first_text_at = time.monotonic() - start
+            parser.feed(delta)
+        if "error" in outcome:
+            raise outcome["error"]
+        return self._finish_stream(parser, outcome["response"], line_nums, start, first_text_at)
+
+    async def _agenerate_streaming(self, payload, line_nums):
+        """_generate_streaming on the event loop: reads the async SDK stream directly, no threads.
+
+        Each read is bounded by the first-token / inactivity timeout; a timeout or task cancellation
+        closes the async generator, and with it the SDK stream and its connection.
+        """
+        parser = StreamingLineParser(line_nums, self.on_line, self.stream_stop_marker)
+        outcome = {}
+        stream = self._astream(payload, outcome)
+        start = time.monotonic()
+        first_text_at = None
+        try:
+            while True:
+                timeout = STREAM_FIRST_TOKEN_TIMEOUT if first_text_at is None else STREAM_INACTIVITY_TIMEOUT
+                try:
+                    delta = await asyncio.wait_for(stream.__anext__(), timeout)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    raise StreamStalledError(f"{self.provider} stream sent no data for {timeout}s")
+                if first_text_at is None:
+                    first_text_at = time.monotonic() - start
+                parser.feed(delta)
+        finally:
+            await stream.aclose()
+        return self._finish_stream(parser, outcome["response"], line_nums, start, first_text_at)
+
+    def _finish_stream(self, parser, response, line_nums, start, first_text_at):
+        parser.close(truncated=response.get("truncated", False))
+        if first_text_at is not None:
+            self.log_queue.put(f"{self.log_label} Stream: first text after {first_text_at:.1f}s, "
+                               f"{len(parser.seen)}/{len(line_nums)} line(s) in {time.monotonic() - start:.1f}s.")
+        response["first_text_s"] = first_text_at  # taken out again by _invoke for the metrics
+        return response
+
+    def _generate(self, payload):
+        raise NotImplementedError
+
+    async def _agenerate(self, payload):
+        raise NotImplementedError
+
+    def _stream(self, payload, on_delta):
+        """Blocking streamed call: pass each text delta to on_delta, return the usual response dict"""
+        raise NotImplementedError
+
+    def _astream(self, payload, outcome):
+        """Async streamed call: an async generator of text deltas that leaves the usual response dict in outcome["response"]"""
+        raise NotImplementedError
+
+    def _build_text_payload(self, prompt):
+        raise NotImplementedError
+
+    def summarize_document(self, source_segments, source_lang, max_words=SUMMARY_MAX_WORDS):
+        """Plain-text summary of the whole document for the 'summary' context strategy.
+
+        Documents larger than half the model's input window are summarised part by part.
+        """
+        limits = get_model_token_limits(self.model_name)
+        part_budget = max(2000, (limits["context"] - limits["output"] - PROMPT_OVERHEAD_TOKENS) // 2)
+        parts, current, used = [], [], 0
+        for i, seg in enumerate(source_segments):
+            seg_tokens = estimate_tokens(seg) + 4
+            if current and used + seg_tokens > part_budget:
+                parts.append(current); current, used = [], 0
+            current.append(f"{i+1}. {seg}"); used += seg_tokens
+        if current: parts.append(current)
+        words = max(100, max_words // max(1, len(parts)))
+        summaries = []
+        for part_no, part in enumerate(parts, 1):
+            which = f" (part {part_no} of {len(parts)})" if len(parts) > 1 else ""
+            prompt = (f"Summarise the following {source_lang} document{which} in at most {words} words, in English, "
+                      "for a translator who will only see small excerpts of it. Cover the subject matter, the key "
+                      "terminology (quote terms in the source language), named entities, and the document's structure. "
+                      "Output only the summary.\n\n" + "\n".join(part))
+            est_output_tokens = int(words * 1.5)
+            payload = self._build_text_payload(prompt)
+            self._apply_output_budget(payload, est_output_tokens)
+            response = self._invoke({"payload": payload, "est_output_tokens": est_output_tokens})
+            summaries.append((response.get("text") or "").strip())
+        return "\n\n".join(s for s in summaries if s)
+
+class BaseTranslationAgent(BaseLLMAgent):
+    role_label = "Translator"
+
+    def _build_translation_payload(self, lines_map_to_translate, line_nums, full_document_context_text_str,
+                                   source_lang, target_lang, all_source_segments_original_list,
+                                   drawings_images_map, user_custom_instructions, tracked_changes_data,
+                                   custom_system_prompt, context_shared=True):
+        raise NotImplementedError
+
+    def _prepare_translation(self, lines_map_to_translate, *context):
         if not self.model:
-            self.log_queue.put(f"[Gemini Translator] Model ('{self.model_name}') not init.")
-            return {n: f"[Err: Model not init]" for n in lines_map_to_translate.keys()}
+            self.log_queue.put(f"{self.log_label} Model ('{self.model_name}') not init.")
+            return {"result": {n: f"[Err: Model not init]" for n in lines_map_to_translate.keys()}}
         if not lines_map_to_translate:
-            self.log_queue.put(f"[Gemini Translator] No lines for chunk.")
-            return {}
+            self.log_queue.put(f"{self.log_label} No lines for chunk.")
+            return {"result": {}}
+        line_nums = sorted(lines_map_to_translate.keys())
+        self.log_queue.put(f"{self.log_label} Translating {len(line_nums)} lines: {line_nums[:3]}... w/ '{self.model_name}' (images + tracked changes)...")
+        with trace_span("build_prompt", "agent", segments=len(line_nums)):
+            payload = self._build_translation_payload(lines_map_to_translate, line_nums, *context)
+        est_output_tokens = estimate_output_tokens([lines_map_to_translate[n] for n in line_nums])
+        self._apply_output_budget(payload, est_output_tokens)
+        return {"line_nums": line_nums, "payload": payload, "est_output_tokens": est_output_tokens}
+
+    def _translation_error(self, line_nums, error):
+        self.log_queue.put(f"{self.log_label} Error: {error}")
+        return {n: f"[TL Err line {n} ({self.provider}): {error}]" for n in line_nums}
+
+    def _finish_translation(self, line_nums, response):
+        raw_text = response.get("text", "")
+        if not raw_text:
+            self.log_queue.put(f"{self.log_label} Warn: Empty response for lines {line_nums}.")
+        with trace_span("parse_response", "agent", segments=len(line_nums)):
+            return parse_numbered_translations(raw_text, line_nums, self.log_queue, self.log_label,
+                                               truncated=response.get("truncated", False))
+
+    def _continuation_lines(self, line_nums, response, results):
+        """Lines to send again after a truncated response (only if the response made progress)"""
+        if not response.get("truncated"):
+            return []
+        remaining = [n for n in line_nums if is_failed_result("Translate", results.get(n))]
+        if 0 < len(remaining) < len(line_nums):
+            self._log_truncation(response, line_nums, remaining)
+            return remaining
+        return []
 
-        line_nums = sorted(list(lines_map_to_translate.keys()))
-        self.log_queue.put(f"[Gemini Translator] Translating {len(line_nums)} lines: {line_nums[:3]}... w/ '{self.model_name}' (drawings + tracked changes if available)...")
+    def prepare_chunk_request(self, lines_map_to_translate, full_document_context_text_str, source_lang, target_lang,
+                              all_source_segments_original_list, drawings_images_map, user_custom_instructions="",
+                              tracked_changes_data=None, custom_system_prompt=None, context_shared=True):
+        """Build, without sending, the request translate_specific_lines_with_drawings_context would send (bulk mode)"""
+        return self._prepare_translation(lines_map_to_translate, full_document_context_text_str, source_lang, target_lang,
+                                         all_source_segments_original_list, drawings_images_map,
+                                         user_custom_instructions, tracked_changes_data, custom_system_prompt, context_shared)
 
-        prompt_parts = []
-        
-        # Use custom system prompt if provided, otherwise use default
-        if custom_system_prompt:
-            try:
-                system_prompt = custom_system_prompt.format(source_lang=source_lang, target_lang=target_lang)
-                prompt_parts.append(system_prompt)
+    def finish_chunk_response(self, request, response):
+        return self._finish_translation(request["line_nums"], response)
+
+    def translate_specific_lines_with_drawings_context(self, lines_map_to_translate, full_document_context_text_str,
+                                                       source_lang, target_lang, all_source_segments_original_list,
+                                                       drawings_images_map, user_custom_instructions="",
+                                                       tracked_changes_data=None, custom_system_prompt=None, context_shared=True):
+        request = self._prepare_translation(lines_map_to_translate, full_document_context_text_str, source_lang, target_lang,
+                                            all_source_segments_original_list, drawings_images_map,
+                                            user_custom_instructions, tracked_changes_data, custom_system_prompt, context_shared)
+        if "result" in request:
+            return request["result"]
+        try:
+            response = self._invoke(request)
+        except Exception as e:
+            return self._translation_error(request["line_nums"], e)
+        results = self._finish_translation(request["line_nums"], response)
+        remaining = self._continuation_lines(request["line_nums"], response, results)
+        if remaining:
+            results.update(self.translate_specific_lines_with_drawings_context(
+                {n: lines_map_to_translate[n] for n in remaining}, full_document_context_text_str, source_lang, target_lang,
+                all_source_segments_original_list, drawings_images_map, user_custom_instructions,
+                tracked_changes_data, custom_system_prompt, context_shared))
+        return results
+
+    async def atranslate_specific_lines_with_drawings_context(self, lines_map_to_translate, full_document_context_text_str,
+                                                              source_lang, target_lang, all_source_segments_original_list,
+                                                              drawings_images_map, user_custom_instructions="",
+                                                              tracked_changes_data=None, custom_system_prompt=None, context_shared=True):
+        """Async variant of translate_specific_lines_with_drawings_context (uses the SDK's async client)"""
+        request = self._prepare_translation(lines_map_to_translate, full_document_context_text_str, source_lang, target_lang,
+                                            all_source_segments_original_list, drawings_images_map,
+                                            user_custom_instructions, tracked_changes_data, custom_system_prompt, context_shared)
+        if "result" in request:
+            return request["result"]
+        try:
+            response = await self._ainvoke(request)
+        except Exception as e:
+            return self._translation_error(request["line_nums"], e)
+        results = self._finish_translation(request["line_nums"], response)
+        remaining = self._continuation_lines(request["line_nums"], response, results)
+        if remaining:
+            results.update(await self.atranslate_specific_lines_with_drawings_context(
+                {n: lines_map_to_translate[n] for n in remaining}, full_document_context_text_str, source_lang, target_lang,
+                all_source_segments_original_list, drawings_images_map, user_custom_instructions,
+                tracked_changes_data, custom_system_prompt, context_shared))
+        return results
+
+class BaseProofreadingAgent(BaseLLMAgent):
+    stream_stop_marker = CHANGES_SUMMARY_START
+    role_label = "Proofreader"
+
+    def _build_proofreading_payload(self, lines_to_proofread_map, line_nums, full_source_doc_str,
+                                    full_original_target_doc_str, source_lang, target_lang,
+                                    all_source_segments_original_list, drawings_images_map,
+                                    user_custom_instructions, tracked_changes_data, custom_system_prompt, context_shared=True):
+        raise NotImplementedError
+
+    def _prepare_proofreading(self, lines_to_proofread_map, *context):
+        if not self.model:
+            self.log_queue.put(f"{self.log_label} Model not initialized.")
+            return {"result": {n: {"revised_target": lines_to_proofread_map[n]["target_original"],
+                                   "changes_summary": "[Proofread Err: Model not init]",
+                                   "original_target": lines_to_proofread_map[n]["target_original"]} for n in lines_to_proofread_map.keys()}}
+        if not lines_to_proofread_map:
+            self.log_queue.put(f"{self.log_label} No lines for proofreading chunk.")
+            return {"result": {}}
+        line_nums = sorted(lines_to_proofread_map.keys())
+        self.log_queue.put(f"{self.log_label} Proofreading {len(line_nums)} lines: {line_nums[:3]}... w/ '{self.model_name}' (images + tracked changes)...")
+        with trace_span("build_prompt", "agent", segments=len(line_nums)):
+            payload = self._build_proofreading_payload(lines_to_proofread_map, line_nums, *context)
+        est_output_tokens = estimate_output_tokens([lines_to_proofread_map[n]["target_original"] for n in line_nums])
+        self._apply_output_budget(payload, est_output_tokens)
+        return {"line_nums": line_nums, "payload": payload, "est_output_tokens": est_output_tokens}
+
+    def _proofreading_error(self, lines_to_proofread_map, line_nums, error):
+        self.log_queue.put(f"{self.log_label} Error during call: {error}")
+        return {n: {"revised_target": lines_to_proofread_map[n]["target_original"],
+                    "changes_summary": f"[Proofread Err line {n}: {error}]",
+                    "original_target": lines_to_proofread_map[n]["target_original"]} for n in line_nums}
+
+    def _finish_proofreading(self, lines_to_proofread_map, line_nums, response):
+        raw_text = response.get("text", "")
+        if not raw_text:
+            self.log_queue.put(f"{self.log_label} Warn: Empty response for lines {line_nums}.")
+        with trace_span("parse_response", "agent", segments=len(line_nums)):
+            return parse_proofreading_response(raw_text, lines_to_proofread_map, line_nums, self.log_queue, self.log_label,
+                                               truncated=response.get("truncated", False))
+
+    def _continuation_lines(self, line_nums, response, results):
+        """Lines to send again after a truncated response (only if the response made progress)"""
+        if not response.get("truncated"):
+            return []
+        remaining = [n for n in line_nums if is_failed_result("Proofread", results.get(n))]
+        if 0 < len(remaining) < len(line_nums):
+            self._log_truncation(response, line_nums, remaining)
+            return remaining
+        return []
+
+    def prepare_chunk_request(self, lines_to_proofread_map, full_source_doc_str, full_original_target_doc_str,
+                              source_lang, target_lang, all_source_segments_original_list, drawings_images_map,
+                              user_custom_instructions="", tracked_changes_data=None, custom_system_prompt=None, context_shared=True):
+        """Build, without sending, the request proofread_specific_lines_with_context would send (bulk mode)"""
+        request = self._prepare_proofreading(lines_to_proofread_map, full_source_doc_str, full_original_target_doc_str,
+                                             source_lang, target_lang, all_source_segments_original_list,
+                                             drawings_images_map, user_custom_instructions, tracked_changes_data,
+                                             custom_system_prompt, context_shared)
+        request["lines_map"] = lines_to_proofread_map
+        return request
+
+    def finish_chunk_response(self, request, response):
+        return self._finish_proofreading(request["lines_map"], request["line_nums"], response)
+
+    def proofread_specific_lines_with_context(self, lines_to_proofread_map, full_source_doc_str,
+                                             full_original_target_doc_str, source_lang, target_lang,
+                                             all_source_segments_original_list, drawings_images_map,
+                                             user_custom_instructions="", tracked_changes_data=None,
+                                             custom_system_prompt=None, context_shared=True):
+        request = self._prepare_proofreading(lines_to_proofread_map, full_source_doc_str, full_original_target_doc_str,
+                                             source_lang, target_lang, all_source_segments_original_list,
+                                             drawings_images_map, user_custom_instructions, tracked_changes_data,
+                                             custom_system_prompt, context_shared)
+        if "result" in request:
+            return request["result"]
+        try:
+            response = self._invoke(request)
+        except Exception as e:
+            return self._proofreading_error(lines_to_proofread_map, request["line_nums"], e)
+        results = self._finish_proofreading(lines_to_proofread_map, request["line_nums"], response)
+        remaining = self._continuation_lines(request["line_nums"], response, results)
+        if remaining:
+            results.update(self.proofread_specific_lines_with_context(
+                {n: lines_to_proofread_map[n] for n in remaining}, full_source_doc_str, full_original_target_doc_str,
+                source_lang, target_lang, all_source_segments_original_list, drawings_images_map,
+                user_custom_instructions, tracked_changes_data, custom_system_prompt, context_shared))
+        return results
+
+    async def aproofread_specific_lines_with_context(self, lines_to_proofread_map, full_source_doc_str,
+                                                    full_original_target_doc_str, source_lang, target_lang,
+                                                    all_source_segments_original_list, drawings_images_map,
+                                                    user_custom_instructions="", tracked_changes_data=None,
+                                                    custom_system_prompt=None, context_shared=True):
+        """Async variant of proofread_specific_lines_with_context (uses the SDK's async client)"""
+        request = self._prepare_proofreading(lines_to_proofread_map, full_source_doc_str, full_original_target_doc_str,
+                                             source_lang, target_lang, all_source_segments_original_list,
+                                             drawings_images_map, user_custom_instructions, tracked_changes_data,
+                                             custom_system_prompt, context_shared)
+        if "result" in request:
+            return request["result"]
+        try:
+            response = await self._ainvoke(request)
+        except Exception as e:
+            return self._proofreading_error(lines_to_proofread_map, request["line_nums"], e)
+        results = self._finish_proofreading(lines_to_proofread_map, request["line_nums"], response)
+        remaining = self._continuation_lines(request["line_nums"], response, results)
+        if remaining:
+            results.update(await self.aproofread_specific_lines_with_context(
+                {n: lines_to_proofread_map[n] for n in remaining}, full_source_doc_str, full_original_target_doc_str,
+                source_lang, target_lang, all_source_segments_original_list, drawings_images_map,
+                user_custom_instructions, tracked_changes_data, custom_system_prompt, context_shared))
+        return results
+
+# --- Gemini Agents ---
+class GeminiAgentMixin:
+    """Gemini model setup and blocking/async generate calls shared by both Gemini agents.
+
+    Payloads may carry "cached_prefix": the number of leading contents parts that are identical
+    across chunks. Large prefixes are uploaded once as CachedContent and reused until the TTL runs out.
+    """
+    def _init_model(self, api_key):
+        self.cached_models = {}
+        self.cache_lock = threading.Lock()
+        self.cache_disabled = False
+        self.model_name = self.model_name.split('/')[-1] if self.model_name.startswith("models/") else self.model_name
+        if not GOOGLE_AI_AVAILABLE:
+            self.log_queue.put(f"{self.log_label} ERROR: Google AI library not available.")
+            return
+        if not api_key:
+            self.log_queue.put(f"{self.log_label} ERROR: API Key is missing.")
+            return
+        try:
+            PROVIDER_CLIENTS.configure_genai(api_key)
+            self.model = genai.GenerativeModel(self.model_name)
+            self.log_queue.put(f"{self.log_label} Agent with model '{self.model_name}' initialized.")
+        except Exception as e:
+            self.log_queue.put(f"{self.log_label} ERROR init ('{self.model_name}'): {e}.")
+
+    def _apply_output_budget(self, payload, est_output_tokens):
+        payload["generation_config"] = {"max_output_tokens": size_max_output_tokens(self.model_name, est_output_tokens)}
+
+    def _response_dict(self, response):
+        finish_reason = None
+        try:
+            candidate = response.candidates[0]
+            finish_reason = getattr(candidate.finish_reason, "name", candidate.finish_reason)
+        except Exception:
+            pass
+        try:
+            text = getattr(response, "text", "") or ""
+        except ValueError:
+            # .text raises when the candidate has no parts (e.g. stopped at MAX_TOKENS before any text)
+            text = ""
+        usage_meta = getattr(response, "usage_metadata", None)
+        cached = getattr(usage_meta, "cached_content_token_count", 0) or 0
+        usage = {"input_tokens": max(0, (getattr(usage_meta, "prompt_token_count", 0) or 0) - cached),
+                 "output_tokens": getattr(usage_meta, "candidates_token_count", 0) or 0,
+                 "cache_read_tokens": cached, "cache_write_tokens": 0}
+        return {"text": text, "finish_reason": finish_reason, "truncated": finish_reason in ("MAX_TOKENS", 2), "usage": usage}
+
+    def _cached_model(self, prefix_parts):
+        """GenerativeModel bound to a CachedContent holding prefix_parts, or None to send the full prompt.
+
+        The upload runs outside cache_lock: only requests for the same prefix wait for it (or, while
+        an entry is being refreshed, keep using the previous one).
+        """
+        if self.cache_disabled or not hasattr(genai, "caching"):
+            return None, 0
+        if sum(estimate_tokens(p) for p in prefix_parts if isinstance(p, str)) < GEMINI_CACHE_MIN_TOKENS:
+            return None, 0
+        key = hashlib.sha256("\x00".join(str(p) for p in prefix_parts).encode("utf-8")).hexdigest()
+        with self.cache_lock:
+            now = time.monotonic()
+            for stale in [k for k, e in self.cached_models.items() if e["ready"].is_set() and now - e["created"] > GEMINI_CACHE_TTL_SECONDS]:
+                del self.cached_models[stale]
+            entry = self.cached_models.get(key)
+            # Recreate a little before expiry rather than racing the TTL mid-request
+            owner = entry is None or (entry["ready"].is_set() and now - entry["created"] > GEMINI_CACHE_TTL_SECONDS * 0.8)
+            if owner:
+                previous = entry["model"] if entry is not None else None
+                entry = self.cached_models[key] = {"model": previous, "created": now, "ready": threading.Event()}
+        if not owner:
+            if entry["model"] is None:
+                entry["ready"].wait()
+            return entry["model"], 0
+        try:
+            cache = genai.caching.CachedContent.create(model=f"models/{self.model_name}", contents=prefix_parts,
+                                                       ttl=datetime.timedelta(seconds=GEMINI_CACHE_TTL_SECONDS))
+        except Exception as e:
+            self.cache_disabled = True
+            self.log_queue.put(f"{self.log_label} Context caching unavailable ({e}); sending full prompts.")
+            with self.cache_lock:
+                self.cached_models.pop(key, None)
+            entry["model"] = None
+            entry["ready"].set()
+            return None, 0
+        entry["model"] = genai.GenerativeModel.from_cached_content(cached_content=cache)
+        entry["created"] = time.monotonic()
+        entry["ready"].set()
+        return entry["model"], getattr(getattr(cache, "usage_metadata", None), "total_token_count", 0) or 0
+
+    def _split_cached_payload(self, payload):
+        payload = dict(payload)
+        prefix_len = payload.pop("cached_prefix", 0)
+        model, written = self._cached_model(payload["contents"][:prefix_len]) if prefix_len else (None, 0)
+        if model is None:
+            return self.model, payload, 0
+        payload["contents"] = payload["contents"][prefix_len:]
+        return model, payload, written
+
+    def _generate(self, payload):
+        model, payload, written = self._split_cached_payload(payload)
+        response = self._response_dict(model.generate_content(**payload))
+        response["usage"]["cache_write_tokens"] = written
+        return response
+
+    async def _agenerate(self, payload):
+        # Cache creation is a blocking call; keep it off the event loop
+        model, payload, written = await asyncio.to_thread(self._split_cached_payload, payload)
+        response = self._response_dict(await model.generate_content_async(**payload))
+        response["usage"]["cache_write_tokens"] = written
+        return response
+
+    def _stream(self, payload, on_delta):
+        model, payload, written = self._split_cached_payload(payload)
+        response = model.generate_content(**payload, stream=True)
+        for chunk in response:
+            try:
+                text = chunk.text
+            except ValueError:
+                text = ""
+            if text:
+                on_delta(text)
+        # Once iterated, the streamed response aggregates text, finish reason and usage
+        result = self._response_dict(response)
+        result["usage"]["cache_write_tokens"] = written
+        return result
+
+    async def _astream(self, payload, outcome):
+        model, payload, written = await asyncio.to_thread(self._split_cached_payload, payload)
+        response = await model.generate_content_async(**payload, stream=True)
+        async for chunk in response:
+            try:
+                text = chunk.text
+            except ValueError:
+                text = ""
+            if text:
+                yield text
+        outcome["response"] = self._response_dict(response)
+        outcome["response"]["usage"]["cache_write_tokens"] = written
+
+    def _build_text_payload(self, prompt):
+        return {"contents": [prompt]}
+
+class GeminiTranslationAgent(GeminiAgentMixin, BaseTranslationAgent):
+    def __init__(self, api_key, log_queue, model_name='gemini-2.5-pro-preview-05-06'):
+        super().__init__(api_key, log_queue, model_name, "Gemini")
+        self._init_model(api_key)
+
+    def _build_translation_payload(self, lines_map_to_translate, line_nums, full_document_context_text_str,
+                                   source_lang, target_lang, all_source_segments_original_list,
+                                   drawings_images_map, user_custom_instructions, tracked_changes_data,
+                                   custom_system_prompt, context_shared=True):
+        prompt_parts = []
+        
+        # Use custom system prompt if provided, otherwise use default
+        if custom_system_prompt:
+            try:
+                system_prompt = custom_system_prompt.format(source_lang=source_lang, target_lang=target_lang)
+                prompt_parts.append(system_prompt)
             except KeyError as e:
-                self.log_queue.put(f"[Gemini Translator] Error in custom prompt template: {e}. Using default.")
+                self.log_queue.put(f"{self.log_label} Error in custom prompt template: {e}. Using default.")
                 prompt_parts.append(f"You are an expert {source_lang} to {target_lang} translator specialized in patent documents.")
         else:
             prompt_parts.append(f"You are an expert {source_lang} to {target_lang} translator specialized in patent documents.")
@@ -956,13 +3518,6 @@ class GeminiTranslationAgent(BaseTranslationAgent):
         if user_custom_instructions:
             prompt_parts.append(f"\nIMPORTANT USER-PROVIDED INSTRUCTIONS:\n{user_custom_instructions}\n")
 
-        if tracked_changes_data:
-            current_src = [all_source_segments_original_list[n-1] for n in line_nums]
-            rel = tracked_changes_data.find_relevant_changes(current_src)
-            if rel:
-                prompt_parts.append(format_tracked_changes_context(rel))
-                self.log_queue.put(f"[Gemini Translator] Added {len(rel)} relevant tracked changes as context")
-
         # Add context and instructions if not using custom prompt (to avoid duplication)
         if not custom_system_prompt:
             prompt_parts.extend([
@@ -971,16 +3526,21 @@ class GeminiTranslationAgent(BaseTranslationAgent):
                 "Present your output ONLY as a numbered list of the translations for the requested sentences, using their original numbering. Maintain accuracy and appropriate patent terminology.\n"
             ])
         
-        prompt_parts.extend([
-            f"FULL PATENT CONTEXT:\n{full_document_context_text_str}\n",
-            "PATENT SENTENCES TO TRANSLATE (translate only these, using preceding images if provided for a figure reference):\n"
-        ])
+        cached_prefix = len(prompt_parts)
+        prompt_parts.append(f"FULL PATENT CONTEXT:\n{full_document_context_text_str}\n")
+        if context_shared:  # the same document context goes with every chunk
+            cached_prefix = len(prompt_parts)
+
+        tracked_text = self._tracked_changes_text(tracked_changes_data, all_source_segments_original_list, line_nums)
+        if tracked_text:
+            prompt_parts.append(tracked_text)
+        prompt_parts.append("PATENT SENTENCES TO TRANSLATE (translate only these, using preceding images if provided for a figure reference):\n")
 
         images_added = set()
         for ln in line_nums:
             src_text_scan = all_source_segments_original_list[ln - 1]
             numbered_src_line = lines_map_to_translate[ln]
-            fig_refs = re.findall(r"(?:figure|figuur|fig\.?)\s*([\w\d]+(?:[\s\.\-]*[\w\d]+)?)", src_text_scan, re.IGNORECASE)
+            fig_refs = find_figure_refs(src_text_scan)
             img_added = False
             if PIL_AVAILABLE and fig_refs and drawings_images_map:
                 for ref in fig_refs:
@@ -996,64 +3556,17 @@ class GeminiTranslationAgent(BaseTranslationAgent):
                 prompt_parts.append("\n")
 
         prompt_parts.append("\nTRANSLATED SENTENCES (numbered list for 'PATENT SENTENCES TO TRANSLATE' only):")
+        return {"contents": prompt_parts, "cached_prefix": cached_prefix}
 
-        try:
-            response = self.model.generate_content(prompt_parts)
-            raw_text = getattr(response, "text", "") or ""
-            if not raw_text:
-                self.log_queue.put(f"[Gemini Translator] Warn: Empty response for lines {line_nums}. Response: {response}")
-        except Exception as e:
-            self.log_queue.put(f"[Gemini Translator] Error enhanced TL ('{self.model_name}'): {e}")
-            return {n: f"[TL Err line {n} (enhanced): {e}]" for n in lines_map_to_translate.keys()}
-
-        translations = {}
-        for line in (raw_text or "").splitlines():
-            m = re.match(r"^\s*(\d+)\.\s*(.*)", line.strip())
-            if m:
-                num = int(m.group(1))
-                txt = m.group(2).strip()
-                if num in line_nums:
-                    translations[num] = txt
-        for num in line_nums:
-            if num not in translations:
-                self.log_queue.put(f"[Gemini Translator] Warn: Missing TL line {num}. Placeholder.")
-                translations[num] = f"[TL Missing line {num}]"
-        return translations
-
-class GeminiProofreadingAgent(BaseProofreadingAgent):
+class GeminiProofreadingAgent(GeminiAgentMixin, BaseProofreadingAgent):
     def __init__(self, api_key, log_queue, model_name='gemini-2.5-pro-preview-05-06'):
         super().__init__(api_key, log_queue, model_name, "Gemini")
-        self.model_name = model_name.split('/')[-1] if model_name.startswith("models/") else model_name
-        if not GOOGLE_AI_AVAILABLE:
-            self.log_queue.put("[Gemini Proofreader] ERROR: Google AI library not available.")
-            return
-        if not api_key:
-            self.log_queue.put("[Gemini Proofreader] ERROR: API Key is missing.")
-            return
-        try:
-            genai.configure(api_key=api_key)
-            self.model = genai.GenerativeModel(self.model_name)
-            self.log_queue.put(f"[Gemini Proofreader] Agent initialized with model '{self.model_name}'.")
-        except Exception as e:
-            self.log_queue.put(f"[Gemini Proofreader] ERROR initializing ('{self.model_name}'): {e}.")
-
-    def proofread_specific_lines_with_context(self, lines_to_proofread_map, full_source_doc_str,
-                                             full_original_target_doc_str, source_lang, target_lang,
-                                             all_source_segments_original_list, drawings_images_map,
-                                             user_custom_instructions="", tracked_changes_data=None,
-                                             custom_system_prompt=None):
-        if not self.model:
-            self.log_queue.put(f"[Gemini Proofreader] Model not initialized.")
-            return {n: {"revised_target": lines_to_proofread_map[n]["target_original"],
-                        "changes_summary": "[Proofread Err: Model not init]",
-                        "original_target": lines_to_proofread_map[n]["target_original"]} for n in lines_to_proofread_map.keys()}
-        if not lines_to_proofread_map:
-            self.log_queue.put(f"[Gemini Proofreader] No lines for proofreading chunk.")
-            return {}
-
-        line_nums = sorted(lines_to_proofread_map.keys())
-        self.log_queue.put(f"[Gemini Proofreader] Proofreading {len(line_nums)} lines: {line_nums[:3]}... w/ '{self.model_name}' (images + tracked changes)...")
+        self._init_model(api_key)
 
+    def _build_proofreading_payload(self, lines_to_proofread_map, line_nums, full_source_doc_str,
+                                    full_original_target_doc_str, source_lang, target_lang,
+                                    all_source_segments_original_list, drawings_images_map,
+                                    user_custom_instructions, tracked_changes_data, custom_system_prompt, context_shared=True):
         prompt_parts = []
         
         # Use custom system prompt if provided, otherwise use default
@@ -1062,7 +3575,7 @@ class GeminiProofreadingAgent(BaseProofreadingAgent):
                 system_prompt = custom_system_prompt.format(source_lang=source_lang, target_lang=target_lang)
                 prompt_parts.append(system_prompt)
             except KeyError as e:
-                self.log_queue.put(f"[Gemini Proofreader] Error in custom prompt template: {e}. Using default.")
+                self.log_queue.put(f"{self.log_label} Error in custom prompt template: {e}. Using default.")
                 prompt_parts.append(f"You are an expert proofreader and editor for {source_lang} → {target_lang} translations, specializing in patent documents.")
         else:
             prompt_parts.append(f"You are an expert proofreader and editor for {source_lang} → {target_lang} translations, specializing in patent documents.")
@@ -1070,13 +3583,6 @@ class GeminiProofreadingAgent(BaseProofreadingAgent):
         if user_custom_instructions:
             prompt_parts.append(f"\nIMPORTANT USER-PROVIDED INSTRUCTIONS:\n{user_custom_instructions}\n")
 
-        if tracked_changes_data:
-            current_src = [all_source_segments_original_list[n-1] for n in line_nums]
-            rel = tracked_changes_data.find_relevant_changes(current_src)
-            if rel:
-                prompt_parts.append(format_tracked_changes_context(rel))
-                self.log_queue.put(f"[Gemini Proofreader] Added {len(rel)} relevant tracked changes as context")
-
         # Add context and instructions if not using custom prompt (to avoid duplication)
         if not custom_system_prompt:
             prompt_parts.extend([
@@ -1088,17 +3594,24 @@ class GeminiProofreadingAgent(BaseProofreadingAgent):
                 "---CHANGES SUMMARY END---"
             ])
         
+        cached_prefix = len(prompt_parts)
         prompt_parts.extend([
             f"\nFULL SOURCE DOCUMENT CONTEXT (reference only):\n{full_source_doc_str}\n",
-            f"FULL ORIGINAL TARGET DOCUMENT CONTEXT (for consistency):\n{full_original_target_doc_str}\n",
-            "SEGMENTS FOR PROOFREADING:\n"
+            f"FULL ORIGINAL TARGET DOCUMENT CONTEXT (for consistency):\n{full_original_target_doc_str}\n"
         ])
+        if context_shared:  # the same document context goes with every chunk
+            cached_prefix = len(prompt_parts)
+
+        tracked_text = self._tracked_changes_text(tracked_changes_data, all_source_segments_original_list, line_nums)
+        if tracked_text:
+            prompt_parts.append(tracked_text)
+        prompt_parts.append("SEGMENTS FOR PROOFREADING:\n")
 
         images_added = set()
         for ln in line_nums:
             src_text = lines_to_proofread_map[ln]["source"]
             orig_target = lines_to_proofread_map[ln]["target_original"]
-            fig_refs = re.findall(r"(?:figure|figuur|fig\.?)\s*([\w\d]+(?:[\s\.\-]*[\w\d]+)?)", src_text, re.IGNORECASE)
+            fig_refs = find_figure_refs(src_text)
             if PIL_AVAILABLE and fig_refs and drawings_images_map:
                 for ref in fig_refs:
                     norm = normalize_figure_ref(f"fig {ref}")
@@ -1111,85 +3624,78 @@ class GeminiProofreadingAgent(BaseProofreadingAgent):
             prompt_parts.append(f"{ln}. EXISTING TRANSLATION: {orig_target}\n")
 
         prompt_parts.append("\nREVISED TRANSLATIONS (numbered list only):")
-
-        try:
-            msg = {"role": "user", "content": prompt_parts}
-            response = self.model.generate_content(msg)
-            raw_text = getattr(response, "text", "") or ""
-            if not raw_text:
-                self.log_queue.put(f"[Gemini Proofreader] Warn: Empty response for lines {line_nums}. Response: {response}")
-        except Exception as e:
-            self.log_queue.put(f"[Gemini Proofreader] Error during call: {e}")
-            return {n: {"revised_target": lines_to_proofread_map[n]["target_original"],
-                        "changes_summary": f"[Proofread Err line {n}: {e}]",
-                        "original_target": lines_to_proofread_map[n]["target_original"]} for n in line_nums}
-
-        translations_block = raw_text
-        summary_block = ""
-        summary_start = "---CHANGES SUMMARY START---"
-        summary_end = "---CHANGES SUMMARY END---"
-        if summary_start in raw_text:
-            parts = raw_text.split(summary_start, 1)
-            translations_block = parts[0].strip()
-            remainder = parts[1]
-            summary_block = remainder.split(summary_end, 1)[0].strip() if summary_end in remainder else remainder.strip()
-
-        results = {}
-        for line in translations_block.splitlines():
-            m = re.match(r"^\s*(\d+)\.\s*(.*)$", line.strip())
-            if m:
-                num = int(m.group(1))
-                txt = m.group(2).strip()
-                if num in line_nums:
-                    results.setdefault(num, {})["revised_target"] = txt
-
-        parsed_summaries = {}
-        if summary_block and "No changes made to any segment in this batch." not in summary_block:
-            for line in summary_block.splitlines():
-                m = re.match(r"^\s*(\d+)\.\s*(.*)$", line.strip())
-                if m:
-                    parsed_summaries[m.group(1)] = m.group(2).strip()
-
-        for num in line_nums:
-            original_target = lines_to_proofread_map[num]["target_original"]
-            entry = results.setdefault(num, {})
-            if "revised_target" not in entry or not entry["revised_target"].strip():
-                entry["revised_target"] = original_target
-                self.log_queue.put(f"[Gemini Proofreader] Note: Using original translation for line {num} (missing or empty revised output).")
-            entry["changes_summary"] = parsed_summaries.get(str(num))
-            entry["original_target"] = original_target
-
-        self.log_queue.put(f"[Gemini Proofreader] Proofreading parse complete. Segments: {len(results)}.")
-        return results
+        return {"contents": prompt_parts, "cached_prefix": cached_prefix}
 
 # --- Claude Agents ---
-class ClaudeTranslationAgent(BaseTranslationAgent):
-    def __init__(self, api_key, log_queue, model_name='claude-3-5-sonnet-20241022'):
-        super().__init__(api_key, log_queue, model_name, "Claude")
+def claude_response_text(response):
+    """Join the text blocks of an Anthropic Messages response"""
+    try:
+        if hasattr(response, "content"):
+            return "".join(block.text for block in response.content if getattr(block, "type", None) == "text")
+    except Exception:
+        pass
+    return getattr(response, "text", "") or str(response)
+
+class ClaudeAgentMixin:
+    """Anthropic client (borrowed from PROVIDER_CLIENTS) and blocking/async message calls shared by both Claude agents."""
+    def _init_client(self, api_key):
         if not CLAUDE_AVAILABLE:
-            self.log_queue.put("[Claude Translator] ERROR: anthropic library not available.")
+            self.log_queue.put(f"{self.log_label} ERROR: anthropic library not available.")
             return
         if not api_key:
-            self.log_queue.put("[Claude Translator] ERROR: API Key is missing.")
+            self.log_queue.put(f"{self.log_label} ERROR: API Key is missing.")
             return
         try:
-            self.client = anthropic.Anthropic(api_key=api_key) if hasattr(anthropic, "Anthropic") else anthropic.Client(api_key=api_key)
+            self.client = PROVIDER_CLIENTS.client("Claude", api_key, self.log_queue)
             self.model = self.model_name
-            self.log_queue.put(f"[Claude Translator] Agent with model '{self.model_name}' initialized.")
+            self.log_queue.put(f"{self.log_label} Agent with model '{self.model_name}' initialized.")
         except Exception as e:
-            self.log_queue.put(f"[Claude Translator] ERROR init ('{self.model_name}'): {e}.")
-
-    def translate_specific_lines_with_drawings_context(self, lines_map_to_translate, full_document_context_text_str,
-                                                       source_lang, target_lang, all_source_segments_original_list,
-                                                       drawings_images_map, user_custom_instructions="",
-                                                       tracked_changes_data=None, custom_system_prompt=None):
-        if not self.model:
-            return {n: f"[Err: Model not init]" for n in lines_map_to_translate.keys()}
-        if not lines_map_to_translate:
-            return {}
-        line_nums = sorted(list(lines_map_to_translate.keys()))
-        self.log_queue.put(f"[Claude Translator] Translating {len(line_nums)} lines: {line_nums[:3]}... w/ '{self.model_name}' (images + tracked changes)...")
+            self.log_queue.put(f"{self.log_label} ERROR init ('{self.model_name}'): {e}.")
+
+    def _get_async_client(self):
+        # Per event loop: the async client binds its connection pool to the running loop
+        return PROVIDER_CLIENTS.async_client("Claude", self.api_key)
+
+    def _response_dict(self, response):
+        stop_reason = getattr(response, "stop_reason", None)
+        usage_obj = getattr(response, "usage", None)
+        usage = {"input_tokens": getattr(usage_obj, "input_tokens", 0) or 0,
+                 "output_tokens": getattr(usage_obj, "output_tokens", 0) or 0,
+                 "cache_read_tokens": getattr(usage_obj, "cache_read_input_tokens", 0) or 0,
+                 "cache_write_tokens": getattr(usage_obj, "cache_creation_input_tokens", 0) or 0}
+        return {"text": claude_response_text(response), "finish_reason": stop_reason, "truncated": stop_reason == "max_tokens",
+                "usage": usage}
+
+    def _generate(self, payload):
+        return self._response_dict(self.client.messages.create(model=self.model_name, **payload))
+
+    async def _agenerate(self, payload):
+        return self._response_dict(await self._get_async_client().messages.create(model=self.model_name, **payload))
+
+    def _stream(self, payload, on_delta):
+        with self.client.messages.stream(model=self.model_name, **payload) as stream:
+            for text in stream.text_stream:
+                on_delta(text)
+            return self._response_dict(stream.get_final_message())
+
+    async def _astream(self, payload, outcome):
+        async with self._get_async_client().messages.stream(model=self.model_name, **payload) as stream:
+            async for text in stream.text_stream:
+                yield text
+            outcome["response"] = self._response_dict(await stream.get_final_message())
+
+    def _build_text_payload(self, prompt):
+        return {"messages": [{"role": "user", "content": prompt}]}
+
+class ClaudeTranslationAgent(ClaudeAgentMixin, BaseTranslationAgent):
+    def __init__(self, api_key, log_queue, model_name='claude-3-5-sonnet-20241022'):
+        super().__init__(api_key, log_queue, model_name, "Claude")
+        self._init_client(api_key)
 
+    def _build_translation_payload(self, lines_map_to_translate, line_nums, full_document_context_text_str,
+                                   source_lang, target_lang, all_source_segments_original_list,
+                                   drawings_images_map, user_custom_instructions, tracked_changes_data,
+                                   custom_system_prompt, context_shared=True):
         content_parts = []
         def add_text(t):
             if t:
@@ -1201,7 +3707,7 @@ class ClaudeTranslationAgent(BaseTranslationAgent):
                 system_prompt = custom_system_prompt.format(source_lang=source_lang, target_lang=target_lang)
                 add_text(system_prompt)
             except KeyError as e:
-                self.log_queue.put(f"[Claude Translator] Error in custom prompt template: {e}. Using default.")
+                self.log_queue.put(f"{self.log_label} Error in custom prompt template: {e}. Using default.")
                 add_text(f"You are an expert {source_lang} to {target_lang} translator specialized in patent documents.")
         else:
             add_text(f"You are an expert {source_lang} to {target_lang} translator specialized in patent documents.")
@@ -1209,24 +3715,23 @@ class ClaudeTranslationAgent(BaseTranslationAgent):
         if user_custom_instructions:
             add_text(f"\nIMPORTANT USER-PROVIDED INSTRUCTIONS:\n{user_custom_instructions}\n")
 
-        if tracked_changes_data:
-            current_src = [all_source_segments_original_list[n-1] for n in line_nums]
-            rel = tracked_changes_data.find_relevant_changes(current_src)
-            if rel:
-                add_text(format_tracked_changes_context(rel))
-                self.log_queue.put(f"[Claude Translator] Added {len(rel)} relevant tracked changes as context")
-
         add_text("The full patent text for overall context is in 'FULL PATENT CONTEXT' below. Translate ONLY sentences from 'PATENT SENTENCES TO TRANSLATE' later. These are listed with their original line numbers from the full document.")
         add_text("If a sentence refers to a Figure (e.g., 'Figure 1A', 'Figuur X'), relevant images may be provided just before that sentence. Use these images as crucial context.")
         add_text("Present your output ONLY as a numbered list of the translations for the requested sentences, using their original numbering.\n")
+        if not context_shared:  # the document context differs per chunk: cache the instructions only
+            content_parts[-1]["cache_control"] = ANTHROPIC_CACHE_CONTROL
         add_text(f"FULL PATENT CONTEXT:\n{full_document_context_text_str}\n")
+        if context_shared:
+            content_parts[-1]["cache_control"] = ANTHROPIC_CACHE_CONTROL  # everything up to here is identical across chunks
+
+        add_text(self._tracked_changes_text(tracked_changes_data, all_source_segments_original_list, line_nums))
         add_text("PATENT SENTENCES TO TRANSLATE (translate only these, using preceding images if provided for a figure reference):\n")
 
         images_added = set()
         for ln in line_nums:
             src_text_scan = all_source_segments_original_list[ln - 1]
             numbered_src_line = lines_map_to_translate[ln]
-            fig_refs = re.findall(r"(?:figure|figuur|fig\.?)\s*([\w\d]+(?:[\s\.\-]*[\w\d]+)?)", src_text_scan, re.IGNORECASE)
+            fig_refs = find_figure_refs(src_text_scan)
             img_added = False
             if PIL_AVAILABLE and fig_refs and drawings_images_map:
                 for ref in fig_refs:
@@ -1243,61 +3748,17 @@ class ClaudeTranslationAgent(BaseTranslationAgent):
             if img_added: add_text("\n")
         add_text("\nTRANSLATED SENTENCES (numbered list for 'PATENT SENTENCES TO TRANSLATE' only):")
 
-        try:
-            msg = {"role": "user", "content": content_parts}
-            response = self.client.messages.create(model=self.model_name, max_tokens=2048, messages=[msg])
-            raw_text = ""
-            try:
-                if hasattr(response, "content"):
-                    raw_text = "".join(block.text for block in response.content if getattr(block, "type", None) == "text")
-            except Exception:
-                raw_text = getattr(response, "text", "") or str(response)
-        except Exception as e:
-            self.log_queue.put(f"[Claude Translator] Error: {e}")
-            return {n: f"[TL Err line {n} (Claude): {e}]" for n in lines_map_to_translate.keys()}
-
-        translations = {}
-        for line in (raw_text or "").splitlines():
-            m = re.match(r"^\s*(\d+)\.\s*(.*)", line.strip())
-            if m:
-                num = int(m.group(1)); txt = m.group(2).strip()
-                if num in line_nums: translations[num] = txt
-        for num in line_nums:
-            if num not in translations:
-                self.log_queue.put(f"[Claude Translator] Warn: Missing TL line {num}. Placeholder.")
-                translations[num] = f"[TL Missing line {num}]"
-        return translations
+        return {"messages": [{"role": "user", "content": content_parts}]}
 
-class ClaudeProofreadingAgent(BaseProofreadingAgent):
+class ClaudeProofreadingAgent(ClaudeAgentMixin, BaseProofreadingAgent):
     def __init__(self, api_key, log_queue, model_name='claude-3-5-sonnet-20241022'):
         super().__init__(api_key, log_queue, model_name, "Claude")
-        if not CLAUDE_AVAILABLE:
-            self.log_queue.put("[Claude Proofreader] ERROR: anthropic library not available."); return
-        if not api_key:
-            self.log_queue.put("[Claude Proofreader] ERROR: API Key is missing."); return
-        try:
-            self.client = anthropic.Anthropic(api_key=api_key) if hasattr(anthropic, "Anthropic") else anthropic.Client(api_key=api_key)
-            self.model = self.model_name
-            self.log_queue.put(f"[Claude Proofreader] Agent with model '{self.model_name}' initialized.")
-        except Exception as e:
-            self.log_queue.put(f"[Claude Proofreader] ERROR init ('{self.model_name}'): {e}.")
-
-    def proofread_specific_lines_with_context(self, lines_to_proofread_map, full_source_doc_str,
-                                             full_original_target_doc_str, source_lang, target_lang,
-                                             all_source_segments_original_list, drawings_images_map,
-                                             user_custom_instructions="", tracked_changes_data=None,
-                                             custom_system_prompt=None):
-        if not self.model:
-            return {n: {"revised_target": lines_to_proofread_map[n]["target_original"],
-                        "changes_summary": "[Proofread Err: Model not init]",
-                        "original_target": lines_to_proofread_map[n]["target_original"]} for n in lines_to_proofread_map.keys()}
-        if not lines_to_proofread_map:
-            self.log_queue.put(f"[Claude Proofreader] No lines for proofreading chunk.")
-            return {}
-
-        line_nums = sorted(lines_to_proofread_map.keys())
-        self.log_queue.put(f"[Claude Proofreader] Proofreading {len(line_nums)} lines: {line_nums[:3]}... w/ '{self.model_name}' (images + tracked changes)...")
+        self._init_client(api_key)
 
+    def _build_proofreading_payload(self, lines_to_proofread_map, line_nums, full_source_doc_str,
+                                    full_original_target_doc_str, source_lang, target_lang,
+                                    all_source_segments_original_list, drawings_images_map,
+                                    user_custom_instructions, tracked_changes_data, custom_system_prompt, context_shared=True):
         content_parts = []
         def add_text(t):
             if t:
@@ -1309,26 +3770,28 @@ class ClaudeProofreadingAgent(BaseProofreadingAgent):
                 system_prompt = custom_system_prompt.format(source_lang=source_lang, target_lang=target_lang)
                 add_text(system_prompt)
             except KeyError as e:
-                self.log_queue.put(f"[Claude Proofreader] Error in custom prompt template: {e}. Using default.")
+                self.log_queue.put(f"{self.log_label} Error in custom prompt template: {e}. Using default.")
                 add_text(f"You are an expert proofreader and editor for {source_lang} → {target_lang} translations, specializing in patent documents.")
         else:
             add_text(f"You are an expert proofreader and editor for {source_lang} → {target_lang} translations, specializing in patent documents.")
         
         if user_custom_instructions:
             add_text(f"\nIMPORTANT USER-PROVIDED INSTRUCTIONS:\n{user_custom_instructions}\n")
-        if tracked_changes_data:
-            current_src = [all_source_segments_original_list[n-1] for n in line_nums]
-            rel = tracked_changes_data.find_relevant_changes(current_src)
-            if rel:
-                add_text(format_tracked_changes_context(rel))
-                self.log_queue.put(f"[Claude Proofreader] Added {len(rel)} relevant tracked changes as context")
 
+        if not context_shared:  # the document context differs per chunk: cache the instructions only
+            content_parts[-1]["cache_control"] = ANTHROPIC_CACHE_CONTROL
+        add_text(f"\nFULL SOURCE DOCUMENT CONTEXT (reference only):\n{full_source_doc_str}\n")
+        add_text(f"FULL ORIGINAL TARGET DOCUMENT CONTEXT (for consistency):\n{full_original_target_doc_str}\n")
+        if context_shared:
+            content_parts[-1]["cache_control"] = ANTHROPIC_CACHE_CONTROL  # everything up to here is identical across chunks
+
+        add_text(self._tracked_changes_text(tracked_changes_data, all_source_segments_original_list, line_nums))
         add_text("SEGMENTS FOR PROOFREADING:\n")
         images_added = set()
         for ln in line_nums:
             src_text = lines_to_proofread_map[ln]["source"]
             orig_target = lines_to_proofread_map[ln]["target_original"]
-            fig_refs = re.findall(r"(?:figure|figuur|fig\.?)\s*([\w\d]+(?:[\s\.\-]*[\w\d]+)?)", src_text, re.IGNORECASE)
+            fig_refs = find_figure_refs(src_text)
             if PIL_AVAILABLE and fig_refs and drawings_images_map:
                 for ref in fig_refs:
                     normalized = normalize_figure_ref(f"fig {ref}")
@@ -1343,87 +3806,112 @@ class ClaudeProofreadingAgent(BaseProofreadingAgent):
             add_text(f"{ln}. EXISTING TRANSLATION: {orig_target}\n")
         add_text("\nREVISED TRANSLATIONS (numbered list only):")
 
-        try:
-            msg = {"role": "user", "content": content_parts}
-            response = self.client.messages.create(model=self.model_name, max_tokens=2048, messages=[msg])
-            raw_text = ""
-            try:
-                if hasattr(response, "content"):
-                    raw_text = "".join(block.text for block in response.content if getattr(block, "type", None) == "text")
-            except Exception:
-                raw_text = getattr(response, "text", "") or str(response)
-        except Exception as e:
-            self.log_queue.put(f"[Claude Proofreader] Error during call: {e}")
-            return {n: {"revised_target": lines_to_proofread_map[n]["target_original"],
-                        "changes_summary": f"[Proofread Err line {n}: {e}]",
-                        "original_target": lines_to_proofread_map[n]["target_original"]} for n in line_nums}
-
-        translations_block = raw_text
-        summary_block = ""
-        summary_start = "---CHANGES SUMMARY START---"
-        summary_end = "---CHANGES SUMMARY END---"
-        if summary_start in raw_text:
-            parts = raw_text.split(summary_start, 1)
-            translations_block = parts[0].strip()
-            remainder = parts[1]
-            summary_block = remainder.split(summary_end, 1)[0].strip() if summary_end in remainder else remainder.strip()
-
-        results = {}
-        for line in translations_block.splitlines():
-            m = re.match(r"^\s*(\d+)\.\s*(.*)$", line.strip())
-            if m:
-                num = int(m.group(1))
-                txt = m.group(2).strip()
-                if num in line_nums:
-                    results.setdefault(num, {})["revised_target"] = txt
-
-        parsed_summaries = {}
-        if summary_block and "No changes made to any segment in this batch." not in summary_block:
-            for line in summary_block.splitlines():
-                m = re.match(r"^\s*(\d+)\.\s*(.*)$", line.strip())
-                if m:
-                    parsed_summaries[m.group(1)] = m.group(2).strip()
-
-        for num in line_nums:
-            original_target = lines_to_proofread_map[num]["target_original"]
-            entry = results.setdefault(num, {})
-            if "revised_target" not in entry or not entry["revised_target"].strip():
-                entry["revised_target"] = original_target
-                self.log_queue.put(f"[Claude Proofreader] Note: Using original translation for line {num} (missing or empty revised output).")
-            entry["changes_summary"] = parsed_summaries.get(str(num))
-            entry["original_target"] = original_target
-
-        self.log_queue.put(f"[Claude Proofreader] Proofreading parse complete. Segments: {len(results)}.")
-        return results
+        return {"messages": [{"role": "user", "content": content_parts}]}
 
 # --- OpenAI Agents ---
-class OpenAITranslationAgent(BaseTranslationAgent):
-    def __init__(self, api_key, log_queue, model_name='gpt-4o'):
-        super().__init__(api_key, log_queue, model_name, "OpenAI")
+class OpenAIAgentMixin:
+    """OpenAI client (borrowed from PROVIDER_CLIENTS) and blocking/async chat completion calls shared by both OpenAI agents."""
+    def _init_client(self, api_key):
         if not OPENAI_AVAILABLE:
-            self.log_queue.put("[OpenAI Translator] ERROR: openai library not available.")
+            self.log_queue.put(f"{self.log_label} ERROR: openai library not available.")
             return
         if not api_key:
-            self.log_queue.put("[OpenAI Translator] ERROR: API Key is missing.")
+            self.log_queue.put(f"{self.log_label} ERROR: API Key is missing.")
             return
         try:
-            self.client = openai.OpenAI(api_key=api_key)
+            self.client = PROVIDER_CLIENTS.client("OpenAI", api_key, self.log_queue)
             self.model = self.model_name
-            self.log_queue.put(f"[OpenAI Translator] Agent with model '{self.model_name}' initialized.")
+            self.log_queue.put(f"{self.log_label} Agent with model '{self.model_name}' initialized.")
         except Exception as e:
-            self.log_queue.put(f"[OpenAI Translator] ERROR init ('{self.model_name}'): {e}.")
+            self.log_queue.put(f"{self.log_label} ERROR init ('{self.model_name}'): {e}.")
 
-    def translate_specific_lines_with_drawings_context(self, lines_map_to_translate, full_document_context_text_str,
-                                                       source_lang, target_lang, all_source_segments_original_list,
-                                                       drawings_images_map, user_custom_instructions="",
-                                                       tracked_changes_data=None, custom_system_prompt=None):
-        if not self.model:
-            return {n: f"[Err: Model not init]" for n in lines_map_to_translate.keys()}
-        if not lines_map_to_translate:
-            return {}
-        line_nums = sorted(list(lines_map_to_translate.keys()))
-        self.log_queue.put(f"[OpenAI Translator] Translating {len(line_nums)} lines: {line_nums[:3]}... w/ '{self.model_name}' (images + tracked changes)...")
+    def _get_async_client(self):
+        # Per event loop: the async client binds its connection pool to the running loop
+        return PROVIDER_CLIENTS.async_client("OpenAI", self.api_key)
+
+    # Reasoning models take max_completion_tokens and only the default temperature
+    REASONING_MODEL_PREFIXES = ("gpt-5", "o1", "o3", "o4")
 
+    def _apply_output_budget(self, payload, est_output_tokens):
+        max_tokens = size_max_output_tokens(self.model_name, est_output_tokens)
+        if self.model_name.startswith(self.REASONING_MODEL_PREFIXES):
+            payload.pop("temperature", None)
+            payload["max_completion_tokens"] = max_tokens
+        else:
+            payload["max_tokens"] = max_tokens
+
+    def _response_dict(self, response):
+        if not response.choices:
+            return {"text": "", "finish_reason": None, "truncated": False}
+        choice = response.choices[0]
+        finish_reason = getattr(choice, "finish_reason", None)
+        return {"text": choice.message.content or "", "finish_reason": finish_reason, "truncated": finish_reason == "length",
+                "usage": self._usage_dict(getattr(response, "usage", None))}
+
+    def _usage_dict(self, usage_obj):
+        # Prefix caching is automatic for prompts over 1024 tokens; cached tokens are reported, never billed as writes
+        cached = getattr(getattr(usage_obj, "prompt_tokens_details", None), "cached_tokens", 0) or 0
+        return {"input_tokens": max(0, (getattr(usage_obj, "prompt_tokens", 0) or 0) - cached),
+                "output_tokens": getattr(usage_obj, "completion_tokens", 0) or 0,
+                "cache_read_tokens": cached, "cache_write_tokens": 0}
+
+    def _generate(self, payload):
+        return self._response_dict(self.client.chat.completions.create(model=self.model_name, **payload))
+
+    async def _agenerate(self, payload):
+        return self._response_dict(await self._get_async_client().chat.completions.create(model=self.model_name, **payload))
+
+    def _stream(self, payload, on_delta):
+        parts, finish_reason, usage_obj = [], None, None
+        stream = self.client.chat.completions.create(model=self.model_name, stream=True,
+                                                     stream_options={"include_usage": True}, **payload)
+        for chunk in stream:
+            if getattr(chunk, "usage", None):
+                usage_obj = chunk.usage
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            text = getattr(choice.delta, "content", None) if choice.delta else None
+            if text:
+                parts.append(text)
+                on_delta(text)
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+        return {"text": "".join(parts), "finish_reason": finish_reason, "truncated": finish_reason == "length",
+                "usage": self._usage_dict(usage_obj)}
+
+    async def _astream(self, payload, outcome):
+        parts, finish_reason, usage_obj = [], None, None
+        stream = await self._get_async_client().chat.completions.create(model=self.model_name, stream=True,
+                                                                         stream_options={"include_usage": True}, **payload)
+        async with stream:
+            async for chunk in stream:
+                if getattr(chunk, "usage", None):
+                    usage_obj = chunk.usage
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                text = getattr(choice.delta, "content", None) if choice.delta else None
+                if text:
+                    parts.append(text)
+                    yield text
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+        outcome["response"] = {"text": "".join(parts), "finish_reason": finish_reason, "truncated": finish_reason == "length",
+                               "usage": self._usage_dict(usage_obj)}
+
+    def _build_text_payload(self, prompt):
+        return {"messages": [{"role": "user", "content": prompt}], "temperature": 0.1}
+
+class OpenAITranslationAgent(OpenAIAgentMixin, BaseTranslationAgent):
+    def __init__(self, api_key, log_queue, model_name='gpt-4o'):
+        super().__init__(api_key, log_queue, model_name, "OpenAI")
+        self._init_client(api_key)
+
+    def _build_translation_payload(self, lines_map_to_translate, line_nums, full_document_context_text_str,
+                                   source_lang, target_lang, all_source_segments_original_list,
+                                   drawings_images_map, user_custom_instructions, tracked_changes_data,
+                                   custom_system_prompt, context_shared=True):
         content_parts = []
         def add_text(t):
             if t:
@@ -1431,17 +3919,14 @@ class OpenAITranslationAgent(BaseTranslationAgent):
         
         def add_image(img):
             if img:
-                import io
-                import base64
-                buffer = io.BytesIO()
-                img.save(buffer, format='PNG')
-                img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-                content_parts.append({
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/png;base64,{img_base64}"
-                    }
-                })
+                img_base64 = pil_image_to_base64_png(img)
+                if img_base64:
+                    content_parts.append({
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/png;base64,{img_base64}"
+                        }
+                    })
 
         # Use custom system prompt if provided, otherwise use default
         if custom_system_prompt:
@@ -1452,91 +3937,52 @@ class OpenAITranslationAgent(BaseTranslationAgent):
         else:
             system_prompt = f"You are an expert {source_lang} to {target_lang} translator. Translate ONLY the sentences from 'PATENT SENTENCES TO TRANSLATE' later, maintaining their original line numbers.\n\nPresent your output ONLY as a numbered list of translations for the requested sentences."
 
-        # Add context
-        add_text(f"FULL DOCUMENT CONTEXT for reference:\n{full_document_context_text_str}\n\n")
+        # Static prefix first (system message, instructions, document context) so OpenAI's automatic
+        # prefix caching can reuse it across chunks; per-chunk material follows
         if user_custom_instructions:
             add_text(f"ADDITIONAL INSTRUCTIONS:\n{user_custom_instructions}\n\n")
-        if tracked_changes_data and tracked_changes_data != "No tracked changes found.":
-            add_text(f"TRACKED CHANGES:\n{tracked_changes_data}\n\n")
+        add_text(f"FULL DOCUMENT CONTEXT for reference:\n{full_document_context_text_str}\n\n")
+        tracked_text = self._tracked_changes_text(tracked_changes_data, all_source_segments_original_list, line_nums)
+        if tracked_text:
+            add_text(f"{tracked_text}\n\n")
 
         # Add sentences to translate
         add_text("PATENT SENTENCES TO TRANSLATE:\n")
-        numbered_src_line = ""
+        numbered_src_lines = ""
+        images_added = set()
         for num in line_nums:
-            src_line = lines_map_to_translate[num]
-            if num in drawings_images_map:
-                img_added = False
-                ref_name = f"FIGURE {num}"
-                for ref, img in drawings_images_map.items():
-                    if ref.upper().replace(" ", "").replace(".", "") == ref_name.upper().replace(" ", "").replace(".", ""):
-                        add_text(numbered_src_line)
-                        add_image(img)
-                        numbered_src_line = f"\n{num}. {src_line}\n"
-                        img_added = True
+            fig_refs = find_figure_refs(all_source_segments_original_list[num - 1])
+            if PIL_AVAILABLE and fig_refs and drawings_images_map:
+                for ref in fig_refs:
+                    norm = normalize_figure_ref(f"fig {ref}")
+                    if norm and norm in drawings_images_map and norm not in images_added:
+                        add_text(numbered_src_lines)
+                        add_text(f"\n--- Context Image: Figure {ref} (Referenced in or near the following text) ---")
+                        add_image(drawings_images_map[norm])
+                        images_added.add(norm)
+                        numbered_src_lines = ""
                         break
-            numbered_src_line += f"{num}. {src_line}\n"
-            if img_added:
-                add_text(numbered_src_line)
-                numbered_src_line = ""
-        add_text(numbered_src_line)
+            numbered_src_lines += f"{lines_map_to_translate[num]}\n"
+        add_text(numbered_src_lines)
         add_text("TRANSLATED SENTENCES (numbered list for 'PATENT SENTENCES TO TRANSLATE' only):")
 
-        try:
-            messages = [
+        return {
+            "messages": [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": content_parts}
-            ]
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=messages,
-                max_tokens=2048,
-                temperature=0.1
-            )
-            raw_text = response.choices[0].message.content if response.choices else ""
-        except Exception as e:
-            self.log_queue.put(f"[OpenAI Translator] Error: {e}")
-            return {n: f"[TL Err line {n} (OpenAI): {e}]" for n in lines_map_to_translate.keys()}
-
-        translations = {}
-        for line in (raw_text or "").splitlines():
-            m = re.match(r"^\s*(\d+)\.\s*(.*)", line.strip())
-            if m:
-                num = int(m.group(1)); txt = m.group(2).strip()
-                if num in line_nums: translations[num] = txt
-        for num in line_nums:
-            if num not in translations:
-                self.log_queue.put(f"[OpenAI Translator] Warn: Missing TL line {num}. Placeholder.")
-                translations[num] = f"[TL Missing line {num}]"
-        return translations
+            ],
+            "temperature": 0.1
+        }
 
-class OpenAIProofreadingAgent(BaseProofreadingAgent):
+class OpenAIProofreadingAgent(OpenAIAgentMixin, BaseProofreadingAgent):
     def __init__(self, api_key, log_queue, model_name='gpt-4o'):
         super().__init__(api_key, log_queue, model_name, "OpenAI")
-        if not OPENAI_AVAILABLE:
-            self.log_queue.put("[OpenAI Proofreader] ERROR: openai library not available.")
-            return
-        if not api_key:
-            self.log_queue.put("[OpenAI Proofreader] ERROR: API Key is missing.")
-            return
-        try:
-            self.client = openai.OpenAI(api_key=api_key)
-            self.model = self.model_name
-            self.log_queue.put(f"[OpenAI Proofreader] Agent with model '{self.model_name}' initialized.")
-        except Exception as e:
-            self.log_queue.put(f"[OpenAI Proofreader] ERROR init ('{self.model_name}'): {e}.")
-
-    def proofread_specific_lines_with_context(self, lines_data, full_document_context_text_str,
-                                            source_lang, target_lang, user_custom_instructions="",
-                                            tracked_changes_data=None, custom_system_prompt=None):
-        if not self.model:
-            return [{"line_num": item.get("line_num", 0), "original_target": item.get("target", ""), 
-                    "revised_target": f"[Err: Model not init]", "changes_summary": ""} for item in lines_data]
-        if not lines_data:
-            return []
-
-        line_nums = [item.get("line_num") for item in lines_data]
-        self.log_queue.put(f"[OpenAI Proofreader] Proofreading {len(line_nums)} lines: {line_nums[:3]}... w/ '{self.model_name}'...")
+        self._init_client(api_key)
 
+    def _build_proofreading_payload(self, lines_to_proofread_map, line_nums, full_source_doc_str,
+                                    full_original_target_doc_str, source_lang, target_lang,
+                                    all_source_segments_original_list, drawings_images_map,
+                                    user_custom_instructions, tracked_changes_data, custom_system_prompt, context_shared=True):
         # Use custom system prompt if provided, otherwise use default
         if custom_system_prompt:
             try:
@@ -1547,112 +3993,1962 @@ class OpenAIProofreadingAgent(BaseProofreadingAgent):
             system_prompt = f"You are an expert {source_lang}-{target_lang} translation proofreader. Review and improve the translations provided, maintaining accuracy and fluency."
 
         # Build content
-        content = f"FULL DOCUMENT CONTEXT for reference:\n{full_document_context_text_str}\n\n"
+        # Static prefix first so OpenAI's automatic prefix caching can reuse it across chunks
+        content = ""
         if user_custom_instructions:
             content += f"ADDITIONAL INSTRUCTIONS:\n{user_custom_instructions}\n\n"
-        if tracked_changes_data and tracked_changes_data != "No tracked changes found.":
-            content += f"TRACKED CHANGES:\n{tracked_changes_data}\n\n"
+        content += f"FULL DOCUMENT CONTEXT for reference:\n{full_source_doc_str}\n\n"
+        if full_original_target_doc_str:
+            content += f"ORIGINAL TARGET DOCUMENT CONTEXT (for consistency):\n{full_original_target_doc_str}\n\n"
+        tracked_text = self._tracked_changes_text(tracked_changes_data, all_source_segments_original_list, line_nums)
+        if tracked_text:
+            content += f"{tracked_text}\n\n"
         
         content += "TRANSLATIONS TO REVIEW:\n"
-        for item in lines_data:
-            line_num = item.get("line_num")
-            source = item.get("source", "")
-            target = item.get("target", "")
-            content += f"{line_num}. SOURCE: {source}\n   TARGET: {target}\n\n"
+        for ln in line_nums:
+            source = lines_to_proofread_map[ln]["source"]
+            target = lines_to_proofread_map[ln]["target_original"]
+            content += f"{ln}. SOURCE: {source}\n   TARGET: {target}\n\n"
         
         content += "REVISED TRANSLATIONS (numbered list only):"
 
-        try:
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": content}
-            ]
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=messages,
-                max_tokens=3000,
-                temperature=0.1
-            )
-            raw_text = response.choices[0].message.content if response.choices else ""
-        except Exception as e:
-            self.log_queue.put(f"[OpenAI Proofreader] Error: {e}")
-            return [{"line_num": item.get("line_num", 0), "original_target": item.get("target", ""), 
-                    "revised_target": f"[PR Err line {item.get('line_num', 0)} (OpenAI): {e}]", 
-                    "changes_summary": ""} for item in lines_data]
-
-        # Parse responses
-        parsed_translations = {}
-        for line in (raw_text or "").splitlines():
-            m = re.match(r"^\s*(\d+)\.\s*(.*)", line.strip())
-            if m:
-                num = int(m.group(1)); txt = m.group(2).strip()
-                if num in line_nums: parsed_translations[num] = txt
+        return {
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": content}
+            ],
+            "temperature": 0.1
+        }
+
+# --- Mock Agents ---
+# Offline stand-in provider for benchmarks and load tests: well-formed numbered output with
+# simulated latency, throughput and failures, no network and no API key. The model name picks
+# a profile; $SUPERVERTALER_MOCK (a JSON object) overrides any option, e.g.
+#   SUPERVERTALER_MOCK='{"rate_limit_rate": 0.2, "time_scale": 0.1, "seed": 7}'
+MOCK_API_KEY = "mock"  # placeholder so the API key checks pass; never sent anywhere
+MOCK_DEFAULT_OPTIONS = {
+    "latency": 0.0,                 # seconds before the first byte (median for lognormal, mean for exponential)
+    "latency_distribution": "fixed",  # fixed, uniform (latency +/- spread), lognormal (sigma = spread), exponential
+    "latency_spread": 0.5,
+    "seconds_per_input_token": 0.0,   # prompt processing time
+    "seconds_per_output_token": 0.0,  # generation time, spread over the streamed lines
+    "error_rate": 0.0,              # requests failing with a 500
+    "rate_limit_rate": 0.0,         # requests refused with a 429
+    "missing_line_rate": 0.0,       # lines left out of an otherwise good response
+    "truncation_rate": 0.0,         # responses cut off halfway as if max_tokens was hit
+    "edit_rate": 0.2,               # Proofread: lines returned revised (with a change summary)
+    "time_scale": 1.0,              # multiplies every delay (0 = no waiting at all)
+    "seed": 0,
+}
+_MOCK_REALISTIC = {"latency": 1.5, "latency_distribution": "lognormal", "latency_spread": 0.5,
+                   "seconds_per_input_token": 0.00002, "seconds_per_output_token": 0.012}
+MOCK_PROFILES = {
+    "mock-instant": {},
+    "mock-realistic": _MOCK_REALISTIC,
+    "mock-flaky": dict(_MOCK_REALISTIC, error_rate=0.05, rate_limit_rate=0.05, missing_line_rate=0.02, truncation_rate=0.03),
+    "mock-throttled": dict(_MOCK_REALISTIC, rate_limit_rate=0.3),
+}
+MOCK_MODELS = list(MOCK_PROFILES)
+
+class MockProviderError(Exception):
+    """Injected provider failure; status_code 429 counts as throttling (see is_rate_limit_error)"""
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+class MockAgentMixin:
+    """Simulated client calls shared by both mock agents.
+
+    Every random draw comes from (seed, payload, attempt number), so a run is reproducible even
+    with concurrent requests, and a retried request gets fresh draws rather than the same failure.
+    """
+    def _init_client(self, api_key):
+        self.options = dict(MOCK_DEFAULT_OPTIONS)
+        self.options.update(MOCK_PROFILES.get(self.model_name, {}))
+        override = os.environ.get("SUPERVERTALER_MOCK")
+        if override:
+            try:
+                extra = json.loads(override)
+                if not isinstance(extra, dict):
+                    raise ValueError("not an object")
+                self.options.update(extra)
+            except ValueError as e:
+                self.log_queue.put(f"{self.log_label} WARN: ignoring SUPERVERTALER_MOCK ({e}); expected a JSON object.")
+        self.attempts = {}
+        self.attempts_lock = threading.Lock()
+        self.model = self.model_name
+        self.log_queue.put(f"{self.log_label} Agent with model '{self.model_name}' initialized (offline mock).")
+
+    def _rng(self, payload):
+        digest = hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        with self.attempts_lock:
+            attempt = self.attempts[digest] = self.attempts.get(digest, 0) + 1
+        return random.Random(f"{self.options['seed']}:{digest}:{attempt}")
+
+    def _latency(self, rng):
+        base, spread = float(self.options["latency"]), float(self.options["latency_spread"])
+        distribution = self.options["latency_distribution"]
+        if distribution == "uniform":
+            value = rng.uniform(base * (1 - spread), base * (1 + spread))
+        elif distribution == "lognormal":
+            value = base * math.exp(rng.gauss(0, spread))
+        elif distribution == "exponential":
+            value = rng.expovariate(1 / base) if base > 0 else 0.0
+        else:
+            value = base
+        return max(0.0, value)
+
+    def _response_lines(self, payload, rng):
+        """The text the mock model answers with, as a list of lines"""
+        options = self.options
+        if payload["task"] == "text":
+            return [f"Mock summary of a {len(payload['content'].split())}-word prompt."]
+        kept = [line for line in payload["lines"] if rng.random() >= options["missing_line_rate"]]
+        if payload["task"] == "translate":
+            return [f"{n}. [{payload['target_lang']}] {source}" for n, source in kept]
+        revised, summary = [], []
+        for n, source, target in kept:
+            if rng.random() < options["edit_rate"]:
+                revised.append(f"{n}. {target} [revised]")
+                summary.append(f"{n}. Mock revision.")
+            else:
+                revised.append(f"{n}. {target}")
+        return revised + [CHANGES_SUMMARY_START] + (summary or ["No changes made to any segment in this batch."]) + [CHANGES_SUMMARY_END]
+
+    def _simulate(self, payload):
+        """Plan one response: {"delay", "error"} for a failure, else {"delay", "lines": [(text, seconds)], "response"}"""
+        options, rng = self.options, self._rng(payload)
+        scale = float(options["time_scale"])
+        input_tokens = estimate_payload_tokens(payload)
+        delay = (self._latency(rng) + input_tokens * options["seconds_per_input_token"]) * scale
+        roll = rng.random()
+        if roll < options["rate_limit_rate"]:
+            return {"delay": delay * 0.2, "error": MockProviderError("Mock rate limit: too many requests (429)", 429)}
+        if roll < options["rate_limit_rate"] + options["error_rate"]:
+            return {"delay": delay, "error": MockProviderError("Mock server error (500)", 500)}
+        lines = self._response_lines(payload, rng)
+        truncated = len(lines) > 1 and rng.random() < options["truncation_rate"]
+        if truncated:
+            lines = lines[:len(lines) // 2]
+        timed, output_tokens = [], 0
+        for line in lines:
+            tokens = estimate_tokens(line) + 1
+            if payload.get("max_tokens") and output_tokens + tokens > payload["max_tokens"]:
+                truncated = True
+                break
+            output_tokens += tokens
+            timed.append((line + "\n", tokens * options["seconds_per_output_token"] * scale))
+        return {"delay": delay, "lines": timed,
+                "response": {"text": "".join(text for text, _ in timed).rstrip("\n"),
+                             "finish_reason": "max_tokens" if truncated else "end_turn", "truncated": truncated,
+                             "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                                       "cache_read_tokens": 0, "cache_write_tokens": 0}}}
+
+    def _generate(self, payload):
+        plan = self._simulate(payload)
+        time.sleep(plan["delay"] + sum(seconds for _, seconds in plan.get("lines", [])))
+        if "error" in plan:
+            raise plan["error"]
+        return plan["response"]
+
+    async def _agenerate(self, payload):
+        plan = self._simulate(payload)
+        await asyncio.sleep(plan["delay"] + sum(seconds for _, seconds in plan.get("lines", [])))
+        if "error" in plan:
+            raise plan["error"]
+        return plan["response"]
+
+    def _stream(self, payload, on_delta):
+        plan = self._simulate(payload)
+        time.sleep(plan["delay"])
+        if "error" in plan:
+            raise plan["error"]
+        for text, seconds in plan["lines"]:
+            time.sleep(seconds)
+            on_delta(text)
+        return plan["response"]
+
+    async def _astream(self, payload, outcome):
+        plan = self._simulate(payload)
+        await asyncio.sleep(plan["delay"])
+        if "error" in plan:
+            raise plan["error"]
+        for text, seconds in plan["lines"]:
+            await asyncio.sleep(seconds)
+            yield text
+        outcome["response"] = plan["response"]
+
+    def _build_text_payload(self, prompt):
+        return {"task": "text", "content": prompt}
+
+class MockTranslationAgent(MockAgentMixin, BaseTranslationAgent):
+    def __init__(self, api_key, log_queue, model_name='mock-instant'):
+        super().__init__(api_key, log_queue, model_name, "Mock")
+        self._init_client(api_key)
+
+    def _build_translation_payload(self, lines_map_to_translate, line_nums, full_document_context_text_str,
+                                   source_lang, target_lang, all_source_segments_original_list,
+                                   drawings_images_map, user_custom_instructions, tracked_changes_data,
+                                   custom_system_prompt, context_shared=True):
+        # Same prompt material as the real agents, so token counts and cache keys behave alike
+        tracked_text = self._tracked_changes_text(tracked_changes_data, all_source_segments_original_list, line_nums)
+        content = "\n\n".join(part for part in (
+            user_custom_instructions and f"ADDITIONAL INSTRUCTIONS:\n{user_custom_instructions}",
+            f"FULL DOCUMENT CONTEXT for reference:\n{full_document_context_text_str}", tracked_text,
+            "SENTENCES TO TRANSLATE:\n" + "\n".join(lines_map_to_translate[n] for n in line_nums)) if part)
+        return {"task": "translate", "system": custom_system_prompt or f"Mock {source_lang} to {target_lang} translator.",
+                "content": content, "target_lang": target_lang,
+                "lines": [[n, all_source_segments_original_list[n - 1]] for n in line_nums]}
+
+class MockProofreadingAgent(MockAgentMixin, BaseProofreadingAgent):
+    def __init__(self, api_key, log_queue, model_name='mock-instant'):
+        super().__init__(api_key, log_queue, model_name, "Mock")
+        self._init_client(api_key)
+
+    def _build_proofreading_payload(self, lines_to_proofread_map, line_nums, full_source_doc_str,
+                                    full_original_target_doc_str, source_lang, target_lang,
+                                    all_source_segments_original_list, drawings_images_map,
+                                    user_custom_instructions, tracked_changes_data, custom_system_prompt, context_shared=True):
+        tracked_text = self._tracked_changes_text(tracked_changes_data, all_source_segments_original_list, line_nums)
+        content = "\n\n".join(part for part in (
+            user_custom_instructions and f"ADDITIONAL INSTRUCTIONS:\n{user_custom_instructions}",
+            f"FULL DOCUMENT CONTEXT for reference:\n{full_source_doc_str}",
+            full_original_target_doc_str and f"ORIGINAL TARGET DOCUMENT CONTEXT (for consistency):\n{full_original_target_doc_str}",
+            tracked_text,
+            "TRANSLATIONS TO REVIEW:\n" + "\n".join(f"{n}. SOURCE: {lines_to_proofread_map[n]['source']}\n   TARGET: "
+                                                    f"{lines_to_proofread_map[n]['target_original']}" for n in line_nums)) if part)
+        return {"task": "proofread", "system": custom_system_prompt or f"Mock {source_lang}-{target_lang} proofreader.",
+                "content": content,
+                "lines": [[n, lines_to_proofread_map[n]["source"], lines_to_proofread_map[n]["target_original"]] for n in line_nums]}
+
+# --- Agent Factory Functions ---
+def create_translation_agent(provider, api_key, log_queue, model_name):
+    if provider.lower() == "gemini":
+        return GeminiTranslationAgent(api_key, log_queue, model_name)
+    elif provider.lower() == "claude":
+        return ClaudeTranslationAgent(api_key, log_queue, model_name)
+    elif provider.lower() == "openai":
+        return OpenAITranslationAgent(api_key, log_queue, model_name)
+    elif provider.lower() == "mock":
+        return MockTranslationAgent(api_key, log_queue, model_name)
+    else:
+        log_queue.put(f"[Factory] Unknown provider: {provider}")
+        return None
+
+def create_proofreading_agent(provider, api_key, log_queue, model_name):
+    if provider.lower() == "gemini":
+        return GeminiProofreadingAgent(api_key, log_queue, model_name)
+    elif provider.lower() == "claude":
+        return ClaudeProofreadingAgent(api_key, log_queue, model_name)
+    elif provider.lower() == "openai":
+        return OpenAIProofreadingAgent(api_key, log_queue, model_name)
+    elif provider.lower() == "mock":
+        return MockProofreadingAgent(api_key, log_queue, model_name)
+    else:
+        log_queue.put(f"[Factory] Unknown provider: {provider}")
+        return None
+
+def get_available_models(provider, api_key, log_queue):
+    if provider.lower() == "gemini":
+        if not GOOGLE_AI_AVAILABLE or not api_key:
+            return GEMINI_MODELS
+        try:
+            PROVIDER_CLIENTS.configure_genai(api_key)
+            dynamic_models = []
+            for m in genai.list_models():
+                if 'generateContent' in m.supported_generation_methods:
+                    model_name = m.name.split('/')[-1] if '/' in m.name else m.name
+                    dynamic_models.append(model_name)
+            return dynamic_models if dynamic_models else GEMINI_MODELS
+        except Exception as e:
+            log_queue.put(f"[Models] Error fetching Gemini models: {e}")
+            return GEMINI_MODELS
+    elif provider.lower() == "claude":
+        return CLAUDE_MODELS
+    elif provider.lower() == "openai":
+        return OPENAI_MODELS
+    elif provider.lower() == "mock":
+        return MOCK_MODELS
+    else:
+        return []
+
+# --- Hedging and Failover ---
+HEDGE_PERCENTILE = 95.0          # hedge a call once it runs longer than this percentile of the primary's recent calls
+HEDGE_MIN_SAMPLES = 10           # until then, calls are hedged after HEDGE_DEFAULT_DELAY
+HEDGE_DEFAULT_DELAY = 60.0       # seconds
+HEDGE_MIN_DELAY = 5.0            # never sooner, or a fast provider's calls would all be sent twice
+HEDGE_LATENCY_WINDOW = 200       # recent call latencies the percentile is taken over
+BREAKER_FAILURE_THRESHOLD = 5    # failed calls in a row before a provider gets no more traffic
+BREAKER_COOLDOWN_SECONDS = 60.0  # then one trial call decides whether it gets traffic again
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker for one provider/model, shared by every agent in the process.
+
+    A call fails when it raises, returns no usable line, or loses to its hedge request.
+    BREAKER_FAILURE_THRESHOLD failures in a row open the breaker; after the cooldown one
+    trial call is let through, and its outcome closes the breaker or opens it again.
+    """
+    def __init__(self, name, threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN_SECONDS):
+        self.name = name
+        self.lock = threading.Lock()
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial = False
+        self.trips = 0
+
+    def allow(self):
+        """True if a call may go to this provider now (when half-open, only the single trial call)"""
+        with self.lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = "half-open"
+            if self.state == "closed":
+                return True
+            if self.state == "half-open" and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def record(self, ok, log_queue=None):
+        with self.lock:
+            previous = self.state
+            self.trial = False
+            if ok:
+                self.state, self.failures = "closed", 0
+            else:
+                self.failures += 1
+                if self.state == "half-open" or self.failures >= self.threshold:
+                    self.trips += self.state != "open"
+                    self.state, self.opened_at = "open", time.monotonic()
+            changed = self.state != previous
+        if changed and log_queue is not None:
+            log_queue.put(f"[Failover] Circuit {self.describe()}")
+
+    def release(self):
+        """Free the trial slot of a call whose outcome will never be known (cancelled after its hedge won)"""
+        with self.lock:
+            self.trial = False
+
+    def describe(self):
+        with self.lock:
+            return (f"{self.name}: {self.state}, {self.failures} failure(s) in a row, "
+                    f"opened {self.trips} time(s)")
+
+_CIRCUIT_BREAKERS = {}
+_CIRCUIT_BREAKERS_LOCK = threading.Lock()
+
+def get_circuit_breaker(provider, model_name):
+    """Return the process-wide circuit breaker for a provider/model (all its API keys)"""
+    registry_key = (provider, model_name)
+    with _CIRCUIT_BREAKERS_LOCK:
+        breaker = _CIRCUIT_BREAKERS.get(registry_key)
+        if breaker is None:
+            breaker = _CIRCUIT_BREAKERS[registry_key] = CircuitBreaker(f"{provider}/{model_name}")
+        return breaker
+
+class HedgedAgent:
+    """Policy layer over two agents of the same role: a primary and a fallback (another provider and/or model).
+
+    A call goes to the primary. If it is still running after the hedge delay (hedge_percentile of the
+    primary's recent call latencies), the same call is also sent to the fallback; the first result with
+    usable lines wins and the other call is cancelled: its task (asyncio) or its RequestCancel (threads: a
+    stream stops at its next delta; a blocking SDK call cannot be stopped and keeps its slot and rate
+    reservation until it returns). A call that fails goes to the fallback at once, and while the primary's
+    circuit breaker is open calls go straight to the fallback.
+    Everything else (bulk requests, document summaries, provider/model/API key) is the primary's.
+    """
+    SHARED_ATTRIBUTES = ("response_cache", "streaming", "on_line")  # set on both agents
+
+    def __init__(self, primary, fallback, log_queue, hedge_percentile=HEDGE_PERCENTILE):
+        self.primary = primary
+        self.fallback = fallback
+        self.log_queue = log_queue
+        self.hedge_percentile = hedge_percentile  # 0 = fail over, but never hedge
+        self.log_label = f"[Failover {primary.provider}/{primary.model_name} -> {fallback.provider}/{fallback.model_name}]"
+        self.lock = threading.Lock()
+        self.latency_samples = []
+        self.stats = {"calls": 0, "hedged": 0, "hedges_won": 0, "failed_over": 0}
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__["primary"], name)
+
+    def __setattr__(self, name, value):
+        if name in self.SHARED_ATTRIBUTES:
+            setattr(self.primary, name, value)
+            setattr(self.fallback, name, value)
+        else:
+            object.__setattr__(self, name, value)
+
+    def translate_specific_lines_with_drawings_context(self, *args, **kwargs):
+        return self._call("translate_specific_lines_with_drawings_context", "Translate", args, kwargs)
+
+    async def atranslate_specific_lines_with_drawings_context(self, *args, **kwargs):
+        return await self._acall("atranslate_specific_lines_with_drawings_context", "Translate", args, kwargs)
+
+    def proofread_specific_lines_with_context(self, *args, **kwargs):
+        return self._call("proofread_specific_lines_with_context", "Proofread", args, kwargs)
+
+    async def aproofread_specific_lines_with_context(self, *args, **kwargs):
+        return await self._acall("aproofread_specific_lines_with_context", "Proofread", args, kwargs)
+
+    def _count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def _plan(self):
+        """(first agent, agent to hedge or fail over to) for the next call, following the circuit breakers"""
+        self._count("calls")
+        if get_circuit_breaker(self.primary.provider, self.primary.model_name).allow():
+            return self.primary, self.fallback
+        if get_circuit_breaker(self.fallback.provider, self.fallback.model_name).allow():
+            self._count("failed_over")
+            return self.fallback, None
+        return self.primary, None  # both circuits open: keep trying the primary
+
+    def _hedge_delay(self):
+        if not self.hedge_percentile:
+            return None
+        with self.lock:
+            samples = list(self.latency_samples)
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return max(HEDGE_MIN_DELAY, percentile(samples, self.hedge_percentile / 100.0))
+
+    def _usable(self, mode, outcome):
+        results = outcome.get("results")
+        if results is None:
+            return False
+        return not results or any(not is_failed_result(mode, value) for value in results.values())
+
+    def _second_call(self, lead, backup, hedge_after=None):
+        """True if the backup call may be sent now: as a hedge (after hedge_after seconds) or after lead failed"""
+        if backup is None or not get_circuit_breaker(backup.provider, backup.model_name).allow():
+            return False
+        self._count("hedged" if hedge_after is not None else "failed_over")
+        if hedge_after is not None:
+            self.log_queue.put(f"{self.log_label} {lead.provider}/{lead.model_name} still running after {hedge_after:.1f}s "
+                               f"(p{self.hedge_percentile:g}); hedging with {backup.provider}/{backup.model_name}.")
+        else:
+            self.log_queue.put(f"{self.log_label} {lead.provider}/{lead.model_name} call failed; retrying with {backup.provider}/{backup.model_name}.")
+        return True
+
+    def _settle(self, agent, usable, elapsed):
+        get_circuit_breaker(agent.provider, agent.model_name).record(usable, self.log_queue)
+        if usable and agent is self.primary:
+            with self.lock:
+                self.latency_samples = (self.latency_samples + [elapsed])[-HEDGE_LATENCY_WINDOW:]
+
+    def _won(self, winner, losers):
+        """Settle the circuits of the calls that lost to winner (already cancelled by the caller)"""
+        for loser in losers:
+            if loser is self.primary:
+                get_circuit_breaker(loser.provider, loser.model_name).record(False, self.log_queue)  # lost to its hedge: too slow
+            else:
+                get_circuit_breaker(loser.provider, loser.model_name).release()
+        if losers and winner is not self.primary:
+            self._count("hedges_won")
+            self.log_queue.put(f"{self.log_label} {winner.provider}/{winner.model_name} answered first; "
+                               f"{self.primary.provider}/{self.primary.model_name} call cancelled.")
+
+    def _finish(self, last):
+        """No usable result from any call: the last one's placeholders, or its exception"""
+        if "error" in last:
+            raise last["error"]
+        return last["results"]
+
+    def _call(self, name, mode, args, kwargs):
+        lead, backup = self._plan()
+        finished = queue.Queue()
+        def start(agent):
+            # Each call runs on its own thread, in a copy of the caller's context (run metrics, trace)
+            # with its own cancellation signal
+            context, started, cancel = contextvars.copy_context(), time.monotonic(), RequestCancel()
+            context.run(_REQUEST_CANCEL.set, cancel)
+            def call():
+                try:
+                    outcome = {"results": context.run(getattr(agent, name), *args, **kwargs)}
+                except Exception as e:
+                    outcome = {"error": e}
+                finished.put((agent, outcome, time.monotonic() - started))
+            threading.Thread(target=call, name="LLMHedge", daemon=True).start()
+            running[agent] = cancel
+        running = {}
+        start(lead)
+        spare = backup  # until it has been sent (or refused by its circuit breaker)
+        hedge_after = self._hedge_delay() if spare is not None else None
+        while True:
+            try:
+                agent, outcome, elapsed = finished.get(timeout=hedge_after)
+            except queue.Empty:
+                if self._second_call(lead, spare, hedge_after):
+                    start(spare)
+                spare = hedge_after = None
+                continue
+            running.pop(agent)
+            usable = self._usable(mode, outcome)
+            self._settle(agent, usable, elapsed)
+            if usable:
+                for cancel in running.values():
+                    cancel.cancel()
+                self._won(agent, list(running))
+                return outcome["results"]
+            if self._second_call(lead, spare):
+                start(spare)
+            spare = hedge_after = None
+            if not running:
+                return self._finish(outcome)
+
+    async def _acall(self, name, mode, args, kwargs):
+        lead, backup = self._plan()
+        async def call(agent):
+            started = time.monotonic()
+            try:
+                outcome = {"results": await getattr(agent, name)(*args, **kwargs)}
+            except Exception as e:
+                outcome = {"error": e}
+            return outcome, time.monotonic() - started
+        running = {asyncio.ensure_future(call(lead)): lead}
+        spare = backup
+        hedge_after = self._hedge_delay() if spare is not None else None
+        while True:
+            done, _ = await asyncio.wait(running, timeout=hedge_after, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if self._second_call(lead, spare, hedge_after):
+                    running[asyncio.ensure_future(call(spare))] = spare
+                spare = hedge_after = None
+                continue
+            winner = last = None
+            for task in done:
+                agent = running.pop(task)
+                outcome, elapsed = task.result()
+                usable = self._usable(mode, outcome)
+                self._settle(agent, usable, elapsed)
+                if usable and winner is None:
+                    winner = (agent, outcome)
+                last = outcome
+            if winner is not None:
+                for task in running:
+                    task.cancel()  # the SDK's async request is aborted with it
+                await asyncio.gather(*running, return_exceptions=True)  # let the losers release their slots
+                self._won(winner[0], list(running.values()))
+                return winner[1]["results"]
+            if self._second_call(lead, spare):
+                running[asyncio.ensure_future(call(spare))] = spare
+            spare = hedge_after = None
+            if not running:
+                return self._finish(last)
+
+    def describe(self):
+        with self.lock:
+            stats = dict(self.stats)
+        text = (f"{stats['calls']} call(s): {stats['hedged']} hedged ({stats['hedges_won']} won by the fallback), "
+                f"{stats['failed_over']} failed over")
+        return (f"{text}; circuits {get_circuit_breaker(self.primary.provider, self.primary.model_name).describe()}"
+                f" | {get_circuit_breaker(self.fallback.provider, self.fallback.model_name).describe()}")
+
+def create_hedged_agent(primary, fallback, log_queue, hedge_percentile=HEDGE_PERCENTILE):
+    """Wrap an agent from create_translation_agent / create_proofreading_agent with a fallback agent of the same role"""
+    if primary is None or fallback is None or not fallback.model:
+        return primary
+    return HedgedAgent(primary, fallback, log_queue, hedge_percentile)
+
+# --- Checkpoint Journal ---
+JOURNAL_SUFFIX = ".journal.jsonl"
+
+def journal_path_for(output_path):
+    return output_path + JOURNAL_SUFFIX
+
+def segment_digest(text):
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()[:16]
+
+class CheckpointJournal:
+    """Append-only JSONL record of finished lines, kept next to the output file.
+
+    Each finished chunk is appended and fsync'd, so a crash or closed window loses at most the
+    chunks in flight. Entries carry a digest of their source segment: on resume, a line is only
+    reused if its source text is unchanged. A torn last line (crash mid-write) is ignored.
+    """
+    def __init__(self, path, mode, source_lang, target_lang, provider, model_name):
+        self.path = path
+        self.header = {"type": "header", "version": 1, "mode": mode, "source_lang": source_lang,
+                       "target_lang": target_lang, "provider": provider, "model": model_name}
+        self.file = None
+        self.lock = threading.Lock()
+        self.recorded = 0
+
+    def _matches(self, header):
+        return all(header.get(k) == self.header[k] for k in ("version", "mode", "source_lang", "target_lang"))
+
+    def load(self, source_segments, log_queue=None):
+        """Return {line_num: result} for journal entries that still match the current source segments"""
+        results = {}
+        if not os.path.exists(self.path):
+            return results
+        stale = 0
+        with open(self.path, "r", encoding="utf-8") as f:
+            for i, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if i == 0:
+                    if record.get("type") != "header" or not self._matches(record):
+                        if log_queue: log_queue.put(f"[Checkpoint] {self.path} is for a different job; not resuming from it.")
+                        return {}
+                    continue
+                for line_num, digest, value in record.get("lines", []):
+                    if 0 < line_num <= len(source_segments) and segment_digest(source_segments[line_num - 1]) == digest:
+                        results[line_num] = value
+                    else:
+                        stale += 1
+        if log_queue:
+            log_queue.put(f"[Checkpoint] Replayed {len(results)} finished line(s) from {self.path}"
+                          + (f"; {stale} entry(ies) skipped because the source changed." if stale else "."))
+        return results
+
+    def start(self, replayed, source_segments):
+        """Open the journal for appending; a fresh journal is rewritten with the header and any replayed lines"""
+        self.file = open(self.path, "w", encoding="utf-8")
+        self.file.write(json.dumps(self.header, ensure_ascii=False) + "\n")
+        if replayed:
+            self.record(replayed, source_segments)
+        else:
+            self._sync()
+
+    def record(self, chunk_results, source_segments, mode=None):
+        lines = [[n, segment_digest(source_segments[n - 1]), value] for n, value in sorted(chunk_results.items())
+                 if mode is None or not is_failed_result(mode, value)]
+        if not lines or self.file is None:
+            return
+        with self.lock:
+            self.file.write(json.dumps({"type": "chunk", "lines": lines}, ensure_ascii=False) + "\n")
+            self._sync()
+            self.recorded += len(lines)
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self, remove=False):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        if remove and os.path.exists(self.path):
+            os.remove(self.path)
+
+# --- LLM Chunk Dispatcher ---
+def chunk_route(agent, mode, build_request, error_result, total, retry_policy=None, on_chunk_done=None,
+                on_finished=None, label="", metrics=None):
+    """Everything needed to send and merge the chunks of one document.
+
+    build_request(indices) -> (args, kwargs) for the agent method.
+    error_result(indices, exc) -> placeholder results for a chunk that raised.
+    on_chunk_done(results) runs for each merged chunk, on_finished() once all `total` chunks are in.
+    metrics: RunMetrics that the agent's requests for these chunks are reported to.
+    Results also accumulate in route["merged"].
+    """
+    return {"agent": agent, "mode": mode, "build_request": build_request, "error_result": error_result,
+            "retry_policy": retry_policy or RetryPolicy(max_attempts=0), "on_chunk_done": on_chunk_done,
+            "on_finished": on_finished, "label": label, "metrics": metrics, "total": total, "done": 0, "merged": {}}
+
+class LLMChunkDispatcher:
+    """Sends the LLM chunks of a run concurrently and merges their results by line number.
+
+    dispatch_mode "threads" runs the blocking agent methods on a bounded thread pool;
+    "asyncio" runs the agents' async methods on one event loop (DISPATCH_LOOP, shared by all runs),
+    so many requests can be in flight without a thread each. Await arun_routed() directly to share an existing loop.
+
+    run_routed() takes chunks from several documents at once: each chunk comes with a route
+    (see chunk_route()) naming its agent, request builder and callbacks, and the chunks are pulled
+    lazily so the next document is only prepared once the pool has room for it.
+    """
+    DISPATCH_MODES = ("threads", "asyncio")
+
+    def __init__(self, agent, mode, log_queue, max_in_flight, dispatch_mode="threads", retry_policy=None,
+                 on_chunk_done=None):
+        self.agent = agent
+        self.mode = mode
+        self.log_queue = log_queue
+        self.max_in_flight = max(1, int(max_in_flight or 1))
+        self.dispatch_mode = dispatch_mode if dispatch_mode in self.DISPATCH_MODES else "threads"
+        self.retry_policy = retry_policy or RetryPolicy(max_attempts=0)
+        self.repair_stats = {"failed": 0, "recovered": 0}
+        self.stats_lock = threading.Lock()
+        self.on_chunk_done = on_chunk_done  # called with each finished chunk's results (e.g. checkpointing)
+        self.retry_policies = []
+        self.agents = []
+        self.trace = None     # (Tracer, None) of the calling thread, handed on to the pool threads
+        self.profiler = None
+
+    def _agent_method(self, route, use_async):
+        if route["mode"] == "Translate":
+            name = "translate_specific_lines_with_drawings_context"
+        else:
+            name = "proofread_specific_lines_with_context"
+        return getattr(route["agent"], ("a" + name) if use_async else name)
+
+    def _concurrency_controller(self, agent):
+        return get_concurrency_controller(agent.provider, agent.model_name, agent.api_key)
+
+    def _start_route(self, route):
+        # max_in_flight is the ceiling; the adaptive controller decides how many are actually sent
+        if route["agent"] not in self.agents:
+            self.agents.append(route["agent"])
+            self._concurrency_controller(route["agent"]).set_max_limit(self.max_in_flight)
+        if route["retry_policy"] not in self.retry_policies:
+            self.retry_policies.append(route["retry_policy"])
+
+    def _report_concurrency(self):
+        for agent in self.agents:
+            self.log_queue.put(f"[Concurrency] Settled: {self._concurrency_controller(agent).describe()}")
+            if isinstance(agent, HedgedAgent):
+                self.log_queue.put(f"{agent.log_label} {agent.describe()}")
+        if self.repair_stats["failed"]:
+            self.log_queue.put(f"[Repair] Recovered {self.repair_stats['recovered']} of {self.repair_stats['failed']} failed line(s) "
+                               f"using {sum(p.used for p in self.retry_policies)} follow-up request(s).")
+
+    def _chunk_done(self, route, i, chunk_results):
+        route["merged"].update(chunk_results)
+        route["done"] += 1
+        if route["on_chunk_done"] is not None:
+            try:
+                with trace_span("merge_chunk", "dispatch", chunk=i + 1, label=route["label"].strip()):
+                    route["on_chunk_done"](chunk_results)
+            except Exception as e:
+                self.log_queue.put(f"[Dispatcher] WARN: chunk callback failed: {e}")
+        self.log_queue.put(f"{route['label']}Finished LLM Chunk {i+1}/{route['total']} for {route['mode']}.")
+        if route["done"] == route["total"] and route["on_finished"] is not None:
+            try:
+                route["on_finished"]()
+            except Exception as e:
+                self.log_queue.put(f"[Dispatcher] WARN: completion callback failed: {e}")
+
+    def _failed_indices(self, route, indices, chunk_results):
+        return [idx for idx in indices if is_failed_result(route["mode"], chunk_results.get(idx + 1))]
+
+    def _next_repair(self, route, i, failed, attempt):
+        """Return the backoff delay for the next repair attempt, or None to stop"""
+        policy = route["retry_policy"]
+        if not failed or attempt >= policy.max_attempts:
+            return None
+        if not policy.try_consume():
+            self.log_queue.put(f"[Repair] {route['label']}Chunk {i+1}: retry budget exhausted; {len(failed)} line(s) keep placeholders.")
+            return None
+        delay = policy.delay(attempt)
+        self.log_queue.put(f"[Repair] {route['label']}Chunk {i+1}: re-requesting {len(failed)} failed line(s) {[idx + 1 for idx in failed[:5]]} "
+                           f"in {delay:.1f}s (attempt {attempt + 1}/{policy.max_attempts}).")
+        return delay
+
+    def _start_attempt(self, attempt):
+        """Tell the metrics that the next requests of this chunk are a follow-up, queued from now"""
+        context = _REQUEST_CONTEXT.get()
+        if context is not None:
+            context.update(attempt=attempt, queued_at=time.monotonic())
+
+    def _record_repair(self, initially_failed, still_failed):
+        with self.stats_lock:
+            self.repair_stats["failed"] += initially_failed
+            self.repair_stats["recovered"] += initially_failed - still_failed
+
+    def _repair(self, route, i, indices, chunk_results, method):
+        """Re-request only the failed lines of a chunk, with backoff, until fixed or out of attempts/budget"""
+        failed = self._failed_indices(route, indices, chunk_results)
+        initially_failed, attempt = len(failed), 0
+        delay = self._next_repair(route, i, failed, attempt)
+        while delay is not None:
+            with trace_span("repair_backoff", "dispatch", attempt=attempt + 1):
+                time.sleep(delay)
+            self._start_attempt(attempt + 1)
+            try:
+                args, kwargs = route["build_request"](failed)
+                chunk_results.update(method(*args, **kwargs))
+            except Exception as e:
+                chunk_results.update(route["error_result"](failed, e))
+            failed = self._failed_indices(route, failed, chunk_results)
+            attempt += 1
+            delay = self._next_repair(route, i, failed, attempt)
+        if initially_failed:
+            self._record_repair(initially_failed, len(failed))
+        return chunk_results
+
+    async def _arepair(self, route, i, indices, chunk_results, method):
+        failed = self._failed_indices(route, indices, chunk_results)
+        initially_failed, attempt = len(failed), 0
+        delay = self._next_repair(route, i, failed, attempt)
+        while delay is not None:
+            with trace_span("repair_backoff", "dispatch", attempt=attempt + 1):
+                await asyncio.sleep(delay)
+            self._start_attempt(attempt + 1)
+            try:
+                args, kwargs = route["build_request"](failed)
+                chunk_results.update(await method(*args, **kwargs))
+            except Exception as e:
+                chunk_results.update(route["error_result"](failed, e))
+            failed = self._failed_indices(route, failed, chunk_results)
+            attempt += 1
+            delay = self._next_repair(route, i, failed, attempt)
+        if initially_failed:
+            self._record_repair(initially_failed, len(failed))
+        return chunk_results
+
+    def _process_chunk(self, route, i, indices, queued_at=None):
+        method = self._agent_method(route, use_async=False)
+        token = _REQUEST_CONTEXT.set(request_context(route["metrics"], route["label"], i + 1, 0, queued_at))
+        trace_token = _TRACE.set(self.trace)
+        profile = self.profiler.thread_begin() if self.profiler is not None else None
+        self.log_queue.put(f"{route['label']}LLM Chunk {i+1}/{route['total']} ({route['mode']}): Sending {len(indices)} segments...")
+        try:
+            with trace_span("chunk", "dispatch", chunk=i + 1, segments=len(indices), label=route["label"].strip()):
+                try:
+                    with trace_span("build_request", "dispatch"):
+                        args, kwargs = route["build_request"](indices)
+                    chunk_results = method(*args, **kwargs)
+                except Exception as e:
+                    self.log_queue.put(f"{route['label']}LLM Chunk {i+1}/{route['total']} ({route['mode']}) failed: {e}")
+                    chunk_results = route["error_result"](indices, e)
+                return self._repair(route, i, indices, chunk_results, method)
+        finally:
+            if self.profiler is not None:
+                self.profiler.thread_end(profile)
+            _TRACE.reset(trace_token)
+            _REQUEST_CONTEXT.reset(token)  # pool threads are reused for other routes' chunks
+
+    async def _aprocess_chunk(self, semaphore, route, i, indices):
+        method = self._agent_method(route, use_async=True)
+        # each chunk runs in its own task, and so in its own copy of the context
+        _REQUEST_CONTEXT.set(request_context(route["metrics"], route["label"], i + 1, 0, time.monotonic()))
+        async with semaphore:
+            tracer = self.trace[0] if self.trace else None
+            lane = tracer.acquire_lane() if tracer is not None else None
+            _TRACE.set((tracer, lane) if tracer is not None else None)
+            self.log_queue.put(f"{route['label']}LLM Chunk {i+1}/{route['total']} ({route['mode']}): Sending {len(indices)} segments...")
+            try:
+                with trace_span("chunk", "dispatch", chunk=i + 1, segments=len(indices), label=route["label"].strip()):
+                    try:
+                        with trace_span("build_request", "dispatch"):
+                            args, kwargs = route["build_request"](indices)
+                        chunk_results = await method(*args, **kwargs)
+                    except Exception as e:
+                        self.log_queue.put(f"{route['label']}LLM Chunk {i+1}/{route['total']} ({route['mode']}) failed: {e}")
+                        chunk_results = route["error_result"](indices, e)
+                    return await self._arepair(route, i, indices, chunk_results, method)
+            finally:
+                if lane is not None:
+                    tracer.release_lane(lane)
+
+    def run(self, chunks, build_request, error_result):
+        """Process all chunks and return the merged {line_num: result} map.
+
+        chunks: list of original-document index lists, one per request.
+        build_request(indices) -> (args, kwargs) for the agent method.
+        error_result(indices, exc) -> placeholder results for a chunk that raised.
+        """
+        route = chunk_route(self.agent, self.mode, build_request, error_result, len(chunks), self.retry_policy, self.on_chunk_done)
+        self.run_routed((route, i, indices) for i, indices in enumerate(chunks))
+        return route["merged"]
+
+    def run_routed(self, items):
+        """Process (route, chunk number, indices) items; results land in each route's "merged" map.
+
+        items may be a generator: it is only advanced while fewer than twice max_in_flight chunks
+        are waiting, so the pool stays full without preparing every document up front.
+        """
+        if self.dispatch_mode == "asyncio":
+            return DISPATCH_LOOP.run(self.arun_routed(items))
+        self.trace, self.profiler = _TRACE.get(), _PROFILER.get()
+        items = iter(items)
+        backlog = 2 * self.max_in_flight
+        pending = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="LLMChunk") as pool:
+            def top_up():
+                while len(pending) < backlog:
+                    item = next(items, None)
+                    if item is None:
+                        return
+                    self._start_route(item[0])
+                    pending[pool.submit(self._process_chunk, *item, time.monotonic())] = item
+            top_up()
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    route, i, indices = pending.pop(future)
+                    try:
+                        chunk_results = future.result()
+                    except Exception as e:
+                        self.log_queue.put(f"{route['label']}LLM Chunk {i+1}/{route['total']} ({route['mode']}) failed: {e}")
+                        chunk_results = route["error_result"](indices, e)
+                    self._chunk_done(route, i, chunk_results)
+                top_up()
+        self._report_concurrency()
+
+    async def arun_routed(self, items):
+        """Async run_routed: chunk requests share the current event loop, bounded by a semaphore"""
+        self.trace, self.profiler = _TRACE.get(), _PROFILER.get()
+        items = iter(items)
+        backlog = 2 * self.max_in_flight
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        pending = {}
+        def top_up():
+            while len(pending) < backlog:
+                item = next(items, None)
+                if item is None:
+                    return
+                self._start_route(item[0])
+                pending[asyncio.ensure_future(self._aprocess_chunk(semaphore, *item))] = item
+        top_up()
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                route, i, indices = pending.pop(task)
+                try:
+                    chunk_results = task.result()
+                except Exception as e:
+                    self.log_queue.put(f"{route['label']}LLM Chunk {i+1}/{route['total']} ({route['mode']}) failed: {e}")
+                    chunk_results = route["error_result"](indices, e)
+                self._chunk_done(route, i, chunk_results)
+            top_up()
+        self._report_concurrency()
+
+# --- Bulk Mode (Provider Batch APIs) ---
+EXECUTION_MODES = ("interactive", "bulk")
+BATCH_POLL_SECONDS = 60
+BATCH_MAX_WAIT_SECONDS = 24 * 3600  # both providers finish (or expire) batches within 24h
+BATCH_STORE_SUFFIX = ".batches.json"
+
+class BatchAPIError(RuntimeError):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+def json_namespace(value):
+    """Give decoded JSON attribute access, so the agents' SDK response converters can read batch results"""
+    if isinstance(value, dict):
+        return types.SimpleNamespace(**{k: json_namespace(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return [json_namespace(v) for v in value]
+    return value
+
+class BatchTransport:
+    """Submit / poll / fetch for one provider's batch endpoint.
+
+    Talks to the documented REST API directly rather than through the SDK, so base_url can point
+    at a local stand-in server for testing. Providers are looked up in BATCH_TRANSPORTS.
+    """
+    provider = None
+    default_base_url = None
+    max_requests = 10000
+
+    def __init__(self, api_key, base_url=None, timeout=120):
+        self.api_key = api_key
+        self.base_url = (base_url or self.default_base_url).rstrip("/")
+        self.timeout = timeout
+
+    def _headers(self):
+        raise NotImplementedError
+
+    def _http(self, method, path, body=None, content_type="application/json"):
+        import urllib.request  # only bulk mode talks to the batch APIs
+        import urllib.error
+        if body is not None and content_type == "application/json":
+            body = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        headers = self._headers()
+        if body is not None:
+            headers["Content-Type"] = content_type
+        request = urllib.request.Request(f"{self.base_url}{path}", data=body, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            detail = e.read().decode("utf-8", "replace")[:500]
+            raise BatchAPIError(f"{self.provider} batch API {method} {path} failed: HTTP {e.code} {detail}", e.code)
+
+    def _json(self, method, path, body=None):
+        return json.loads(self._http(method, path, body).decode("utf-8"))
+
+    @staticmethod
+    def _jsonl(raw):
+        return [json.loads(line) for line in raw.decode("utf-8").splitlines() if line.strip()]
+
+    def submit(self, model_name, requests):
+        """requests: [(custom_id, payload)]. Returns the batch ID."""
+        raise NotImplementedError
+
+    def status(self, batch_id):
+        """Returns {"done": bool, "detail": str}"""
+        raise NotImplementedError
+
+    def results(self, batch_id):
+        """Returns {custom_id: (response body or None, error message or None)}"""
+        raise NotImplementedError
+
+class AnthropicBatchTransport(BatchTransport):
+    """Anthropic Message Batches API"""
+    provider = "Claude"
+    default_base_url = "https://api.anthropic.com/v1"
+    max_requests = 100000
+
+    def _headers(self):
+        return {"x-api-key": self.api_key, "anthropic-version": "2023-06-01"}
+
+    def submit(self, model_name, requests):
+        body = {"requests": [{"custom_id": custom_id, "params": dict(payload, model=model_name)}
+                             for custom_id, payload in requests]}
+        return self._json("POST", "/messages/batches", body)["id"]
+
+    def status(self, batch_id):
+        batch = self._json("GET", f"/messages/batches/{batch_id}")
+        counts = batch.get("request_counts") or {}
+        return {"done": batch.get("processing_status") == "ended",
+                "detail": f"{batch.get('processing_status')} ({counts.get('succeeded', 0)} succeeded, "
+                          f"{counts.get('processing', 0)} processing, {counts.get('errored', 0)} errored)"}
+
+    def results(self, batch_id):
+        results = {}
+        for item in self._jsonl(self._http("GET", f"/messages/batches/{batch_id}/results")):
+            result = item.get("result") or {}
+            if result.get("type") == "succeeded":
+                results[item["custom_id"]] = (result.get("message"), None)
+            else:
+                results[item["custom_id"]] = (None, f"{result.get('type')}: {json.dumps(result.get('error'))[:200]}")
+        return results
+
+class OpenAIBatchTransport(BatchTransport):
+    """OpenAI Batch API (JSONL file upload -> batch -> output/error files)"""
+    provider = "OpenAI"
+    default_base_url = "https://api.openai.com/v1"
+    max_requests = 50000
+    ENDPOINT = "/v1/chat/completions"
+
+    def _headers(self):
+        return {"Authorization": f"Bearer {self.api_key}"}
+
+    def _upload(self, filename, content):
+        boundary = f"----SupervertalerBatch{os.urandom(8).hex()}"
+        body = b"".join([
+            f'--{boundary}\r\nContent-Disposition: form-data; name="purpose"\r\n\r\nbatch\r\n'.encode("utf-8"),
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f'Content-Type: application/jsonl\r\n\r\n'.encode("utf-8"),
+            content, f"\r\n--{boundary}--\r\n".encode("utf-8")])
+        return json.loads(self._http("POST", "/files", body, f"multipart/form-data; boundary={boundary}").decode("utf-8"))["id"]
+
+    def submit(self, model_name, requests):
+        lines = [json.dumps({"custom_id": custom_id, "method": "POST", "url": self.ENDPOINT,
+                             "body": dict(payload, model=model_name)}, ensure_ascii=False)
+                 for custom_id, payload in requests]
+        file_id = self._upload("supervertaler_batch.jsonl", "\n".join(lines).encode("utf-8"))
+        return self._json("POST", "/batches", {"input_file_id": file_id, "endpoint": self.ENDPOINT,
+                                               "completion_window": "24h"})["id"]
+
+    def status(self, batch_id):
+        batch = self._json("GET", f"/batches/{batch_id}")
+        counts = batch.get("request_counts") or {}
+        return {"done": batch.get("status") in ("completed", "failed", "expired", "cancelled"),
+                "detail": f"{batch.get('status')} ({counts.get('completed', 0)}/{counts.get('total', 0)} completed, "
+                          f"{counts.get('failed', 0)} failed)"}
+
+    def results(self, batch_id):
+        batch = self._json("GET", f"/batches/{batch_id}")
+        results = {}
+        for file_key in ("output_file_id", "error_file_id"):
+            if not batch.get(file_key):
+                continue
+            for item in self._jsonl(self._http("GET", f"/files/{batch[file_key]}/content")):
+                response = item.get("response") or {}
+                if response.get("status_code") == 200 and not item.get("error"):
+                    results[item["custom_id"]] = (response.get("body"), None)
+                else:
+                    error = item.get("error") or response.get("body")
+                    results[item["custom_id"]] = (None, f"HTTP {response.get('status_code')}: {json.dumps(error)[:200]}")
+        return results
+
+# Gemini has no equivalent batch endpoint for these payloads (they carry PIL images and cached contents)
+BATCH_TRANSPORTS = {"Claude": AnthropicBatchTransport, "OpenAI": OpenAIBatchTransport}
+
+def create_batch_transport(provider, api_key, base_url=None):
+    transport_cls = BATCH_TRANSPORTS.get(provider)
+    return transport_cls(api_key, base_url) if transport_cls else None
+
+class BatchStore:
+    """Submitted bulk jobs, kept under "batches" in the project JSON (or in a sidecar file next to the
+    output when the run has no saved project), so a later run can pick up the same batch IDs."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, job_key):
+        return self.get_all().get(job_key)
+
+    def get_all(self):
+        return self._load().get("batches", {})
+
+    def put(self, job_key, record):
+        with self.lock:
+            data = self._load()
+            data.setdefault("batches", {})[job_key] = record
+            out = AtomicTextFile(self.path)
+            try:
+                out.write(json.dumps(data, indent=2, ensure_ascii=False))
+                out.commit()
+            except Exception:
+                out.abort()
+                raise
+
+class BulkBatchRunner:
+    """Sends the chunks of one or more documents as provider batch submissions instead of interactive requests.
+
+    Requests are built exactly as the interactive path builds them and the results go through the
+    agents' usual line-number parsers, so the output is interchangeable with an interactive run.
+    Batch IDs are stored before polling starts: re-running the same job (same requests) resumes
+    polling instead of paying for a second submission. With max_wait 0 the run only submits.
+
+    Each route (chunk_route() plus its "chunks") is one document; all routes must use
+    the same model, since an OpenAI batch may only address one.
+    """
+    def __init__(self, transport, log_queue, store, job_key, poll_interval=BATCH_POLL_SECONDS,
+                 max_wait=BATCH_MAX_WAIT_SECONDS):
+        self.transport = transport
+        self.log_queue = log_queue
+        self.store = store
+        self.job_key = job_key
+        self.poll_interval = max(1, poll_interval)
+        self.max_wait = max(0, max_wait)
+        self.pending = False  # True when the batch was still running at max_wait
+
+    def _chunk_done(self, route, chunk_results):
+        route["merged"].update(chunk_results)
+        if route["on_chunk_done"] is None:
+            return
+        try:
+            route["on_chunk_done"](chunk_results)
+        except Exception as e:
+            self.log_queue.put(f"[Bulk] WARN: chunk callback failed: {e}")
+
+    def _submit(self, agent, requests, digest):
+        items = sorted(requests.items())
+        batch_ids = []
+        for start in range(0, len(items), self.transport.max_requests):
+            part = items[start:start + self.transport.max_requests]
+            batch_id = self.transport.submit(agent.model_name, [(cid, request["payload"]) for cid, (route, request) in part])
+            batch_ids.append(batch_id)
+            self.log_queue.put(f"[Bulk] Submitted batch {batch_id} with {len(part)} request(s) to {self.transport.provider}.")
+        self.store.put(self.job_key, {"batch_ids": batch_ids, "provider": agent.provider, "model": agent.model_name,
+                                      "digest": digest, "requests": len(items), "status": "submitted",
+                                      "submitted": time.strftime("%Y-%m-%d %H:%M:%S")})
+        return batch_ids
+
+    def _wait(self, batch_ids):
+        """Poll until every batch has ended; False if max_wait ran out first"""
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            statuses = [self.transport.status(batch_id) for batch_id in batch_ids]
+            self.log_queue.put("[Bulk] " + "; ".join(f"{b}: {s['detail']}" for b, s in zip(batch_ids, statuses)))
+            if all(s["done"] for s in statuses):
+                return True
+            if time.monotonic() + self.poll_interval > deadline:
+                return False
+            time.sleep(self.poll_interval)
+
+    def run(self, routes):
+        """Send every chunk of every route; results land in each route's "merged" map"""
+        requests = {}
+        for r, route in enumerate(routes):
+            agent = route["agent"]
+            for i, indices in enumerate(route["chunks"]):
+                args, kwargs = route["build_request"](indices)
+                request = agent.prepare_chunk_request(*args, **kwargs)
+                if "result" in request:
+                    self._chunk_done(route, request["result"])
+                    continue
+                cached = agent._cached_response(request)
+                if cached is None:
+                    requests[f"d{r:04d}-c{i:05d}"] = (route, request)
+                else:
+                    self._chunk_done(route, agent.finish_chunk_response(request, cached))
+        if not requests:
+            return
+
+        agent = routes[0]["agent"]
+        digest = hashlib.sha256("".join(
+            cid + response_cache_key(agent.provider, agent.model_name, request["payload"])
+            for cid, (route, request) in sorted(requests.items())).encode("utf-8")).hexdigest()
+        record = self.store.get(self.job_key)
+        if record and record.get("status") == "submitted" and record.get("digest") == digest:
+            batch_ids = record["batch_ids"]
+            self.log_queue.put(f"[Bulk] Resuming batch(es) {', '.join(batch_ids)} submitted {record.get('submitted')}.")
+        else:
+            batch_ids = self._submit(agent, requests, digest)
+            record = self.store.get(self.job_key) or {}
+
+        if not self._wait(batch_ids):
+            self.pending = True
+            self.log_queue.put(f"[Bulk] Batch(es) still running; run bulk mode again later to collect "
+                               f"(IDs saved in {self.store.path}).")
+            for route, request in requests.values():
+                route["merged"].update(route["error_result"]([n - 1 for n in request["line_nums"]], "batch still running"))
+            return
+
+        collected = {}
+        for batch_id in batch_ids:
+            collected.update(self.transport.results(batch_id))
+        failed = 0
+        for cid, (route, request) in sorted(requests.items()):
+            body, error = collected.get(cid, (None, "no result returned"))
+            if body is None:
+                failed += 1
+                chunk_results = route["error_result"]([n - 1 for n in request["line_nums"]], error)
+            else:
+                agent = route["agent"]
+                response = agent._response_dict(json_namespace(body))
+                agent._log_cache_usage(response)
+                agent._store_response(request, response)
+                chunk_results = agent.finish_chunk_response(request, response)
+            self._chunk_done(route, chunk_results)
+        self.log_queue.put(f"[Bulk] Collected {len(requests) - failed} of {len(requests)} request(s)"
+                           + (f"; {failed} failed." if failed else "."))
+        self.store.put(self.job_key, dict(record, status="collected", collected=time.strftime("%Y-%m-%d %H:%M:%S")))
+
+# --- Headless Engine ---
+EXIT_SUCCESS, EXIT_FAILED, EXIT_USAGE, EXIT_PARTIAL = 0, 1, 2, 3
+RESULT_EXIT_CODES = {"success": EXIT_SUCCESS, "partial": EXIT_PARTIAL, "error": EXIT_FAILED}
+
+def default_projects_dir():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "projects")
+
+def load_drawing_images(folder_path, log_queue, pool=None):
+    """Load figure images from a folder into {normalized figure ref: PIL.Image}
+
+    With a CPU pool the images are also PNG-encoded up front in worker processes, so the
+    Claude/OpenAI request builders find them in the encoded-image cache.
+    """
+    if not PIL_AVAILABLE or not folder_path: log_queue.put("[Drawings] Pillow lib not avail or no folder path."); return {}
+    loaded_images_map = {}; log_queue.put(f"[Drawings] Loading images from: {folder_path}")
+    valid_extensions = ('.png', '.jpg', '.jpeg', '.webp'); count = 0
+    fnames = [fname for fname in os.listdir(folder_path) if fname.lower().endswith(valid_extensions)]
+    encoded = dict(zip(fnames, run_cpu_tasks(drawing_task, [(os.path.join(folder_path, fname),) for fname in fnames], pool, log_queue)
+                       if pool is not None and len(fnames) > 1 else []))
+    for fname in fnames:
+        try:
+            base_name = os.path.splitext(fname)[0]; normalized_ref = normalize_figure_ref(base_name)
+            if normalized_ref: img = Image.open(os.path.join(folder_path, fname)); loaded_images_map[normalized_ref] = img; log_queue.put(f"[Drawings] Loaded '{fname}' as Fig Ref '{normalized_ref}'."); count += 1
+            else: log_queue.put(f"[Drawings] Could not normalize: {fname}"); continue
+            png_b64, error = encoded.get(fname, (None, None))
+            if png_b64: remember_base64_png(img, png_b64)
+            elif error: log_queue.put(f"[Drawings] Could not pre-encode {fname}: {error}")
+        except Exception as e_img: log_queue.put(f"[Drawings] Err loading img {fname}: {e_img}")
+    log_queue.put(f"[Drawings] Loaded {count} images" + (f" ({sum(1 for e, _ in encoded.values() if e)} pre-encoded in worker processes)." if encoded else "."))
+    return loaded_images_map
+
+SETTING_TRUE, SETTING_FALSE = ("true", "1", "yes", "on"), ("false", "0", "no", "off", "")
+
+def parse_setting_bool(value, label):
+    """A saved boolean setting (bool, 0/1, or a string such as "true"/"false") as a bool; ValueError otherwise"""
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in SETTING_TRUE: return True
+    if text in SETTING_FALSE: return False
+    raise ValueError(f"Invalid {label} setting '{value}' (use true or false).")
+
+def parse_run_settings(settings, provider):
+    """Validate project-style settings (string values, as saved by the GUI) into TranslationEngine.run kwargs.
+
+    Raises ValueError with a user-facing message on invalid values.
+    """
+    try: chunk_s = int(settings.get("chunk_size", "100")); assert chunk_s > 0
+    except (ValueError, TypeError, AssertionError): raise ValueError("Invalid Chunk Size.")
+    parallel_s = str(settings.get("parallel_requests", "auto")).strip()
+    if parallel_s and parallel_s.lower() != "auto":
+        try: assert int(parallel_s) > 0
+        except (ValueError, AssertionError): raise ValueError("Invalid Parallel Requests (use a positive number or 'auto').")
+    try: retry_attempts = int(settings.get("retry_attempts", "3")); assert retry_attempts >= 0
+    except (ValueError, TypeError, AssertionError): raise ValueError("Invalid Retry Attempts (use 0 to disable).")
+    try: context_token_cap = int(settings.get("context_token_cap", DEFAULT_CONTEXT_TOKEN_CAP)); assert context_token_cap >= 500
+    except (ValueError, TypeError, AssertionError): raise ValueError("Invalid Context Token Cap (minimum 500).")
+    execution = settings.get("execution", "interactive")
+    if execution not in EXECUTION_MODES: raise ValueError(f"Invalid execution mode '{execution}' (use interactive or bulk).")
+    if execution == "bulk" and provider not in BATCH_TRANSPORTS:
+        raise ValueError(f"Bulk mode needs a provider batch API ({', '.join(BATCH_TRANSPORTS)}); {provider} has none.")
+    try:
+        batch_options = {"base_url": settings.get("batch_base_url") or None,
+                         "poll_interval": float(settings.get("batch_poll_seconds", BATCH_POLL_SECONDS)),
+                         "max_wait": float(settings.get("batch_max_wait", BATCH_MAX_WAIT_SECONDS))}
+        assert batch_options["poll_interval"] > 0 and batch_options["max_wait"] >= 0
+    except (ValueError, TypeError, AssertionError): raise ValueError("Invalid batch poll interval / max wait (seconds).")
+    dispatch_mode = settings.get("dispatch_mode", "threads")
+    if dispatch_mode not in LLMChunkDispatcher.DISPATCH_MODES:
+        raise ValueError(f"Invalid dispatch mode '{dispatch_mode}' (use {', '.join(LLMChunkDispatcher.DISPATCH_MODES)}).")
+    context_strategy = settings.get("context_strategy", "full")
+    if context_strategy not in CONTEXT_STRATEGIES:
+        raise ValueError(f"Invalid context strategy '{context_strategy}' (use {', '.join(CONTEXT_STRATEGIES)}).")
+    profile = settings.get("profile") or "off"
+    if profile not in PROFILERS: raise ValueError(f"Invalid profiler '{profile}' (use {', '.join(PROFILERS)}).")
+    failover_provider, failover_model = settings.get("failover_provider") or None, settings.get("failover_model") or None
+    if failover_provider and failover_provider not in ("Claude", "Gemini", "OpenAI", "Mock"):
+        raise ValueError(f"Unknown failover provider '{failover_provider}'.")
+    if failover_provider and not failover_model: raise ValueError("Please select a failover model for the failover provider.")
+    try: hedge_percentile = float(settings.get("hedge_percentile", HEDGE_PERCENTILE)); assert hedge_percentile == 0 or 50 <= hedge_percentile < 100
+    except (ValueError, TypeError, AssertionError): raise ValueError("Invalid Hedge Percentile (50-99.9, or 0 to only fail over).")
+    return {
+        "chunk_s": chunk_s,
+        "max_in_flight": get_provider_max_in_flight(provider, None if parallel_s.lower() in ("", "auto") else parallel_s),
+        "dispatch_mode": dispatch_mode,
+        "retry_attempts": retry_attempts,
+        "context_strategy": context_strategy,
+        "context_token_cap": context_token_cap,
+        "use_response_cache": parse_setting_bool(settings.get("use_response_cache", True), "Response Cache"),
+        "streaming": parse_setting_bool(settings.get("streaming", False), "Streaming"),
+        "execution": execution,
+        "batch_options": batch_options,
+        "write_metrics": parse_setting_bool(settings.get("write_metrics", False), "Write Metrics"),
+        "trace": parse_setting_bool(settings.get("trace", False), "Trace"),
+        "resume": parse_setting_bool(settings.get("resume", False), "Resume"),
+        "profile": profile,
+        "failover_provider": failover_provider,
+        "failover_model": failover_model,
+        "hedge_percentile": hedge_percentile,
+    }
+
+OUTPUT_SUFFIXES = {"Translate": "_translated", "Proofread": "_proofread"}
+
+def default_output_path(input_f, mode, output_dir=None):
+    """<input>_translated.txt / <input>_proofread.txt, next to the input or in output_dir"""
+    base, ext = os.path.splitext(input_f)
+    if output_dir:
+        base = os.path.join(output_dir, os.path.basename(base))
+    return f"{base}{OUTPUT_SUFFIXES.get(mode, '_output')}{ext or '.txt'}"
+
+def collect_job_inputs(paths):
+    """Expand input files and folders (their .txt files, sorted, not recursive) into a list of input files.
+
+    Files that look like earlier outputs (*_translated.txt, *_proofread.txt) are skipped in folders.
+    """
+    inputs = []
+    for path in paths:
+        if not os.path.isdir(path):
+            inputs.append(path)
+            continue
+        for name in sorted(os.listdir(path)):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() == ".txt" and not stem.endswith(tuple(OUTPUT_SUFFIXES.values())) and os.path.isfile(os.path.join(path, name)):
+                inputs.append(os.path.join(path, name))
+    return inputs
+
+def queue_exit_code(results):
+    statuses = {r["status"] for r in results}
+    if statuses <= {"success"}:
+        return EXIT_SUCCESS
+    return EXIT_FAILED if statuses == {"error"} else EXIT_PARTIAL
+
+class TranslationEngine:
+    """Headless pipeline (ingest -> TM -> LLM -> output) shared by the GUI, the CLI and batch callers.
+
+    Never touches tkinter: errors and outcomes come back as result dicts, progress goes to
+    log_queue (anything with put()) and the optional on_progress(text) callback.
+    on_row(line_num, source, target, comment) is called as each output row becomes final
+    (in completion order: TM hits first, then LLM lines as their chunks finish).
+    agents: a dict shared with other engines (e.g. the job service's workers) so they reuse
+    the same agents and SDK clients; agents then log to agent_log_queue.
+    """
+    def __init__(self, api_keys, log_queue, tm_agent=None, tracked_changes_agent=None, projects_dir=None, on_progress=None,
+                 cpu_workers=None, on_row=None, agents=None, agent_log_queue=None):
+        self.api_keys = api_keys
+        self.log_queue = log_queue
+        self.tm_agent = tm_agent or TMAgent(log_queue)
+        self.tracked_changes_agent = tracked_changes_agent or TrackedChangesAgent(log_queue)
+        self.projects_dir = projects_dir or default_projects_dir()
+        self.on_progress = on_progress
+        self.agents = {} if agents is None else agents  # shared across runs and jobs, see _get_agent
+        self.shares_agents = agents is not None  # other engines may be using the same agents right now
+        self.agent_log_queue = agent_log_queue or log_queue
+        self.on_row = on_row
+        self.loaded_tm = None      # (tm_file, source_lang, target_lang) this engine last loaded
+        self.drawings_cache = {}   # drawings folder -> {figure ref: image}
+        self.cpu_workers = cpu_workers  # worker processes for parsing/encoding in run_jobs (None = one per core)
+
+    def _progress(self, text):
+        if self.on_progress is not None:
+            self.on_progress(text)
+
+    def _result(self, status, mode, input_f, output_f, file_ok=False, segments=0, tm_hits=0, llm_segments=0,
+                modified_lines=0, message="", error_title=None, elapsed=0.0, metrics=None, metrics_file=None, tmx_file=None):
+        """tmx_file: the TMX this run committed (see StreamingOutputWriter.tmx_path), if any"""
+        return {"status": status, "exit_code": RESULT_EXIT_CODES[status], "mode": mode, "input_file": input_f,
+                "output_file": output_f if file_ok else None, "tmx_file": tmx_file if file_ok else None,
+                "segments": segments, "tm_hits": tm_hits, "llm_segments": llm_segments, "modified_lines": modified_lines,
+                "message": message, "error_title": error_title, "elapsed_seconds": round(elapsed, 3),
+                "metrics": metrics, "metrics_file": metrics_file}
+
+    def _error(self, title, message, mode, input_f, output_f):
+        return self._result("error", mode, input_f, output_f, message=message, error_title=title)
+
+    def run_project(self, project_data, overrides=None, project_path=None):
+        """Run a saved project (dict as written by the GUI's Save Project), with optional overrides.
+
+        overrides may replace any "settings" key plus input_file, output_file, tm_file and drawings_folder.
+        project_path is where bulk mode records its batch IDs (under "batches").
+        """
+        job = self._resolve_job(project_data, overrides, project_path)
+        if "status" in job:
+            return job
+        return self._load_job_resources(job) or self.run(**job["run"])
+
+    def run_jobs(self, project_data, jobs, project_path=None):
+        """Run many documents as one queue; jobs is a list of overrides dicts (as for run_project).
+
+        Agents (and so their SDK clients), the TM, the drawings and the tracked-changes index are
+        loaded once and shared. The chunks of all interactive jobs go through one dispatcher, which
+        opens the next document while the last chunks of the previous one are still in flight;
+        bulk jobs are pooled into one batch per provider/model. Returns one result dict per job.
+
+        With more than one CPU worker, upcoming documents are read and the TM/DOCX/drawings are
+        parsed in worker processes (see get_cpu_pool) while earlier documents are being sent.
+        A trace or profile (any job's trace / profile setting) covers the whole queue and is saved
+        as jobs.trace.json / jobs.profile.txt next to the first job's output.
+        """
+        resolved = [self._resolve_job(project_data, overrides, project_path) for overrides in jobs]
+        runs = [job["run"] for job in resolved if "status" not in job]
+        trace = any(run["trace"] for run in runs)
+        profile = next((run["profile"] for run in runs if run["profile"] != "off"), "off")
+        base_path = os.path.join(os.path.dirname(os.path.abspath(runs[0]["output_f"])), "jobs") if runs else ""
+        with RunDiagnostics(base_path, f"{len(jobs)} job(s)", trace, profile, self.log_queue):
+            return self._run_jobs(resolved)
+
+    def _run_jobs(self, resolved):
+        total = len(resolved)
+        results = [job if "status" in job else None for job in resolved]
+        outputs = {}
+        for k, job in enumerate(resolved):
+            if results[k] is None:
+                output_f = os.path.abspath(job["run"]["output_f"])
+                if output_f in outputs:
+                    results[k] = self._error("File Error", f"Output file is already written by job {outputs[output_f] + 1}.",
+                                             job["run"]["mode"], job["run"]["input_f"], job["run"]["output_f"])
+                outputs.setdefault(output_f, k)
+        ready = [(k, job) for k, job in enumerate(resolved) if results[k] is None]
+        self.log_queue.put(f"[Jobs] {len(ready)} of {total} job(s) queued"
+                           + (f"; {total - len(ready)} rejected (see results)." if len(ready) < total else "."))
+
+        queue_metrics = RunMetrics(log_queue=self.log_queue, label="Queue")
+        pool = get_cpu_pool(self.cpu_workers) if len(ready) > 1 else None
+        lookahead = 2 * resolve_cpu_workers(self.cpu_workers)
+        order = [k for k, job in ready if job["run"]["execution"] == "bulk"] + [k for k, job in ready if job["run"]["execution"] != "bulk"]
+        ingests = {}  # job number -> future of ingest_task
+
+        def ingest(k):
+            """Segment data of job k from the worker pool (queueing the next few documents), or None to read it in-process"""
+            if pool is None:
+                return None
+            position = order.index(k)
+            try:
+                for n in order[position:position + lookahead]:
+                    if n not in ingests:
+                        ingests[n] = pool.submit(ingest_task, resolved[n]["run"]["input_f"], resolved[n]["run"]["mode"])
+                with trace_span("ingest_wait", "stage", job=k + 1):
+                    data, messages = ingests.pop(k).result()
+            except concurrent.futures.process.BrokenProcessPool as e:
+                self.log_queue.put(f"[Workers] Process pool failed ({e}); reading {os.path.basename(resolved[k]['run']['input_f'])} in-process.")
+                ingests.pop(k, None)
+                return None
+            for message in messages:
+                self.log_queue.put(message)
+            return data
+
+        def open_job(k, job):
+            preloaded = ingest(k)
+            error = self._load_job_resources(job, pool)
+            opened = error or self._open_job(label=f"[Job {k+1}/{total}] ", shared=True, preloaded=preloaded,
+                                             parent_metrics=queue_metrics, **job["run"])
+            if "status" in opened:
+                results[k] = opened
+                return None
+            opened["number"] = k
+            return opened
+
+        def finish(job):
+            results[job["number"]] = result = self._close_job(job)
+            done = sum(1 for r in results if r is not None)
+            self.log_queue.put(f"[Jobs] {done}/{total} done: {os.path.basename(job['input_f'])} -> {result['status']}.")
+            self._progress(f"Jobs: {done}/{total} done")
+
+        bulk_jobs = [opened for opened in (open_job(k, job) for k, job in ready if job["run"]["execution"] == "bulk") if opened]
+        work = [(job, chunks, attempts, lambda job=job: finish(job)) for job, chunks, attempts in
+                self._run_bulk([job for job in bulk_jobs if job["chunks"]])]
+        for job in bulk_jobs:
+            if not any(job is w[0] for w in work):
+                finish(job)
+
+        def interactive_work():
+            for k, job in ready:
+                if job["run"]["execution"] == "bulk":
+                    continue
+                opened = open_job(k, job)
+                if opened is None:
+                    continue
+                if not opened["chunks"]:
+                    finish(opened)
+                    continue
+                yield opened, opened["chunks"], opened["retry_attempts"], lambda job=opened: finish(job)
+
+        runs = [job["run"] for k, job in ready]
+        if runs:
+            # One pool for the whole queue, as wide as the widest job allows
+            self._dispatch(itertools.chain(work, interactive_work()), max(r["max_in_flight"] or 1 for r in runs),
+                           runs[0]["dispatch_mode"])
+        cache = get_response_cache(os.path.join(self.projects_dir, RESPONSE_CACHE_FILENAME)) if any(r["use_response_cache"] for r in runs) else None
+        if cache is not None and cache.hits:
+            self.log_queue.put(f"[Cache] {cache.hits} request(s) served from the response cache ({cache.path}).")
+        summary = queue_metrics.close()
+        if summary["requests"]:
+            self.log_queue.put(f"[Metrics] Queue: {queue_metrics.describe(summary)}")
+        statuses = [r["status"] for r in results]
+        self.log_queue.put(f"[Jobs] Finished: {statuses.count('success')} success, {statuses.count('partial')} partial, "
+                           f"{statuses.count('error')} failed.")
+        return results
+
+    def _resolve_job(self, project_data, overrides=None, project_path=None):
+        """Project settings + overrides -> {"run": run() kwargs, "tm_file", "drawings_folder"}, or an error result"""
+        overrides = {k: v for k, v in (overrides or {}).items() if v is not None}
+        settings = dict(project_data.get("settings", {}))
+        file_paths = dict(project_data.get("file_paths", {}))
+        for key, value in overrides.items():
+            (file_paths if key in ("input_file", "output_file", "tm_file", "drawings_folder") else settings)[key] = value
+        mode = settings.get("mode", "Translate")
+        provider, model_name = settings.get("provider", "Claude"), settings.get("model", "")
+        input_f, output_f = file_paths.get("input_file", ""), file_paths.get("output_file", "")
+        source_lang, target_lang = settings.get("source_lang", "Dutch"), settings.get("target_lang", "English")
+        if mode not in ("Translate", "Proofread"):
+            return self._error("Error", f"Unknown mode '{mode}' (use Translate or Proofread).", mode, input_f, output_f)
+        if not provider or not model_name:
+            return self._error("Error", "Please select both AI provider and model", mode, input_f, output_f)
+        if not input_f or not output_f:
+            return self._error("File Error", "Select input & output files.", mode, input_f, output_f)
+        try:
+            run_kwargs = parse_run_settings(settings, provider)
+        except ValueError as e:
+            return self._error("Error", str(e), mode, input_f, output_f)
+        drawings_folder = file_paths.get("drawings_folder", "")
+        if drawings_folder and not PIL_AVAILABLE:
+            return self._error("Image Error", "Pillow (PIL) library needed for drawings folder feature.", mode, input_f, output_f)
+        prompts = project_data.get("prompts", {})
+        run_kwargs.update(mode=mode, input_f=input_f, output_f=output_f, source_lang=source_lang, target_lang=target_lang,
+                          provider=provider, model_name=model_name,
+                          user_custom_instructions=project_data.get("content", {}).get("custom_instructions", ""),
+                          custom_system_prompt=prompts.get("current_translate" if mode == "Translate" else "current_proofread") or None,
+                          project_path=project_path)
+        return {"run": run_kwargs, "tm_file": file_paths.get("tm_file", ""), "drawings_folder": drawings_folder}
+
+    def _load_job_resources(self, job, pool=None):
+        """Load the job's TM and drawings unless the previous job already did; returns an error result or None"""
+        run = job["run"]
+        tm_key = (job["tm_file"], run["source_lang"], run["target_lang"]) if run["mode"] == "Translate" and job["tm_file"] else None
+        if tm_key != self.loaded_tm:
+            if tm_key:
+                with trace_span("load_tm", "stage", tm_file=os.path.basename(tm_key[0])):
+                    self.tm_agent.load_tm(*tm_key, pool=pool)
+            elif self.loaded_tm:
+                self.tm_agent.tm_data = {}  # only forget a TM this engine loaded itself
+            self.loaded_tm = tm_key
+        folder = job["drawings_folder"]
+        if folder and folder not in self.drawings_cache:
+            try:
+                with trace_span("load_drawings", "stage", folder=folder):
+                    self.drawings_cache[folder] = load_drawing_images(folder, self.log_queue, pool)
+            except OSError as e:
+                return self._error("Drawings Folder Error", f"Could not read drawings folder: {e}", run["mode"], run["input_f"], run["output_f"])
+        run["drawings_map"] = self.drawings_cache[folder] if folder else {}
+        return None
+
+    def _get_hedged_agent(self, primary, mode, provider, model_name, use_response_cache, streaming, hedge_percentile):
+        """primary with a fallback agent (see HedgedAgent), reused across runs; primary alone if the fallback cannot start"""
+        key = ("hedged", id(primary), provider, model_name, hedge_percentile)
+        if key in self.agents:
+            return self.agents[key]
+        api_key = provider_api_key(self.api_keys, provider)
+        fallback = self._get_agent(mode, provider, model_name, api_key, use_response_cache, streaming) if api_key else None
+        if not fallback or not fallback.model:
+            self.log_queue.put(f"[Failover] {provider}/{model_name} unavailable (API key or library missing); running without failover.")
+            return primary
+        agent = self.agents[key] = create_hedged_agent(primary, fallback, self.agent_log_queue, hedge_percentile)
+        return agent
+
+    def _get_agent(self, mode, provider, model_name, api_key, use_response_cache, streaming):
+        """One agent (and so one SDK client) per mode, provider, model and request settings, reused across runs"""
+        key = (mode, provider, model_name, api_key, use_response_cache, streaming)
+        agent = self.agents.get(key)
+        if agent is not None:
+            return agent
+        factory = create_translation_agent if mode == "Translate" else create_proofreading_agent
+        agent = factory(provider, api_key, self.agent_log_queue, model_name)
+        if not agent or not agent.model:
+            return agent
+        if use_response_cache:
+            try:
+                agent.response_cache = get_response_cache(os.path.join(self.projects_dir, RESPONSE_CACHE_FILENAME))
+            except Exception as e:
+                self.log_queue.put(f"[Cache] Response cache unavailable ({e}); all requests go to {provider}.")
+        agent.streaming = streaming
+        self.agents[key] = agent
+        return agent
+
+    def _dispatch(self, work, max_in_flight, dispatch_mode):
+        """Send chunks interactively; work yields (job, chunks, retry_attempts, on_finished) and is consumed lazily"""
+        dispatcher = LLMChunkDispatcher(None, None, self.log_queue, max_in_flight, dispatch_mode)
+        def items():
+            for job, chunks, retry_attempts, on_finished in work:
+                # Follow-up requests for failed lines: at most retry_attempts per chunk, and a per-document
+                # budget of one follow-up per chunk (minimum 5) so a broken provider cannot loop forever
+                route = chunk_route(job["agent"], job["mode"], job["build_request"], job["error_result"], len(chunks),
+                                    RetryPolicy(max_attempts=retry_attempts, budget=max(5, len(chunks))),
+                                    job["on_chunk_done"], on_finished, job["label"], job["metrics"])
+                for i, indices in enumerate(chunks):
+                    yield route, i, indices
+        with trace_span("dispatch", "stage", max_in_flight=max_in_flight, mode=dispatch_mode):
+            dispatcher.run_routed(items())
+
+    def _run_bulk(self, jobs):
+        """Send the jobs' chunks as provider batches, one per provider/model.
+
+        Returns [(job, chunks, retry_attempts)] holding the failed lines left for interactive top-up.
+        """
+        groups = {}
+        for job in jobs:
+            key = (job["agent"].provider, job["agent"].model_name, job["api_key"], job["batch_options"].get("base_url"))
+            groups.setdefault(key, []).append(job)
+        leftovers = []
+        for (provider, model_name, api_key, base_url), group in groups.items():
+            first, options = group[0], group[0]["batch_options"]
+            store = BatchStore(first["project_path"] or first["output_f"] + BATCH_STORE_SUFFIX)
+            if len(group) == 1:
+                job_key = f"{first['mode']}:{os.path.abspath(first['output_f'])}"
+            else:
+                outputs = "\n".join(os.path.abspath(job["output_f"]) for job in group)
+                job_key = "jobs:" + hashlib.sha256(outputs.encode("utf-8")).hexdigest()[:16]
+            runner = BulkBatchRunner(create_batch_transport(provider, api_key, base_url), self.log_queue, store, job_key,
+                                     options.get("poll_interval", BATCH_POLL_SECONDS),
+                                     options.get("max_wait", BATCH_MAX_WAIT_SECONDS))
+            routes = []
+            for job in group:
+                top_up = job["retry_attempts"] > 0
+                def on_batch_chunk_done(results, job=job, top_up=top_up):
+                    # Failed lines are written once their interactive top-up is done, not now
+                    job["on_chunk_done"]({n: v for n, v in results.items() if not (top_up and is_failed_result(job["mode"], v))})
+                route = chunk_route(job["agent"], job["mode"], job["build_request"], job["error_result"], len(job["chunks"]),
+                                    on_chunk_done=on_batch_chunk_done, label=job["label"], metrics=job["metrics"])
+                route["chunks"] = job["chunks"]
+                routes.append(route)
+            try:
+                with trace_span("bulk_batch", "network", provider=provider, model=model_name, documents=len(group)):
+                    runner.run(routes)
+            except (BatchAPIError, OSError, ValueError, KeyError) as e:
+                self.log_queue.put(f"[Bulk] ERROR: {e}")
+                runner.pending = True  # nothing is known about the batch; do not pay for the same lines twice
+                for job, route in zip(group, routes):
+                    for indices in job["chunks"]:
+                        route["merged"].update(job["error_result"](indices, e))
+            for job, route in zip(group, routes):
+                job["keep_results"](route["merged"])
+                if runner.pending or job["retry_attempts"] <= 0:
+                    continue
+                failed = [[idx for idx in indices if is_failed_result(job["mode"], route["merged"].get(idx + 1))]
+                          for indices in job["chunks"]]
+                failed = [indices for indices in failed if indices]
+                if failed:
+                    self.log_queue.put(f"[Bulk] {job['label']}Sending {sum(len(c) for c in failed)} line(s) without a usable batch result interactively.")
+                    # the batch itself was the first attempt for these lines
+                    leftovers.append((job, failed, job["retry_attempts"] - 1))
+        return leftovers
+
+    def run(self, mode, input_f, output_f, source_lang, target_lang, provider, model_name, chunk_s, drawings_map, user_custom_instructions, custom_system_prompt=None, max_in_flight=None, dispatch_mode="threads", retry_attempts=3, context_strategy="full", context_token_cap=DEFAULT_CONTEXT_TOKEN_CAP, use_response_cache=True, resume=False, streaming=False, execution="interactive", batch_options=None, project_path=None, write_metrics=False, trace=False, profile="off", failover_provider=None, failover_model=None, hedge_percentile=HEDGE_PERCENTILE):
+        """Ingest -> TM -> LLM -> output for one file. Returns a result dict (see _result).
+
+        execution "bulk" sends the chunks through the provider's batch API (see BulkBatchRunner);
+        batch_options: base_url, poll_interval, max_wait.
+        trace / profile ("cprofile" or "sampling"): save a stage trace / profiler report next to the output (see RunDiagnostics).
+        failover_provider / failover_model: hedge slow calls and fail over to this agent (see HedgedAgent).
+        """
+        with RunDiagnostics(output_f, f"{mode} {os.path.basename(input_f)}", trace, profile, self.log_queue):
+            job = self._open_job(mode, input_f, output_f, source_lang, target_lang, provider, model_name, chunk_s, drawings_map,
+                                 user_custom_instructions, custom_system_prompt, max_in_flight, dispatch_mode, retry_attempts,
+                                 context_strategy, context_token_cap, use_response_cache, resume, streaming, execution,
+                                 batch_options, project_path, write_metrics=write_metrics, failover_provider=failover_provider,
+                                 failover_model=failover_model, hedge_percentile=hedge_percentile)
+            if "status" in job:
+                return job
+            if job["chunks"]:
+                if execution == "bulk":
+                    work = [(j, chunks, attempts, None) for j, chunks, attempts in self._run_bulk([job])]
+                else:
+                    work = [(job, job["chunks"], retry_attempts, None)]
+                if work:
+                    self._dispatch(work, job["workers"], dispatch_mode)
+            return self._close_job(job)
+
+    def _open_job(self, mode, input_f, output_f, source_lang, target_lang, provider, model_name, chunk_s, drawings_map, user_custom_instructions, custom_system_prompt=None, max_in_flight=None, dispatch_mode="threads", retry_attempts=3, context_strategy="full", context_token_cap=DEFAULT_CONTEXT_TOKEN_CAP, use_response_cache=True, resume=False, streaming=False, execution="interactive", batch_options=None, project_path=None, write_metrics=False, trace=False, profile="off", failover_provider=None, failover_model=None, hedge_percentile=HEDGE_PERCENTILE, label="", shared=False, preloaded=None, parent_metrics=None):
+        """Ingest, TM, checkpoint replay, output writer and chunk plan for one file.
+
+        Returns the job dict the dispatch and _close_job steps work on, or an error result.
+        shared: the job's agent serves several documents at once (job queue), so streamed lines
+        are not reported per document.
+        preloaded: the input's segment data, already read by ingest_task in a worker process.
+        write_metrics: record every LLM request in <output>.metrics.jsonl (see RunMetrics);
+        parent_metrics also receives them (the queue's totals).
+        """
+        started = time.monotonic()
+        shared = shared or self.shares_agents
+        ingestor = BilingualFileIngestionAgent(); output_gen = OutputGenerationAgent()
+        
+        with trace_span("ingest", "stage", file=os.path.basename(input_f), preloaded=preloaded is not None):
+            all_original_data = preloaded if preloaded is not None else ingestor.process(input_f, self.log_queue, mode=mode)
+        if not all_original_data: self.log_queue.put("No data from input file."); return self._error("Input Err", "No data in input file.", mode, input_f, output_f)
+
+        source_segments_original = []
+        original_target_segments = [] 
+        original_comments = []    
+
+        api_key = provider_api_key(self.api_keys, provider)
+        if not api_key:
+            self.log_queue.put(f"No API key available for {provider}")
+            return self._error("API Key Error", f"No API key configured for {provider}", mode, input_f, output_f)
+        if execution == "bulk" and provider not in BATCH_TRANSPORTS:
+            return self._error("Error", f"Bulk mode is not available for {provider}.", mode, input_f, output_f)
+
+        agent = self._get_agent(mode, provider, model_name, api_key, use_response_cache, streaming)
+        if agent and agent.model and failover_provider and (failover_provider, failover_model) != (provider, model_name):
+            agent = self._get_hedged_agent(agent, mode, failover_provider, failover_model, use_response_cache, streaming,
+                                           hedge_percentile)
+        if mode == "Translate":
+            source_segments_original = all_original_data
+            if not agent or not agent.model: self.log_queue.put("Translator init fail."); return self._error("Model Err", "Translator model init failed.", mode, input_f, output_f)
+        elif mode == "Proofread":
+            if not agent or not agent.model: self.log_queue.put("Proofreader init fail."); return self._error("Model Err", "Proofreader model init failed.", mode, input_f, output_f)
+            for item in all_original_data:
+                source_segments_original.append(item["source"])
+                original_target_segments.append(item["target"])
+                original_comments.append(item["comment"]) 
+
+        final_output_targets_or_proofread_results = [None] * len(source_segments_original)
+        tm_hits = 0
+        llm_processed_map = {}  # LLM/journal results of lines whose row is not written yet (emptied as rows are written)
+
+        if mode == "Translate":
+            if self.tm_agent.tm_data:
+                self.log_queue.put(f"[TM] Applying {len(self.tm_agent.tm_data)} TM entries...")
+                with trace_span("apply_tm", "stage", segments=len(source_segments_original)):
+                    for i, seg in enumerate(source_segments_original):
+                        tm_tgt = self.tm_agent.get_translation(seg)
+                        if tm_tgt is not None: final_output_targets_or_proofread_results[i] = tm_tgt; tm_hits += 1
+                self.log_queue.put(f"[TM] Applied TM to {tm_hits} segments.")
+            else: self.log_queue.put("[TM] No TM data or file not specified.")
 
-        results = []
-        for item in lines_data:
-            line_num = item.get("line_num")
-            original_target = item.get("target", "")
-            entry = {
-                "line_num": line_num,
-                "source": item.get("source", ""),
-                "original_target": original_target,
-                "comment": item.get("comment", "")
-            }
-            if line_num in parsed_translations and parsed_translations[line_num]:
-                entry["revised_target"] = parsed_translations[line_num]
-                entry["changes_summary"] = "Revised by OpenAI" if parsed_translations[line_num] != original_target else "No changes needed"
-            else:
-                entry["revised_target"] = original_target
-                self.log_queue.put(f"[OpenAI Proofreader] Note: Using original translation for line {line_num} (missing or empty revised output).")
-            results.append(entry)
+        # Finished lines are journalled next to the output so an interrupted run can be resumed
+        journal = CheckpointJournal(journal_path_for(output_f), mode, source_lang, target_lang, provider, model_name)
+        replayed = journal.load(source_segments_original, self.log_queue) if resume else {}
+        llm_processed_map.update(replayed)
+        try:
+            journal.start(replayed, source_segments_original)
+        except OSError as e:
+            self.log_queue.put(f"[Checkpoint] WARN: cannot write {journal.path} ({e}); this run is not resumable.")
 
-        self.log_queue.put(f"[OpenAI Proofreader] Proofreading parse complete. Segments: {len(results)}.")
-        return results
+        llm_indices = [i for i, processed_item in enumerate(final_output_targets_or_proofread_results)
+                       if processed_item is None and (i + 1) not in llm_processed_map]
+        lines_needing_llm_count = len(llm_indices)
 
-# --- Agent Factory Functions ---
-def create_translation_agent(provider, api_key, log_queue, model_name):
-    if provider.lower() == "gemini":
-        return GeminiTranslationAgent(api_key, log_queue, model_name)
-    elif provider.lower() == "claude":
-        return ClaudeTranslationAgent(api_key, log_queue, model_name)
-    elif provider.lower() == "openai":
-        return OpenAITranslationAgent(api_key, log_queue, model_name)
-    else:
-        log_queue.put(f"[Factory] Unknown provider: {provider}")
-        return None
+        def output_row(i):
+            source_text = source_segments_original[i]
+            comment = None
+            if mode == "Translate":
+                target_text = final_output_targets_or_proofread_results[i] if final_output_targets_or_proofread_results[i] is not None else llm_processed_map.get(i + 1)
+                target_text = target_text if target_text is not None else "[ERR - No TL]"
+            else:
+                proofread_entry = llm_processed_map.get(i + 1)
+                original_target_text = original_target_segments[i]
 
-def create_proofreading_agent(provider, api_key, log_queue, model_name):
-    if provider.lower() == "gemini":
-        return GeminiProofreadingAgent(api_key, log_queue, model_name)
-    elif provider.lower() == "claude":
-        return ClaudeProofreadingAgent(api_key, log_queue, model_name)
-    elif provider.lower() == "openai":
-        return OpenAIProofreadingAgent(api_key, log_queue, model_name)
-    else:
-        log_queue.put(f"[Factory] Unknown provider: {provider}")
-        return None
+                if proofread_entry:
+                    target_text = proofread_entry.get("revised_target", original_target_text)
+                    ai_summary = proofread_entry.get("changes_summary")
+                else:
+                    target_text = original_target_text
+                    ai_summary = "[Segment not processed by AI Proofreader]"
 
-def get_available_models(provider, api_key, log_queue):
-    if provider.lower() == "gemini":
-        if not GOOGLE_AI_AVAILABLE or not api_key:
-            return GEMINI_MODELS
+                existing_comment = original_comments[i]
+                comment_parts = []
+                if existing_comment: comment_parts.append(f"ORIGINAL COMMENT:\n{existing_comment}")
+                if target_text.strip() != original_target_segments[i].strip():
+                    if ai_summary and "No changes made" not in ai_summary:
+                        comment_parts.append(f"PROOFREADER COMMENT (AI):\n{ai_summary}")
+                    else:
+                        comment_parts.append(f"PROOFREADER COMMENT (AI):\nSegment was modified by AI.")
+                        output_state["modified"] += 1
+                elif ai_summary and "No changes made" not in ai_summary:
+                     comment_parts.append(f"PROOFREADER COMMENT (AI):\n{ai_summary} (Note: Text appears identical to original despite summary.)")
+                comment = "\n\n".join(comment_parts).strip() if comment_parts else None
+            t = str(target_text)
+            if "[Err" in t or "[Missing" in t or "[SYS ERR" in t or "[ERR" in t or t.startswith(FAILED_TRANSLATION_MARKERS):
+                output_state["had_errors"] = True
+            return source_text, target_text, comment
+
+        # Rows are written in document order as soon as their result is known (TM and journal hits
+        # right away, LLM lines when their chunk finishes), so the output is never assembled in memory.
+        # Written lines keep only a count: llm_processed_map and pending_llm shrink as the run goes on.
+        output_state = {"had_errors": False, "modified": 0, "llm_segments": len(replayed)}
+        def emit_row(i):
+            row = output_row(i)
+            if writer is not None:
+                writer.add(i, *row)
+            if self.on_row is not None:
+                self.on_row(i + 1, *row)
+        def emit_rows(indices):
+            for i in indices:
+                if i not in pending_llm:
+                    continue  # written already
+                pending_llm.discard(i)
+                emit_row(i)
+                if llm_processed_map.pop(i + 1, None) is not None:
+                    output_state["llm_segments"] += 1
+        def keep_results(results):
+            """Hold results of lines that are not written yet (they are written by _close_job)"""
+            llm_processed_map.update((n, v) for n, v in results.items() if n - 1 in pending_llm)
         try:
-            genai.configure(api_key=api_key)
-            dynamic_models = []
-            for m in genai.list_models():
-                if 'generateContent' in m.supported_generation_methods:
-                    model_name = m.name.split('/')[-1] if '/' in m.name else m.name
-                    dynamic_models.append(model_name)
-            return dynamic_models if dynamic_models else GEMINI_MODELS
+            writer = output_gen.open_stream(output_f, self.log_queue, mode, source_lang, target_lang)
         except Exception as e:
-            log_queue.put(f"[Models] Error fetching Gemini models: {e}")
-            return GEMINI_MODELS
-    elif provider.lower() == "claude":
-        return CLAUDE_MODELS
-    elif provider.lower() == "openai":
-        return OPENAI_MODELS
-    else:
-        return []
+            self.log_queue.put(f"[Output] ERROR writing files: {e}")
+            writer = None
+        pending_llm = set(llm_indices)
+        for i in range(len(source_segments_original)):
+            if i not in pending_llm:
+                emit_row(i)
+        llm_processed_map.clear()  # the replayed journal lines are written
+
+        job = {"mode": mode, "input_f": input_f, "output_f": output_f, "label": label, "started": started,
+               "agent": agent, "api_key": api_key, "chunks": [], "workers": 1, "retry_attempts": retry_attempts,
+               "execution": execution, "batch_options": batch_options or {}, "project_path": project_path,
+               "segments": len(source_segments_original), "tm_hits": tm_hits, "keep_results": keep_results,
+               "journal": journal, "writer": writer, "emit_rows": emit_rows, "output_state": output_state,
+               "response_cache": agent.response_cache, "shared": shared,
+               "cache_hits_before": agent.response_cache.hits if agent.response_cache else 0,
+               "metrics": RunMetrics(metrics_path_for(output_f) if write_metrics else None, self.log_queue, label, parent_metrics),
+               "build_request": None, "error_result": None, "on_chunk_done": None}
+        if lines_needing_llm_count == 0:
+            self.log_queue.put(f"{label}No segments require LLM {mode} after TM (if applicable).")
+            return job
+
+        # Live progress: lines count as received when streamed (if enabled) or when their chunk finishes
+        received_lines = set()
+        progress_state = {"last": 0.0}
+        progress_lock = threading.Lock()
+        def update_progress(line_nums):
+            with progress_lock:
+                received_lines.update(line_nums)
+                done, now = len(received_lines), time.monotonic()
+                if done < lines_needing_llm_count and now - progress_state["last"] < 0.25:
+                    return
+                progress_state["last"] = now
+            self._progress(f"{label}{mode}: {done}/{lines_needing_llm_count} lines received")
+        agent.on_line = None if shared else (lambda line_num, text: update_progress([line_num]))
+
+        def on_chunk_done(results):
+            keep_results(results)
+            journal.record(results, source_segments_original, mode)
+            emit_rows(line_num - 1 for line_num in sorted(results))
+            update_progress(results.keys())
+        context_builder = DocumentContextBuilder(
+            context_strategy, source_segments_original, original_target_segments if mode == "Proofread" else None,
+            context_token_cap, summarizer=lambda segs: agent.summarize_document(segs, source_lang), log_queue=self.log_queue)
+        self.log_queue.put(f"[Context] {label}Strategy: {context_builder.strategy} (cap ~{context_builder.max_context_tokens()} tokens per chunk).")
+        with trace_span("prepare_context", "stage", strategy=context_builder.strategy):
+            context_builder.prepare()
+        with trace_span("plan_chunks", "stage", segments=lines_needing_llm_count):
+            chunks = plan_chunks(llm_indices, source_segments_original, model_name, chunk_s, context_builder.max_context_tokens(),
+                                 original_target_segments if mode == "Proofread" else None)
+        num_llm_chunks = len(chunks)
+        self.log_queue.put(f"[Chunker] {label}{describe_chunk_plan(chunks, source_segments_original, original_target_segments if mode == 'Proofread' else None)}")
+        workers = max(1, min(max_in_flight or get_provider_max_in_flight(provider), num_llm_chunks))
+        self.log_queue.put(f"{label}LLM Segments for {mode}: {lines_needing_llm_count}. LLM Chunks: {num_llm_chunks if num_llm_chunks > 0 else '0'}. "
+                           + ("Execution: bulk (provider batch API)" if execution == "bulk" else f"Parallel requests: {workers} ({dispatch_mode})"))
+
+        context_shared = context_builder.same_for_every_chunk()
+        def build_request(current_orig_doc_indices):
+            source_context_str, target_context_str = context_builder.for_chunk(current_orig_doc_indices)
+            if mode == "Translate":
+                lines_map_for_llm = {orig_idx + 1: f"{orig_idx + 1}. {source_segments_original[orig_idx]}" for orig_idx in current_orig_doc_indices}
+                return (lines_map_for_llm, source_context_str, source_lang, target_lang,
+                        source_segments_original, drawings_map, user_custom_instructions), \
+                       {"tracked_changes_data": self.tracked_changes_agent, "custom_system_prompt": custom_system_prompt,
+                        "context_shared": context_shared}
+            lines_map_for_llm = {orig_idx + 1: {"source": source_segments_original[orig_idx], "target_original": original_target_segments[orig_idx]} for orig_idx in current_orig_doc_indices}
+            return (lines_map_for_llm, source_context_str, target_context_str,
+                    source_lang, target_lang, source_segments_original, drawings_map,
+                    user_custom_instructions), \
+                   {"tracked_changes_data": self.tracked_changes_agent, "custom_system_prompt": custom_system_prompt,
+                    "context_shared": context_shared}
+
+        def error_result(current_orig_doc_indices, e):
+            if mode == "Translate":
+                return {idx + 1: f"[TL Err line {idx + 1}: {e}]" for idx in current_orig_doc_indices}
+            return {idx + 1: {"revised_target": original_target_segments[idx],
+                              "changes_summary": f"[Proofread Err line {idx + 1}: {e}]",
+                              "original_target": original_target_segments[idx]} for idx in current_orig_doc_indices}
+
+        job.update(chunks=chunks, workers=workers, build_request=build_request, error_result=error_result,
+                   on_chunk_done=on_chunk_done)
+        return job
+
+    def _close_job(self, job):
+        """Write the remaining rows, commit the output files and settle the checkpoint journal; returns the result dict"""
+        mode, output_f, journal = job["mode"], job["output_f"], job["journal"]
+        response_cache = job["response_cache"]
+        if response_cache and job["chunks"] and not job["shared"]:
+            self.log_queue.put(f"[Cache] {response_cache.hits - job['cache_hits_before']} request(s) served from the response cache ({response_cache.path}).")
+
+        with trace_span("write_output", "stage", file=os.path.basename(output_f)):
+            job["emit_rows"](range(job["segments"]))
+            file_ok = job["writer"].close() if job["writer"] is not None else False
+        metrics = job["metrics"].close()
+        if metrics["requests"]:
+            self.log_queue.put(f"[Metrics] {job['label']}{job['metrics'].describe(metrics)}"
+                               + (f" Details: {job['metrics'].path}" if job["metrics"].path else ""))
+        had_errors, modified_lines_count = job["output_state"]["had_errors"], job["output_state"]["modified"]
+        llm_segments = job["output_state"]["llm_segments"]
+
+        # A clean run no longer needs its journal; otherwise keep it so a resumed run only tops up what is missing
+        journal.close(remove=file_ok and not had_errors)
+        if not (file_ok and not had_errors) and journal.recorded:
+            self.log_queue.put(f"[Checkpoint] Kept {journal.path}; tick 'Resume from checkpoint' to redo only the unfinished lines.")
+
+        msg_detail_key = "SUCCESS" if file_ok and not had_errors else "PARTIAL" if file_ok else "FAIL"
+
+        base_log_message_suffix = f"Output: {output_f}"
+        if msg_detail_key == "PARTIAL":
+            base_log_message_suffix += ". Check logs."
+        elif msg_detail_key == "FAIL":
+            base_log_message_suffix = "Check logs."
+
+        final_log_message = f"\n--- {job['label']}{mode.upper()} {msg_detail_key}! "
+        if mode == "Translate":
+            final_log_message += f"TM Hits: {job['tm_hits']}. LLM Segs processed: {llm_segments}. "
+        else:
+            final_log_message += f"LLM Segs processed: {llm_segments}. Lines Modified by AI: {modified_lines_count}. "
+        if self.tracked_changes_agent.change_data:
+            final_log_message += f"Tracked Changes: {len(self.tracked_changes_agent.change_data)} pairs used as context. "
+        final_log_message += base_log_message_suffix + " ---"
+        self.log_queue.put(final_log_message)
+
+        return self._result("success" if msg_detail_key == "SUCCESS" else "partial" if msg_detail_key == "PARTIAL" else "error",
+                            mode, job["input_f"], output_f, file_ok=file_ok, segments=job["segments"], tm_hits=job["tm_hits"],
+                            llm_segments=llm_segments, modified_lines=modified_lines_count,
+                            message=final_log_message.strip(), elapsed=time.monotonic() - job["started"],
+                            metrics=metrics, metrics_file=job["metrics"].path,
+                            tmx_file=job["writer"].tmx_path if job["writer"] is not None else None)
 
 # --- Supervertaler GUI Application Class ---
 class TranslationApp:
@@ -1662,7 +5958,7 @@ class TranslationApp:
         root.geometry("1100x950")  # Wider to accommodate right-side log
 
         self.log_queue = queue.Queue()
-        self.api_keys = API_KEYS
+        self.api_keys = get_api_keys()
         self.tm_agent = TMAgent(self.log_queue)
         self.tracked_changes_agent = TrackedChangesAgent(self.log_queue)  # UPDATED: Use TrackedChangesAgent
         self.drawings_images_map = {} 
@@ -1870,6 +6166,20 @@ class TranslationApp:
         self.source_lang_var = tk.StringVar(value="Dutch")
         self.target_lang_var = tk.StringVar(value="English")
         self.chunk_size_var = tk.StringVar(value="100")
+        self.parallel_requests_var = tk.StringVar(value="auto")
+        self.retry_attempts_var = tk.StringVar(value="3")
+        self.context_token_cap_var = tk.StringVar(value=str(DEFAULT_CONTEXT_TOKEN_CAP))
+        self.use_response_cache_var = tk.BooleanVar(value=True)
+        self.resume_var = tk.BooleanVar(value=False)
+        self.streaming_var = tk.BooleanVar(value=False)
+        self.write_metrics_var = tk.BooleanVar(value=False)
+        self.trace_var = tk.BooleanVar(value=False)
+        self.profile_var = tk.StringVar(value="off")
+        self.failover_provider_var = tk.StringVar(value="")
+        self.failover_model_var = tk.StringVar(value="")
+        self.hedge_percentile_var = tk.StringVar(value=f"{HEDGE_PERCENTILE:g}")
+        self.bulk_mode_var = tk.BooleanVar(value=False)
+        self.progress_var = tk.StringVar(value="")
 
         # AI Provider and Model Selection
         provider_frame = tk.Frame(left_frame, bg="white")
@@ -1888,10 +6198,11 @@ class TranslationApp:
             if CLAUDE_AVAILABLE: available_providers.append("Claude")
             if GOOGLE_AI_AVAILABLE: available_providers.append("Gemini")
             if OPENAI_AVAILABLE: available_providers.append("OpenAI")
-        
-        provider_combo['values'] = available_providers
         if available_providers and self.provider_var.get() not in available_providers:
             self.provider_var.set(available_providers[0])
+        available_providers.append("Mock")  # offline provider for benchmarks and load tests; never the default
+        
+        provider_combo['values'] = available_providers
         provider_combo.grid(row=0, column=1, padx=5, pady=2, sticky="w")
         provider_combo.bind('<<ComboboxSelected>>', self.on_provider_changed)
         
@@ -1904,18 +6215,65 @@ class TranslationApp:
         self.update_available_models()
         current_row += 1
 
+        # Failover: slow calls are hedged with (and failed calls sent to) a second provider/model
+        failover_frame = tk.Frame(left_frame, bg="white")
+        failover_frame.grid(row=current_row, column=0, columnspan=3, pady=2, sticky="ew", padx=5); current_row += 1
+        tk.Label(failover_frame, text="Failover:", bg="white").grid(row=0, column=0, padx=5, pady=2, sticky="w")
+        failover_combo = ttk.Combobox(failover_frame, textvariable=self.failover_provider_var, width=15, state="readonly",
+                                      values=[""] + available_providers)
+        failover_combo.grid(row=0, column=1, padx=5, pady=2, sticky="w")
+        failover_combo.bind('<<ComboboxSelected>>', self.on_failover_provider_changed)
+        tk.Label(failover_frame, text="Model:", bg="white").grid(row=0, column=2, padx=(20,5), pady=2, sticky="w")
+        self.failover_model_combo = ttk.Combobox(failover_frame, textvariable=self.failover_model_var, width=30)
+        self.failover_model_combo.grid(row=0, column=3, padx=5, pady=2, sticky="w")
+        tk.Label(failover_frame, text="Hedge at percentile:", bg="white").grid(row=0, column=4, padx=(20,5), pady=2, sticky="w")
+        tk.Entry(failover_frame, textvariable=self.hedge_percentile_var, width=6).grid(row=0, column=5, padx=5, pady=2, sticky="w")
+
         setting_fields_data = [
             ("Source Language:", self.source_lang_var, 30), ("Target Language:", self.target_lang_var, 30),
-            ("Chunk Size (lines):", self.chunk_size_var, 10)
+            ("Max Chunk Size (lines):", self.chunk_size_var, 10),
+            ("Parallel Requests:", self.parallel_requests_var, 10),
+            ("Retry Attempts (failed lines):", self.retry_attempts_var, 10),
+            ("Context Token Cap (per chunk):", self.context_token_cap_var, 10)
         ]
         for text, var, width in setting_fields_data:
             tk.Label(left_frame, text=text, bg="white").grid(row=current_row, column=0, padx=5, pady=2, sticky="w")
             tk.Entry(left_frame, textvariable=var, width=width).grid(row=current_row, column=1, padx=5, pady=2, sticky="w"); current_row += 1
 
+        self.dispatch_mode_var = tk.StringVar(value="threads")
+        tk.Label(left_frame, text="Dispatch Engine:", bg="white").grid(row=current_row, column=0, padx=5, pady=2, sticky="w")
+        ttk.Combobox(left_frame, textvariable=self.dispatch_mode_var, values=LLMChunkDispatcher.DISPATCH_MODES,
+                     width=10, state="readonly").grid(row=current_row, column=1, padx=5, pady=2, sticky="w"); current_row += 1
+
+        self.context_strategy_var = tk.StringVar(value="full")
+        tk.Label(left_frame, text="Document Context:", bg="white").grid(row=current_row, column=0, padx=5, pady=2, sticky="w")
+        ttk.Combobox(left_frame, textvariable=self.context_strategy_var, values=CONTEXT_STRATEGIES,
+                     width=10, state="readonly").grid(row=current_row, column=1, padx=5, pady=2, sticky="w"); current_row += 1
+
+        tk.Checkbutton(left_frame, text="Reuse cached LLM responses", variable=self.use_response_cache_var,
+                       bg="white").grid(row=current_row, column=1, padx=5, pady=2, sticky="w"); current_row += 1
+        tk.Checkbutton(left_frame, text="Resume from checkpoint (skip lines already finished)", variable=self.resume_var,
+                       bg="white").grid(row=current_row, column=1, padx=5, pady=2, sticky="w"); current_row += 1
+        tk.Checkbutton(left_frame, text="Stream responses (live progress)", variable=self.streaming_var,
+                       bg="white").grid(row=current_row, column=1, padx=5, pady=2, sticky="w"); current_row += 1
+        tk.Checkbutton(left_frame, text="Write request metrics (<output>.metrics.jsonl)", variable=self.write_metrics_var,
+                       bg="white").grid(row=current_row, column=1, padx=5, pady=2, sticky="w"); current_row += 1
+        diagnostics_frame = tk.Frame(left_frame, bg="white")
+        diagnostics_frame.grid(row=current_row, column=1, padx=5, pady=2, sticky="w"); current_row += 1
+        tk.Checkbutton(diagnostics_frame, text="Trace stages (<output>.trace.json)", variable=self.trace_var,
+                       bg="white").pack(side=tk.LEFT)
+        tk.Label(diagnostics_frame, text="Profiler:", bg="white").pack(side=tk.LEFT, padx=(10, 2))
+        ttk.Combobox(diagnostics_frame, textvariable=self.profile_var, values=PROFILERS, width=9,
+                     state="readonly").pack(side=tk.LEFT)
+        tk.Checkbutton(left_frame, text="Bulk mode (provider batch API: cheaper, results within 24h)", variable=self.bulk_mode_var,
+                       bg="white").grid(row=current_row, column=1, padx=5, pady=2, sticky="w"); current_row += 1
+
         buttons_frame = tk.Frame(left_frame, bg="white"); buttons_frame.grid(row=current_row, column=0, columnspan=3, pady=5); current_row += 1
         self.process_button = tk.Button(buttons_frame, text="Start Process", command=self.start_processing_thread, width=15, height=2); self.process_button.pack(side=tk.LEFT, padx=10) 
         self.list_models_button = tk.Button(buttons_frame, text="List Models", command=self.list_available_models, width=15); self.list_models_button.pack(side=tk.LEFT, padx=10) 
         self.refresh_models_button = tk.Button(buttons_frame, text="Refresh Models", command=self.update_available_models, width=15); self.refresh_models_button.pack(side=tk.LEFT, padx=10)
+        self.run_folder_button = tk.Button(buttons_frame, text="Run Folder...", command=self.start_folder_processing_thread, width=15); self.run_folder_button.pack(side=tk.LEFT, padx=10)
+        tk.Label(left_frame, textvariable=self.progress_var, bg="white", fg="gray").grid(row=current_row, column=0, columnspan=3, padx=5, sticky="w"); current_row += 1
         
         # Log section in bottom right frame - extra sharp heading font
         tk.Label(log_frame, text="📝 Processing Log", font=("Segoe UI", 12, "bold"), bg="white").pack(anchor="w", padx=5, pady=(5,2))
@@ -1952,12 +6310,19 @@ class TranslationApp:
             working.append("Gemini")
         if OPENAI_AVAILABLE and self.api_keys["openai"]:
             working.append("OpenAI")
-        return working
+        return working  # Mock is not counted: it is always usable, but only for tests
 
     def on_provider_changed(self, event=None):
         """Called when user changes AI provider"""
         self.update_available_models()
 
+    def on_failover_provider_changed(self, event=None):
+        """Offer the failover provider's models (blank provider = no failover)"""
+        provider = self.failover_provider_var.get()
+        models = get_available_models(provider, provider_api_key(self.api_keys, provider), self.log_queue) if provider else []
+        self.failover_model_combo['values'] = models
+        self.failover_model_var.set(models[0] if models else "")
+
     def update_available_models(self):
         """Update the model dropdown based on selected provider"""
         provider = self.provider_var.get()
@@ -1972,6 +6337,8 @@ class TranslationApp:
             api_key = self.api_keys["google"]
         elif provider == "OpenAI":
             api_key = self.api_keys["openai"]
+        elif provider == "Mock":
+            api_key = MOCK_API_KEY
         
         # Get available models
         models = get_available_models(provider, api_key, self.log_queue)
@@ -1983,6 +6350,8 @@ class TranslationApp:
                 default_model = "claude-3-5-sonnet-20241022"
             elif provider == "OpenAI":
                 default_model = "gpt-4o"
+            elif provider == "Mock":
+                default_model = "mock-realistic"
             else:  # Gemini
                 default_model = "gemini-2.5-pro-preview-05-06"
             
@@ -2573,9 +6942,31 @@ class TranslationApp:
         if not project_name:
             messagebox.showwarning("No Name", "Please enter a project name.")
             return
+        project_data = self.collect_project_data(project_name)
+
+        # Save to file
+        filename = f"{project_name}.json"
+        filepath = os.path.join(self.projects_dir, filename)
+        # Keep the bulk-mode batch IDs recorded in an earlier save of this project
+        batches = BatchStore(filepath).get_all()
+        if batches:
+            project_data["batches"] = batches
+
+        try:
+            with open(filepath, 'w', encoding='utf-8') as f:
+                json.dump(project_data, f, indent=2, ensure_ascii=False)
+            
+            self.refresh_projects_list()
+            self.update_log(f"[Project] Saved project: '{project_name}'")
+            messagebox.showinfo("Saved", f"Project '{project_name}' saved successfully!")
+            
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to save project: {str(e)}")
+            self.update_log(f"[ERROR] Failed to save project: {str(e)}")
 
-        # Collect current state
-        project_data = {
+    def collect_project_data(self, project_name=""):
+        """Current workspace state as a project dict (what Save Project writes, and what TranslationEngine runs)"""
+        return {
             "name": project_name,
             "created": time.strftime("%Y-%m-%d %H:%M:%S"),
             "version": APP_VERSION,
@@ -2586,6 +6977,20 @@ class TranslationApp:
                 "model": self.model_var.get() if hasattr(self, 'model_var') else "",
                 "mode": self.operation_mode_var.get(),
                 "chunk_size": self.chunk_size_var.get(),
+                "parallel_requests": self.parallel_requests_var.get(),
+                "dispatch_mode": self.dispatch_mode_var.get(),
+                "retry_attempts": self.retry_attempts_var.get(),
+                "context_strategy": self.context_strategy_var.get(),
+                "context_token_cap": self.context_token_cap_var.get(),
+                "use_response_cache": self.use_response_cache_var.get(),
+                "streaming": self.streaming_var.get(),
+                "write_metrics": self.write_metrics_var.get(),
+                "trace": self.trace_var.get(),
+                "profile": self.profile_var.get(),
+                "failover_provider": self.failover_provider_var.get(),
+                "failover_model": self.failover_model_var.get(),
+                "hedge_percentile": self.hedge_percentile_var.get(),
+                "execution": "bulk" if self.bulk_mode_var.get() else "interactive",
             },
             "content": {
                 "custom_instructions": self.custom_instructions_text.get("1.0", tk.END).strip() if hasattr(self, 'custom_instructions_text') else "",
@@ -2602,22 +7007,6 @@ class TranslationApp:
             }
         }
 
-        # Save to file
-        filename = f"{project_name}.json"
-        filepath = os.path.join(self.projects_dir, filename)
-
-        try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(project_data, f, indent=2, ensure_ascii=False)
-            
-            self.refresh_projects_list()
-            self.update_log(f"[Project] Saved project: '{project_name}'")
-            messagebox.showinfo("Saved", f"Project '{project_name}' saved successfully!")
-            
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to save project: {str(e)}")
-            self.update_log(f"[ERROR] Failed to save project: {str(e)}")
-
     def load_project(self):
         """Load selected project from JSON file"""
         selection = self.projects_listbox.curselection()
@@ -2642,6 +7031,20 @@ class TranslationApp:
                 self.model_var.set(settings.get("model", ""))
             self.operation_mode_var.set(settings.get("mode", "Translate"))
             self.chunk_size_var.set(settings.get("chunk_size", "100"))
+            self.parallel_requests_var.set(settings.get("parallel_requests", "auto"))
+            self.dispatch_mode_var.set(settings.get("dispatch_mode", "threads"))
+            self.retry_attempts_var.set(settings.get("retry_attempts", "3"))
+            self.context_strategy_var.set(settings.get("context_strategy", "full"))
+            self.context_token_cap_var.set(settings.get("context_token_cap", str(DEFAULT_CONTEXT_TOKEN_CAP)))
+            self.use_response_cache_var.set(settings.get("use_response_cache", True))
+            self.streaming_var.set(settings.get("streaming", False))
+            self.write_metrics_var.set(settings.get("write_metrics", False))
+            self.trace_var.set(settings.get("trace", False))
+            self.profile_var.set(settings.get("profile", "off"))
+            self.failover_provider_var.set(settings.get("failover_provider", ""))
+            self.failover_model_var.set(settings.get("failover_model", ""))
+            self.hedge_percentile_var.set(settings.get("hedge_percentile", f"{HEDGE_PERCENTILE:g}"))
+            self.bulk_mode_var.set(settings.get("execution", "interactive") == "bulk")
 
             # Restore content
             content = project_data.get("content", {})
@@ -2771,18 +7174,15 @@ class TranslationApp:
         if not filepaths:
             return
         
-        success_count = 0
+        supported = []
         for filepath in filepaths:
             _, ext = os.path.splitext(filepath.lower())
             
-            if ext == '.docx':
-                if self.tracked_changes_agent.load_docx_changes(filepath):
-                    success_count += 1
-            elif ext == '.tsv':
-                if self.tracked_changes_agent.load_tsv_changes(filepath):
-                    success_count += 1
+            if ext in ('.docx', '.tsv'):
+                supported.append(filepath)
             else:
                 self.update_log(f"[Tracked Changes] Skipping unsupported file type: {filepath}")
+        success_count = self.tracked_changes_agent.load_files(supported, get_cpu_pool() if len(supported) > 1 else None)
         
         # Update status label
         total_pairs = len(self.tracked_changes_agent.change_data)
@@ -2839,7 +7239,9 @@ class TranslationApp:
         self.log_text.config(state="normal"); self.log_text.insert(tk.END, str(msg) + "\n"); self.log_text.see(tk.END); self.log_text.config(state="disabled"); self.root.update_idletasks()
     
     def check_log_queue(self): 
-        while not self.log_queue.empty(): self.update_log(self.log_queue.get_nowait())
+        start, count = time.perf_counter(), 0
+        while not self.log_queue.empty(): self.update_log(self.log_queue.get_nowait()); count += 1
+        if count and _ACTIVE_TRACERS: trace_span_everywhere("log_pump", "gui", start, time.perf_counter(), messages=count)
         self.root.after(100, self.check_log_queue)
     
     def list_available_models(self):
@@ -2858,6 +7260,8 @@ class TranslationApp:
             api_key = self.api_keys["google"]
         elif provider == "OpenAI":
             api_key = self.api_keys["openai"]
+        elif provider == "Mock":
+            api_key = MOCK_API_KEY
         
         if not api_key:
             self.update_log(f"API Key missing for {provider}")
@@ -2865,7 +7269,7 @@ class TranslationApp:
             
         if provider == "Gemini" and GOOGLE_AI_AVAILABLE:
             try:
-                genai.configure(api_key=api_key)
+                PROVIDER_CLIENTS.configure_genai(api_key)
                 self.update_log("Fetching Gemini models...")
                 models_info = []
                 for m in genai.list_models():
@@ -2884,26 +7288,21 @@ class TranslationApp:
             for i, model in enumerate(OPENAI_MODELS, 1):
                 self.update_log(f"{i}. {model}")
             self.update_log(f"\nFound {len(OPENAI_MODELS)} OpenAI models. Models with 'gpt-4' prefix support multimodal capabilities.")
+        elif provider == "Mock":
+            self.update_log("Mock profiles (offline, no API calls; override options with the SUPERVERTALER_MOCK environment variable):")
+            for i, model in enumerate(MOCK_MODELS, 1):
+                self.update_log(f"{i}. {model}: {MOCK_PROFILES[model] or 'no delays or failures'}")
         else:
             self.update_log(f"Cannot list models for {provider} - library not available or API key missing")
             
         self.update_log("--- Done Listing ---\n")
     
     def load_drawing_images_from_folder(self, folder_path):
-        if not PIL_AVAILABLE or not folder_path: self.log_queue.put("[Drawings] Pillow lib not avail or no folder path."); return {}
-        loaded_images_map = {}; self.log_queue.put(f"[Drawings] Loading images from: {folder_path}")
-        valid_extensions = ('.png', '.jpg', '.jpeg', '.webp'); count = 0
         try:
-            for fname in os.listdir(folder_path):
-                if fname.lower().endswith(valid_extensions):
-                    try:
-                        base_name = os.path.splitext(fname)[0]; normalized_ref = normalize_figure_ref(base_name)
-                        if normalized_ref: img = Image.open(os.path.join(folder_path, fname)); loaded_images_map[normalized_ref] = img; self.log_queue.put(f"[Drawings] Loaded '{fname}' as Fig Ref '{normalized_ref}'."); count += 1
-                        else: self.log_queue.put(f"[Drawings] Could not normalize: {fname}")
-                    except Exception as e_img: self.log_queue.put(f"[Drawings] Err loading img {fname}: {e_img}")
-            self.log_queue.put(f"[Drawings] Loaded {count} images."); 
-        except Exception as e_list_dir: self.log_queue.put(f"[Drawings] Error listing dir {folder_path}: {e_list_dir}"); messagebox.showerror("Drawings Folder Error", f"Could not read drawings folder: {e_list_dir}")
-        return loaded_images_map
+            return load_drawing_images(folder_path, self.log_queue)
+        except OSError as e_list_dir:
+            self.log_queue.put(f"[Drawings] Error listing dir {folder_path}: {e_list_dir}"); messagebox.showerror("Drawings Folder Error", f"Could not read drawings folder: {e_list_dir}")
+            return {}
 
     def start_processing_thread(self):
         provider = self.provider_var.get()
@@ -2917,7 +7316,7 @@ class TranslationApp:
             
         # Check if provider is working
         working_providers = self.get_working_providers()
-        if provider not in working_providers:
+        if provider not in working_providers and provider != "Mock":
             api_key_type = "OpenAI" if provider == "OpenAI" else "Claude" if provider == "Claude" else "Google"
             messagebox.showerror("Error", f"{provider} not available. Check if {api_key_type} API key is configured in api_keys.txt and library is installed.")
             return
@@ -2930,8 +7329,18 @@ class TranslationApp:
         # Get custom system prompt for the current mode
         custom_system_prompt = self.get_custom_system_prompt(mode)
         
-        try: chunk_s = int(self.chunk_size_var.get()); assert chunk_s > 0
-        except: messagebox.showerror("Error", "Invalid Chunk Size."); return
+        try:
+            run_settings = parse_run_settings({
+                "chunk_size": self.chunk_size_var.get(), "parallel_requests": self.parallel_requests_var.get(),
+                "dispatch_mode": self.dispatch_mode_var.get(), "retry_attempts": self.retry_attempts_var.get(),
+                "context_strategy": self.context_strategy_var.get(), "context_token_cap": self.context_token_cap_var.get(),
+                "use_response_cache": self.use_response_cache_var.get(), "streaming": self.streaming_var.get(),
+                "write_metrics": self.write_metrics_var.get(), "trace": self.trace_var.get(), "profile": self.profile_var.get(),
+                "failover_provider": self.failover_provider_var.get(), "failover_model": self.failover_model_var.get(),
+                "hedge_percentile": self.hedge_percentile_var.get(),
+                "execution": "bulk" if self.bulk_mode_var.get() else "interactive"}, provider)
+        except ValueError as e:
+            messagebox.showerror("Error", str(e)); return
         
         if not input_f or not output_f: messagebox.showerror("File Error", "Select input & output files."); return
         if drawings_folder and not PIL_AVAILABLE: messagebox.showerror("Image Error", "Pillow (PIL) library needed for drawings folder feature."); return
@@ -2940,174 +7349,85 @@ class TranslationApp:
         self.list_models_button.config(state="disabled")
         self.refresh_models_button.config(state="disabled")
         self.update_log(f"--- Starting {mode} Process with {provider} ({model_name}) ---")
+        self.progress_var.set("")
         
         if mode == "Translate" and tm_f: self.tm_agent.load_tm(tm_f, src_l, tgt_l)
         self.drawings_images_map = {} 
         if drawings_folder and PIL_AVAILABLE: self.drawings_images_map = self.load_drawing_images_from_folder(drawings_folder)
         
         thread = threading.Thread(target=self.run_pipeline,
-                                  args=(mode, input_f, output_f, src_l, tgt_l, provider, model_name, chunk_s, 
-                                        self.drawings_images_map, custom_instr, custom_system_prompt)) 
+                                  args=(mode, input_f, output_f, src_l, tgt_l, provider, model_name, run_settings.pop("chunk_s"),
+                                        self.drawings_images_map, custom_instr, custom_system_prompt),
+                                  kwargs=dict(run_settings, resume=self.resume_var.get(), project_path=self.current_project_path()))
         thread.daemon = True; thread.start()
 
-    def run_pipeline(self, mode, input_f, output_f, source_lang, target_lang, provider, model_name, chunk_s, drawings_map, user_custom_instructions, custom_system_prompt=None):
-        ingestor = BilingualFileIngestionAgent(); output_gen = OutputGenerationAgent()
-        
-        all_original_data = ingestor.process(input_f, self.log_queue, mode=mode) 
-        if not all_original_data: self.log_queue.put("No data from input file."); messagebox.showerror("Input Err", "No data in input file."); self.root.after(0, self.enable_buttons); return
-
-        source_segments_original = []
-        original_target_segments = [] 
-        original_comments = []    
-        modified_lines_count = 0
+    def current_project_path(self):
+        """Saved project file for the name in the Project Library box, if it exists (bulk mode stores batch IDs there)"""
+        project_name = self.project_name_var.get().strip()
+        filepath = os.path.join(self.projects_dir, f"{project_name}.json") if project_name else None
+        return filepath if filepath and os.path.exists(filepath) else None
 
-        # Get appropriate API key
-        api_key = ""
-        if provider == "Claude":
-            api_key = self.api_keys["claude"]
-        elif provider == "Gemini":
-            api_key = self.api_keys["google"]
-        elif provider == "OpenAI":
-            api_key = self.api_keys["openai"]
-        
-        if not api_key:
-            self.log_queue.put(f"No API key available for {provider}")
-            messagebox.showerror("API Key Error", f"No API key configured for {provider}")
-            self.root.after(0, self.enable_buttons)
+    def start_folder_processing_thread(self):
+        """Run every .txt file in a folder with the current settings, as one job queue"""
+        provider = self.provider_var.get()
+        mode = self.operation_mode_var.get()
+        if provider not in self.get_working_providers() and provider != "Mock":
+            messagebox.showerror("Error", f"{provider} not available. Check api_keys.txt and the installed libraries.")
             return
+        input_dir = filedialog.askdirectory(title="Select Folder with Input Files (.txt)")
+        if not input_dir: return
+        output_dir = filedialog.askdirectory(title="Select Output Folder", initialdir=input_dir)
+        if not output_dir: return
+        inputs = collect_job_inputs([input_dir])
+        if not inputs:
+            messagebox.showerror("File Error", f"No .txt files found in {input_dir}"); return
+        project_data = self.collect_project_data(self.project_name_var.get().strip())
+        project_data["prompts"] = {"current_translate": self.get_custom_system_prompt("Translate"),
+                                   "current_proofread": self.get_custom_system_prompt("Proofread")}
+        jobs = [{"input_file": f, "output_file": default_output_path(f, mode, output_dir), "resume": self.resume_var.get()}
+                for f in inputs]
+
+        for button in (self.process_button, self.list_models_button, self.refresh_models_button, self.run_folder_button):
+            button.config(state="disabled")
+        self.update_log(f"--- Starting {mode} of {len(jobs)} file(s) from {input_dir} with {provider} ---")
+        self.progress_var.set("")
+        thread = threading.Thread(target=self.run_folder_pipeline, args=(project_data, jobs, self.current_project_path()))
+        thread.daemon = True; thread.start()
 
-        if mode == "Translate":
-            source_segments_original = all_original_data
-            translator = create_translation_agent(provider, api_key, self.log_queue, model_name)
-            if not translator or not translator.model: self.log_queue.put("Translator init fail."); messagebox.showerror("Model Err", "Translator model init failed."); self.root.after(0, self.enable_buttons); return
-        elif mode == "Proofread":
-            proofreader = create_proofreading_agent(provider, api_key, self.log_queue, model_name)
-            if not proofreader or not proofreader.model: self.log_queue.put("Proofreader init fail."); messagebox.showerror("Model Err", "Proofreader model init failed."); self.root.after(0, self.enable_buttons); return
-            for item in all_original_data:
-                source_segments_original.append(item["source"])
-                original_target_segments.append(item["target"])
-                original_comments.append(item["comment"]) 
-
-        final_output_targets_or_proofread_results = [None] * len(source_segments_original)
-        tm_hits = 0; llm_processed_map = {}
-
-        if mode == "Translate":
-            if self.tm_agent.tm_data:
-                self.log_queue.put(f"[TM] Applying {len(self.tm_agent.tm_data)} TM entries...")
-                for i, seg in enumerate(source_segments_original):
-                    tm_tgt = self.tm_agent.get_translation(seg)
-                    if tm_tgt is not None: final_output_targets_or_proofread_results[i] = tm_tgt; tm_hits += 1
-                self.log_queue.put(f"[TM] Applied TM to {tm_hits} segments.")
-            else: self.log_queue.put("[TM] No TM data or file not specified.")
-        
-        full_source_doc_str = "\n".join([f"{i+1}. {line}" for i, line in enumerate(source_segments_original)])
-        full_original_target_doc_str = "\n".join([f"{i+1}. {line}" for i, line in enumerate(original_target_segments)]) if mode == "Proofread" else ""
-        
-        lines_needing_llm_count = len(source_segments_original) - (tm_hits if mode == "Translate" else 0)
-
-        if lines_needing_llm_count > 0:
-            llm_indices = [i for i, processed_item in enumerate(final_output_targets_or_proofread_results) if processed_item is None]
-            num_llm_chunks = math.ceil(lines_needing_llm_count / chunk_s)
-            self.log_queue.put(f"LLM Segments for {mode}: {lines_needing_llm_count}. LLM Chunks: {num_llm_chunks if num_llm_chunks > 0 else '0'}")
-            
-            for i in range(num_llm_chunks):
-                current_orig_doc_indices = llm_indices[i * chunk_s : min((i + 1) * chunk_s, lines_needing_llm_count)] 
-                if not current_orig_doc_indices: continue
-                self.log_queue.put(f"LLM Chunk {i+1}/{num_llm_chunks} ({mode}): Sending {len(current_orig_doc_indices)} segments...")
-                
-                if mode == "Translate":
-                    lines_map_for_llm = {orig_idx + 1: f"{orig_idx + 1}. {source_segments_original[orig_idx]}" for orig_idx in current_orig_doc_indices}
-                    chunk_results = translator.translate_specific_lines_with_drawings_context(
-                        lines_map_for_llm, full_source_doc_str, source_lang, target_lang,
-                        source_segments_original, drawings_map, user_custom_instructions,
-                        tracked_changes_data=self.tracked_changes_agent, custom_system_prompt=custom_system_prompt)
-                elif mode == "Proofread":
-                    lines_map_for_llm = {orig_idx + 1: {"source": source_segments_original[orig_idx], "target_original": original_target_segments[orig_idx]} for orig_idx in current_orig_doc_indices}
-                    chunk_results = proofreader.proofread_specific_lines_with_context(
-                        lines_map_for_llm, full_source_doc_str, full_original_target_doc_str,
-                        source_lang, target_lang, source_segments_original, drawings_map,
-                        user_custom_instructions, tracked_changes_data=self.tracked_changes_agent, 
-                        custom_system_prompt=custom_system_prompt)
-                
-                llm_processed_map.update(chunk_results)
-                self.log_queue.put(f"Finished LLM Chunk {i+1}/{num_llm_chunks} for {mode}.")
-        else: self.log_queue.put(f"No segments require LLM {mode} after TM (if applicable).")
-
-        output_source_list = []
-        output_target_list = []
-        output_comment_list = [] 
-
-        for i in range(len(source_segments_original)):
-            source_text = source_segments_original[i]
-            output_source_list.append(source_text)
-            if mode == "Translate":
-                target_text = final_output_targets_or_proofread_results[i] if final_output_targets_or_proofread_results[i] is not None else llm_processed_map.get(i + 1)
-                output_target_list.append(target_text if target_text is not None else "[ERR - No TL]")
-            elif mode == "Proofread":
-                proofread_entry = llm_processed_map.get(i + 1) 
-                original_target_text = original_target_segments[i]
-                
-                if proofread_entry:
-                    revised_target = proofread_entry.get("revised_target", original_target_text)
-                    ai_summary = proofread_entry.get("changes_summary")
-                else: 
-                    revised_target = original_target_text
-                    ai_summary = "[Segment not processed by AI Proofreader]"
-                
-                output_target_list.append(revised_target)
-                existing_comment = original_comments[i]
-                comment_parts = []
-                if existing_comment: comment_parts.append(f"ORIGINAL COMMENT:\n{existing_comment}")
-                if revised_target.strip() != original_target_segments[i].strip(): 
-                    if ai_summary and "No changes made" not in ai_summary:
-                        comment_parts.append(f"PROOFREADER COMMENT (AI):\n{ai_summary}")
-                    else: 
-                        comment_parts.append(f"PROOFREADER COMMENT (AI):\nSegment was modified by AI.")
-                        modified_lines_count +=1
-                elif ai_summary and "No changes made" not in ai_summary: 
-                     comment_parts.append(f"PROOFREADER COMMENT (AI):\n{ai_summary} (Note: Text appears identical to original despite summary.)")
-                output_comment_list.append("\n\n".join(comment_parts).strip() if comment_parts else None)
-        
-        had_errors = any(t is None or "[Err" in str(t) or "[Missing" in str(t) or "[SYS ERR" in str(t) for t in output_target_list)
-        file_ok = output_gen.process(
-            output_source_list,
-            output_target_list,
-            output_f,
-            self.log_queue,
-            mode=mode,
-            comments_list_for_output=output_comment_list if mode == "Proofread" else None,
-            source_lang=source_lang,
-            target_lang=target_lang  # FIX: use correct parameter name
-        )
-
-        msg_title = "Success" if file_ok and not had_errors else "Partial Success" if file_ok else "Error"
-        msg_detail_key = "SUCCESS" if file_ok and not had_errors else "PARTIAL" if file_ok else "FAIL"
-
-        base_log_message_suffix = f"Output: {output_f}"
-        if msg_detail_key == "PARTIAL":
-            base_log_message_suffix += ". Check logs."
-        elif msg_detail_key == "FAIL":
-            base_log_message_suffix = "Check logs."
+    def run_folder_pipeline(self, project_data, jobs, project_path=None):
+        engine = TranslationEngine(self.api_keys, self.log_queue, self.tm_agent, self.tracked_changes_agent, self.projects_dir,
+                                   on_progress=lambda text: self.root.after(0, self.progress_var.set, text))
+        results = engine.run_jobs(project_data, jobs, project_path)
+        counts = {status: sum(1 for r in results if r["status"] == status) for status in ("success", "partial", "error")}
+        summary = f"{counts['success']} succeeded, {counts['partial']} partial, {counts['error']} failed.\nSee logs for details."
+        exit_code = queue_exit_code(results)
+        if exit_code == EXIT_SUCCESS: messagebox.showinfo("Success", summary)
+        elif exit_code == EXIT_PARTIAL: messagebox.showwarning("Partial Success", summary)
+        else: messagebox.showerror("Error", summary)
+        self.root.after(0, self.enable_buttons)
 
-        final_log_message = f"\n--- {mode.upper()} {msg_detail_key}! "
-        if mode == "Translate":
-            final_log_message += f"TM Hits: {tm_hits}. LLM Segs processed: {len(llm_processed_map)}. "
+    def run_pipeline(self, mode, input_f, output_f, source_lang, target_lang, provider, model_name, chunk_s, drawings_map, user_custom_instructions, custom_system_prompt=None, max_in_flight=None, dispatch_mode="threads", retry_attempts=3, context_strategy="full", context_token_cap=DEFAULT_CONTEXT_TOKEN_CAP, use_response_cache=True, resume=False, streaming=False, execution="interactive", batch_options=None, project_path=None, write_metrics=False, trace=False, profile="off", failover_provider=None, failover_model=None, hedge_percentile=HEDGE_PERCENTILE):
+        engine = TranslationEngine(self.api_keys, self.log_queue, self.tm_agent, self.tracked_changes_agent, self.projects_dir,
+                                   on_progress=lambda text: self.root.after(0, self.progress_var.set, text))
+        result = engine.run(mode, input_f, output_f, source_lang, target_lang, provider, model_name, chunk_s, drawings_map,
+                            user_custom_instructions, custom_system_prompt, max_in_flight, dispatch_mode, retry_attempts,
+                            context_strategy, context_token_cap, use_response_cache, resume, streaming,
+                            execution, batch_options, project_path, write_metrics, trace, profile,
+                            failover_provider, failover_model, hedge_percentile)
+        if result["error_title"]:
+            messagebox.showerror(result["error_title"], result["message"])
         else:
-            final_log_message += f"LLM Segs processed: {len(llm_processed_map)}. Lines Modified by AI: {modified_lines_count}. "
-        if self.tracked_changes_agent.change_data:
-            final_log_message += f"Tracked Changes: {len(self.tracked_changes_agent.change_data)} pairs used as context. "
-        final_log_message += base_log_message_suffix + " ---"
-        self.log_queue.put(final_log_message)
-
-        messagebox_func = (
-            messagebox.showinfo if msg_title == "Success"
-            else messagebox.showwarning if msg_title == "Partial Success"
-            else messagebox.showerror
-        )
-        messagebox_func(
-            msg_title,
-            f"{mode} {msg_detail_key.lower()}! Output: {output_f if file_ok else 'not saved'}\nSee logs for details."
-        )
+            msg_title = {"success": "Success", "partial": "Partial Success"}.get(result["status"], "Error")
+            msg_detail = {"success": "success", "partial": "partial"}.get(result["status"], "fail")
+            messagebox_func = (
+                messagebox.showinfo if msg_title == "Success"
+                else messagebox.showwarning if msg_title == "Partial Success"
+                else messagebox.showerror
+            )
+            messagebox_func(
+                msg_title,
+                f"{mode} {msg_detail}! Output: {result['output_file'] or 'not saved'}\nSee logs for details."
+            )
         self.root.after(0, self.enable_buttons)
 
     # NEW: re-enable buttons after processing
@@ -3117,15 +7437,858 @@ class TranslationApp:
             self.process_button.config(state="normal", text=("Translate" if mode == "Translate" else "Proofread"))
             self.list_models_button.config(state="normal")
             self.refresh_models_button.config(state="normal")
+            self.run_folder_button.config(state="normal")
         except Exception:
             # Fail-safe: ignore UI reset errors
             pass
 
-# ADD: main guard to launch GUI
-if __name__ == "__main__":
+# --- Job Service (local HTTP) ---
+SERVICE_DEFAULT_HOST = "127.0.0.1"
+SERVICE_DEFAULT_PORT = 8765
+SERVICE_WORKERS = 2          # jobs running at once
+SERVICE_MAX_QUEUED = 16      # jobs waiting for a worker; more are refused (HTTP 503)
+SERVICE_KEEP_FINISHED = 100  # finished jobs kept for status and download, oldest dropped first
+SERVICE_LOG_LINES = 200      # log lines kept per job for the status endpoint
+SERVICE_MAX_REQUEST_BYTES = 64 * 1024 * 1024
+# Paths and endpoints on the service's machine: only the operator sets them (--project, command line), never a
+# request, or any client could read server files or send the service's API keys to a batch URL of its choosing
+SERVICE_OPERATOR_SETTINGS = ("batch_base_url", "input_file", "output_file", "tm_file", "drawings_folder")
+
+class JobLog:
+    """log_queue of one service job: keeps its last lines and forwards them, tagged, to the service log"""
+    def __init__(self, job_id, service_log):
+        self.prefix = f"[Job {job_id}] "
+        self.service_log = service_log
+        self.lines = []
+        self.lock = threading.Lock()
+
+    def put(self, msg):
+        msg = str(msg).strip("\n")
+        with self.lock:
+            self.lines.append(msg)
+            del self.lines[:-SERVICE_LOG_LINES]
+        self.service_log.put(self.prefix + msg)
+
+class JobService:
+    """Bounded job queue and worker threads behind the local HTTP API (see create_job_server).
+
+    Each job runs in its own TranslationEngine (own TM and log); the engines share one agents
+    dict, so the SDK clients, rate limiters and concurrency controllers stay warm across jobs and
+    users. Settings: the default project, then the service defaults, then the request's own.
+    """
+    def __init__(self, api_keys, log_queue, project_data=None, defaults=None, projects_dir=None, jobs_dir=None,
+                 workers=SERVICE_WORKERS, max_queued=SERVICE_MAX_QUEUED, tracked_changes_agent=None):
+        self.api_keys = api_keys
+        self.log_queue = log_queue
+        self.project_data = project_data or {}
+        self.defaults = dict(defaults or {})
+        self.projects_dir = projects_dir or default_projects_dir()
+        self.jobs_dir = jobs_dir or os.path.join(self.projects_dir, "service_jobs")
+        self.tracked_changes_agent = tracked_changes_agent or TrackedChangesAgent(log_queue)
+        self.agents = {}
+        self.jobs = {}  # job id -> job dict, in submission order
+        self.condition = threading.Condition()
+        self.pending = queue.Queue(maxsize=max(1, max_queued))
+        self.stopping = threading.Event()
+        self.workers = [threading.Thread(target=self._worker, name=f"job-worker-{n + 1}", daemon=True)
+                        for n in range(max(1, workers))]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        """Let the workers exit after their current job (queued jobs are not run)"""
+        self.stopping.set()
+        for _ in self.workers:
+            try:
+                self.pending.put_nowait(None)  # wakes an idle worker; with a full queue, a queued job id does
+            except queue.Full:
+                break
+
+    def submit(self, request):
+        """Queue a job; returns its status dict. Raises ValueError for a bad request, queue.Full when the queue is full.
+
+        request: {"input": TXT content (source lines, or source<TAB>target[<TAB>comment] for Proofread),
+        "name": file name, "mode", "settings": {project settings}, "project": {a whole project},
+        "custom_instructions"}. SERVICE_OPERATOR_SETTINGS are refused in "settings" and replaced by
+        the service's own in "project".
+        """
+        if not isinstance(request, dict):
+            raise ValueError("Expected a JSON object.")
+        text = request.get("input")
+        if not isinstance(text, str) or not text.strip():
+            raise ValueError('"input" (the TXT content to translate or proofread) is required.')
+        settings = request.get("settings") or {}
+        project_data = request.get("project") or self.project_data
+        if not isinstance(settings, dict) or not isinstance(project_data, dict) \
+                or not isinstance(project_data.get("settings", {}), dict):
+            raise ValueError('"settings" and "project" must be objects.')
+        for key in SERVICE_OPERATOR_SETTINGS:
+            if key in settings or key in request:
+                raise ValueError(f'"{key}" can only be set by the service operator (--project or the command line).')
+        project_data = json.loads(json.dumps(project_data))  # the job's own copy
+        if request.get("project"):
+            own_settings = self.project_data.get("settings", {})
+            project_data["file_paths"] = dict(self.project_data.get("file_paths", {}))
+            project_settings = project_data.setdefault("settings", {})
+            for key in SERVICE_OPERATOR_SETTINGS:
+                project_settings.pop(key, None)
+                if key in own_settings:
+                    project_settings[key] = own_settings[key]
+        overrides = dict(self.defaults, **settings)
+        if request.get("mode"):
+            overrides["mode"] = request["mode"]
+        if request.get("custom_instructions") is not None:
+            project_data.setdefault("content", {})["custom_instructions"] = str(request["custom_instructions"])
+        mode = overrides.get("mode") or project_data.get("settings", {}).get("mode", "Translate")
+        if mode not in ("Translate", "Proofread"):
+            raise ValueError(f"Unknown mode '{mode}' (use Translate or Proofread).")
+        merged = dict(project_data.get("settings", {}), **overrides)  # as TranslationEngine._resolve_job will see them
+        parse_run_settings(merged, merged.get("provider", "Claude"))
+        name = os.path.basename(str(request.get("name") or "")) or "input.txt"
+        if not name.lower().endswith(".txt"):
+            name += ".txt"
+
+        with self.condition:
+            if self.pending.full():
+                raise queue.Full
+            job_id = os.urandom(6).hex()
+            input_f = os.path.join(self.jobs_dir, job_id, name)
+            os.makedirs(os.path.dirname(input_f), exist_ok=True)
+            with open(input_f, "w", encoding="utf-8") as f:
+                f.write(text)
+            overrides.update(mode=mode, input_file=input_f, output_file=default_output_path(input_f, mode))
+            job = {"id": job_id, "name": name, "mode": mode, "status": "queued", "progress": "",
+                   "submitted": time.time(), "started": None, "finished": None, "rows": [], "result": None,
+                   "log": JobLog(job_id, self.log_queue), "project_data": project_data, "overrides": overrides}
+            self.jobs[job_id] = job
+            finished = [j for j in self.jobs.values() if j["finished"] is not None]
+            pruned = finished[:max(0, len(finished) - SERVICE_KEEP_FINISHED)]
+            for old in pruned:
+                del self.jobs[old["id"]]
+            self.pending.put_nowait(job_id)
+            self.log_queue.put(f"[Service] Queued job {job_id} ({mode}, {name}).")
+            view = self._public(job)
+        for old in pruned:
+            self._remove_job_files(old["id"])
+        return view
+
+    def _remove_job_files(self, job_id):
+        """Delete a forgotten job's folder (its input and output files)"""
+        import shutil
+        folder = os.path.join(self.jobs_dir, job_id)
+        try:
+            shutil.rmtree(folder)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.log_queue.put(f"[Service] Could not delete {folder}: {e}")
+
+    def _worker(self):
+        while True:
+            job_id = self.pending.get()
+            if job_id is None or self.stopping.is_set():
+                try:
+                    self.pending.put_nowait(None)  # pass the stop on to a worker still waiting
+                except queue.Full:
+                    pass
+                return
+            with self.condition:
+                job = self.jobs.get(job_id)
+                if job is None:
+                    continue
+                job.update(status="running", started=time.time())
+            try:
+                result = self._run(job)
+            except Exception as e:
+                job["log"].put(f"[Service] Job failed: {e}")
+                result = {"status": "error", "exit_code": EXIT_FAILED, "message": str(e), "error_title": "Error"}
+            with self.condition:
+                job.update(status=result["status"], result=result, finished=time.time())
+                self.condition.notify_all()
+
+    def _run(self, job):
+        def on_progress(text):
+            job["progress"] = text
+        def on_row(line_num, source, target, comment):
+            with self.condition:
+                job["rows"].append((line_num, target, comment))
+                self.condition.notify_all()
+        engine = TranslationEngine(self.api_keys, job["log"], tracked_changes_agent=self.tracked_changes_agent,
+                                   projects_dir=self.projects_dir, on_progress=on_progress, on_row=on_row,
+                                   agents=self.agents, agent_log_queue=self.log_queue)
+        return engine.run_project(job["project_data"], job["overrides"])
+
+    def _public(self, job, with_log=False):
+        """The job as the API shows it"""
+        def stamp(ts):
+            return datetime.datetime.fromtimestamp(ts).isoformat(timespec="seconds") if ts else None
+        view = {"id": job["id"], "name": job["name"], "mode": job["mode"], "status": job["status"],
+                "progress": job["progress"], "rows_received": len(job["rows"]),
+                "submitted": stamp(job["submitted"]), "started": stamp(job["started"]), "finished": stamp(job["finished"]),
+                "urls": {"status": f"/jobs/{job['id']}", "rows": f"/jobs/{job['id']}/rows"}}
+        if job["status"] == "queued":
+            queued = [j for j in self.jobs.values() if j["status"] == "queued"]
+            view["queue_position"] = next(n for n, j in enumerate(queued, 1) if j is job)
+        if job["result"] is not None:
+            result = job["result"]
+            view["result"] = {k: result.get(k) for k in ("status", "exit_code", "segments", "tm_hits", "llm_segments",
+                                                         "modified_lines", "message", "error_title", "elapsed_seconds", "metrics")}
+            if result.get("output_file"):
+                view["urls"]["output.txt"] = f"/jobs/{job['id']}/output.txt"
+            if result.get("tmx_file"):
+                view["urls"]["output.tmx"] = f"/jobs/{job['id']}/output.tmx"
+        if with_log:
+            with job["log"].lock:
+                view["log"] = list(job["log"].lines)
+        return view
+
+    def status(self, job_id):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            return self._public(job, with_log=True) if job else None
+
+    def list_jobs(self):
+        with self.condition:
+            return [self._public(job) for job in self.jobs.values()]
+
+    def health(self):
+        with self.condition:
+            running = sum(1 for job in self.jobs.values() if job["status"] == "running")
+        return {"status": "ok", "workers": len(self.workers), "running": running, "queued": self.pending.qsize(),
+                "max_queued": self.pending.maxsize, "agents": len(self.agents)}
+
+    def metrics_text(self):
+        """Prometheus text: the process-wide LLM request metrics plus the job counts"""
+        with self.condition:
+            states = {}
+            for job in self.jobs.values():
+                states[job["status"]] = states.get(job["status"], 0) + 1
+        return LLM_METRICS.render([
+            ("supervertaler_service_jobs", "Jobs known to the service by status.",
+             [({"status": status}, count) for status, count in sorted(states.items())]),
+            ("supervertaler_service_workers", "Worker threads running jobs.", [({}, len(self.workers))])])
+
+    def wait_rows(self, job_id, after, timeout):
+        """(rows after the first `after`, finished), waiting up to timeout for new rows; None for an unknown job"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            self.condition.wait_for(lambda: len(job["rows"]) > after or job["finished"] is not None, timeout)
+            return job["rows"][after:], job["finished"] is not None
+
+    def output_file(self, job_id, kind):
+        """Path of a finished job's "txt" or "tmx" output; None if the job is unknown or has no such file"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            result = job["result"] if job else None
+        if not result:
+            return None
+        return result.get("output_file") if kind == "txt" else result.get("tmx_file")
+
+def create_job_server(service, host=SERVICE_DEFAULT_HOST, port=SERVICE_DEFAULT_PORT):
+    """Start the service's workers and bind its HTTP server (call serve_forever() on the result)"""
+    import http.server  # only the --serve command line needs the HTTP stack
+    import urllib.parse
+
+    class JobServiceHandler(http.server.BaseHTTPRequestHandler):
+        """HTTP API of the job service; JSON in and out, the rows stream is NDJSON (one JSON object per line).
+
+        POST /jobs                       submit a job (see JobService.submit) -> 202 + status; 503 when the queue is full
+        GET  /jobs                       all known jobs
+        GET  /jobs/<id>                  status, progress, result and the last log lines
+        GET  /jobs/<id>/rows?after=N     results as lines finish ({"event": "row", "line", "target", "comment"}),
+                                         until {"event": "end", "status"}; N skips rows already received
+        GET  /jobs/<id>/output.txt|.tmx  the output files of a finished job
+        GET  /health                     worker and queue counts
+        GET  /metrics                    LLM request, token, cost and latency metrics (Prometheus text format)
+        """
+        server_version = "Supervertaler/2.3.0"
+        ROWS_HEARTBEAT_SECONDS = 15.0
+
+        def log_message(self, fmt, *args):
+            self.server.service.log_queue.put(f"[Service] {self.address_string()} {fmt % args}")
+
+        def _send_json(self, code, payload, headers=None):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_text(self, code, text, content_type):
+            body = text.encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _route(self):
+            url = urllib.parse.urlsplit(self.path)
+            return [part for part in url.path.split("/") if part], urllib.parse.parse_qs(url.query)
+
+        def do_POST(self):
+            parts, _ = self._route()
+            if parts != ["jobs"]:
+                return self._send_json(404, {"error": "Not found."})
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+                if not 0 < length <= SERVICE_MAX_REQUEST_BYTES:
+                    raise ValueError(f"Request body must be 1 byte to {SERVICE_MAX_REQUEST_BYTES} bytes of JSON.")
+                job = self.server.service.submit(json.loads(self.rfile.read(length).decode("utf-8")))
+            except queue.Full:
+                return self._send_json(503, {"error": "The job queue is full; try again later."}, {"Retry-After": "10"})
+            except (ValueError, UnicodeDecodeError) as e:
+                return self._send_json(400, {"error": str(e)})
+            except OSError as e:
+                return self._send_json(500, {"error": f"Cannot store the input: {e}"})
+            self._send_json(202, job, {"Location": job["urls"]["status"]})
+
+        def do_GET(self):
+            parts, query = self._route()
+            service = self.server.service
+            if parts == ["health"]:
+                return self._send_json(200, service.health())
+            if parts == ["metrics"]:
+                return self._send_text(200, service.metrics_text(), "text/plain; version=0.0.4; charset=utf-8")
+            if parts == ["jobs"]:
+                return self._send_json(200, {"jobs": service.list_jobs()})
+            if len(parts) == 2 and parts[0] == "jobs":
+                status = service.status(parts[1])
+                return self._send_json(200, status) if status else self._send_json(404, {"error": "Unknown job."})
+            if len(parts) == 3 and parts[0] == "jobs" and parts[2] == "rows":
+                return self._stream_rows(parts[1], query)
+            if len(parts) == 3 and parts[0] == "jobs" and parts[2] in ("output.txt", "output.tmx"):
+                return self._send_output(parts[1], parts[2].split(".")[1])
+            self._send_json(404, {"error": "Not found."})
+
+        def _stream_rows(self, job_id, query):
+            service = self.server.service
+            try:
+                after = max(0, int(query.get("after", ["0"])[0]))
+            except ValueError:
+                return self._send_json(400, {"error": "after must be a number."})
+            if service.wait_rows(job_id, after, 0) is None:
+                return self._send_json(404, {"error": "Unknown job."})
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()  # no Content-Length: the stream ends when the connection closes
+            try:
+                while True:
+                    waited = service.wait_rows(job_id, after, self.ROWS_HEARTBEAT_SECONDS)
+                    if waited is None:
+                        break
+                    rows, finished = waited
+                    events = [{"event": "row", "line": line_num, "target": target, "comment": comment}
+                              for line_num, target, comment in rows]
+                    after += len(rows)
+                    if finished and not rows:
+                        status = service.status(job_id) or {}
+                        events.append({"event": "end", "status": status.get("status"), "rows": after})
+                    elif not rows:
+                        events.append({"event": "heartbeat", "rows": after})
+                    self.wfile.write("".join(json.dumps(e, ensure_ascii=False) + "\n" for e in events).encode("utf-8"))
+                    self.wfile.flush()
+                    if events[-1]["event"] == "end":
+                        break
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # client went away
+
+        def _send_output(self, job_id, kind):
+            path = self.server.service.output_file(job_id, kind)
+            if not path or not os.path.exists(path):
+                return self._send_json(404, {"error": f"No {kind.upper()} output (unknown or unfinished job)."})
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; charset=utf-8" if kind == "txt" else "application/xml; charset=utf-8")
+            self.send_header("Content-Length", str(os.path.getsize(path)))
+            self.send_header("Content-Disposition", f'attachment; filename="{os.path.basename(path)}"')
+            self.end_headers()
+            with open(path, "rb") as f:
+                while True:
+                    block = f.read(64 * 1024)
+                    if not block:
+                        break
+                    self.wfile.write(block)
+
+    server = http.server.ThreadingHTTPServer((host, port), JobServiceHandler)
+    server.daemon_threads = True
+    server.service = service
+    service.start()
+    service.log_queue.put(f"[Service] Listening on http://{host}:{server.server_port}/ ({len(service.workers)} worker(s), "
+                          f"up to {service.pending.maxsize} queued job(s)); jobs are stored in {service.jobs_dir}.")
+    return server
+
+# --- Benchmarks ---
+# Offline benchmark suite (--benchmark): synthetic patent-like inputs at several sizes, each
+# pipeline stage timed on its own, plus an end-to-end run against the Mock provider. Results
+# are saved as JSON so releases can be compared (--benchmark-baseline).
+BENCHMARK_SIZES = (1000, 10000, 100000)
+BENCHMARK_CHUNK_SIZE = 100
+BENCHMARK_MODEL = "claude-3-5-sonnet-20241022"  # token limits used for chunk planning
+BENCHMARK_PROMPT_PROVIDERS = ("Claude", "OpenAI", "Gemini")  # prompt builders timed (no request is sent)
+BENCHMARK_LOOKUP_SAMPLE = 100  # chunks sampled for the tracked-changes lookup (it scans every pair per segment)
+BENCHMARK_DRAWINGS = 12
+
+_BENCH_SUBJECTS = ["de inrichting", "het koppelelement", "de behuizing", "de sensor", "het verwarmingselement",
+                   "de regeleenheid", "de afdichtring", "het draagframe", "de pomp", "de klep", "het substraat",
+                   "de elektrode", "de aandrijfas", "het filter", "de houder"]
+_BENCH_VERBS = ["is verbonden met", "omvat", "is aangebracht op", "werkt samen met", "is gevormd uit",
+                "strekt zich uit langs", "is bevestigd aan", "regelt", "ondersteunt", "omsluit"]
+_BENCH_TAILS = ["volgens conclusie {n}", "zoals getoond in figuur {f}", "waarbij de afstand ten minste {n} mm bedraagt",
+                "in een eerste uitvoeringsvorm", "met een diameter van {n},{f} mm", "zoals weergegeven in fig. {f}",
+                "op een temperatuur tussen {n} en {m} graden Celsius", ""]
+
+class NullLog:
+    """log_queue that drops every message (benchmarks measure the stages, not the logging)"""
+    def put(self, msg):
+        pass
+
+def _bench_sentence(rng, number):
+    subject, other = rng.sample(_BENCH_SUBJECTS, 2)
+    tail = rng.choice(_BENCH_TAILS).format(n=rng.randint(1, 40), m=rng.randint(41, 400), f=rng.randint(1, BENCHMARK_DRAWINGS))
+    sentence = f"{subject.capitalize()} ({number}) {rng.choice(_BENCH_VERBS)} {other} ({number + 1})"
+    return f"{sentence} {tail}.".replace(" .", ".")
+
+def generate_benchmark_inputs(folder, segments, seed=0):
+    """Write synthetic inputs into folder; returns their paths and the source segments.
+
+    input.txt (Translate), proofread.txt (source<TAB>target), tm.tmx (every other segment),
+    tracked.tsv (about 1 pair per 20 segments, at most 2000) and, with Pillow, a drawings folder.
+    """
+    rng = random.Random(seed)
+    sources = [_bench_sentence(rng, 10 + (i % 90) * 2) for i in range(segments)]
+    paths = {"input": os.path.join(folder, "input.txt"), "proofread": os.path.join(folder, "proofread.txt"),
+             "tm": os.path.join(folder, "tm.tmx"), "tracked": os.path.join(folder, "tracked.tsv"),
+             "drawings": os.path.join(folder, "drawings") if PIL_AVAILABLE else ""}
+    with open(paths["input"], "w", encoding="utf-8") as f:
+        f.writelines(s + "\n" for s in sources)
+    with open(paths["proofread"], "w", encoding="utf-8") as f:
+        f.writelines(f"{s}\t[EN] {s}\n" for s in sources)
+    tmx = TMXGenerator().open_stream(paths["tm"], "nl", "en")
+    for s in sources[::2]:
+        tmx.write_unit(s, f"[TM] {s}")
+    tmx.commit()
+    with open(paths["tracked"], "w", encoding="utf-8") as f:
+        f.write("original\tfinal\n")
+        for s in rng.sample(sources, min(2000, max(10, segments // 20))):
+            f.write(f"{s}\t{s.replace(' de ', ' een ', 1)} (herzien)\n")
+    if paths["drawings"]:
+        os.makedirs(paths["drawings"], exist_ok=True)
+        for n in range(1, BENCHMARK_DRAWINGS + 1):
+            img = Image.new("RGB", (1200, 900), "white")
+            img.paste((rng.randint(0, 255), 0, 0), (100, 100, 100 + n * 60, 800))
+            img.save(os.path.join(paths["drawings"], f"Fig {n}.png"))
+    return paths, sources
+
+def _bench_stage(fn, trace_memory):
+    """Run fn timed; with trace_memory run it again under tracemalloc for its peak allocation.
+
+    Returns fn's result (a dict of stage figures) plus "seconds" and "peak_memory_bytes".
+    """
+    start = time.perf_counter()
+    figures = fn() or {}
+    figures["seconds"] = round(time.perf_counter() - start, 4)
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+        try:
+            fn()
+            figures["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return figures
+
+def run_benchmark_size(segments, folder, trace_memory=True, log_queue=None):
+    """All benchmark stages for one input size; returns {stage: figures}"""
+    log = log_queue or NullLog()
+    quiet = NullLog()
+    paths, sources = generate_benchmark_inputs(folder, segments)
+    stages = {}
+    def stage(name, fn):
+        log.put(f"[Benchmark] {segments} segments: {name}...")
+        stages[name] = _bench_stage(fn, trace_memory)
+
+    stage("ingest", lambda: {"items": len(BilingualFileIngestionAgent().process(paths["input"], quiet, mode="Translate"))})
+    stage("ingest_proofread", lambda: {"items": len(BilingualFileIngestionAgent().process(paths["proofread"], quiet, mode="Proofread"))})
+    def load_tm():
+        tm = TMAgent(quiet)
+        tm.load_tm(paths["tm"], "Dutch", "English")
+        return {"items": len(tm.tm_data)}
+    stage("tm_load", load_tm)
+    tracked = TrackedChangesAgent(quiet)
+    def load_tracked():
+        tracked.clear_changes()
+        tracked.load_tsv_changes(paths["tracked"])
+        return {"items": len(tracked.change_data)}
+    stage("tracked_changes_load", load_tracked)
+
+    state = {}
+    def plan():
+        builder = DocumentContextBuilder("full", sources, None, DEFAULT_CONTEXT_TOKEN_CAP)
+        state["context"] = builder
+        state["chunks"] = plan_chunks(list(range(len(sources))), sources, BENCHMARK_MODEL, BENCHMARK_CHUNK_SIZE,
+                                      builder.max_context_tokens())
+        return {"items": len(state["chunks"]), "context_strategy": builder.strategy}
+    stage("context_and_chunking", plan)
+    chunks, context = state["chunks"], state["context"]
+
+    sample = chunks[::max(1, len(chunks) // BENCHMARK_LOOKUP_SAMPLE)][:BENCHMARK_LOOKUP_SAMPLE]
+    def lookup():
+        found = sum(len(tracked.find_relevant_changes([sources[i] for i in chunk])) for chunk in sample)
+        return {"items": len(sample), "pairs": len(tracked.change_data), "changes_found": found}
+    stage("tracked_changes_lookup", lookup)
+    stages["tracked_changes_lookup"]["estimated_seconds_all_chunks"] = round(
+        stages["tracked_changes_lookup"]["seconds"] * len(chunks) / max(1, len(sample)), 2)
+
+    drawings = {}
+    if paths["drawings"]:
+        def load_drawings():
+            drawings.clear()
+            drawings.update(load_drawing_images(paths["drawings"], quiet))
+            return {"items": sum(1 for img in drawings.values() if pil_image_to_base64_png(img))}
+        stage("drawings", load_drawings)
+    else:
+        stages["drawings"] = {"skipped": "Pillow not installed"}
+
+    for provider in BENCHMARK_PROMPT_PROVIDERS:
+        agent = create_translation_agent(provider, "", quiet, BENCHMARK_MODEL if provider == "Claude" else
+                                         {"OpenAI": "gpt-4o", "Gemini": "gemini-1.5-pro"}[provider])
+        def assemble(agent=agent):
+            tokens = 0
+            for chunk in chunks:
+                lines_map = {i + 1: f"{i + 1}. {sources[i]}" for i in chunk}
+                payload = agent._build_translation_payload(lines_map, sorted(lines_map), context.for_chunk(chunk)[0], "Dutch",
+                                                           "English", sources, drawings, "", None, None)
+                tokens += estimate_payload_tokens(payload)
+            return {"items": len(chunks), "prompt_tokens": tokens, "prompt_tokens_per_segment": round(tokens / max(1, segments), 1)}
+        try:
+            stage(f"prompt_assembly_{provider.lower()}", assemble)
+        except Exception as e:
+            stages[f"prompt_assembly_{provider.lower()}"] = {"skipped": f"{type(e).__name__}: {e}"}
+
+    responses = [(sorted(i + 1 for i in chunk), "\n".join(f"{i + 1}. [EN] {sources[i]}" for i in chunk)) for chunk in chunks]
+    stage("response_parsing", lambda: {"items": sum(len(parse_numbered_translations(text, nums, quiet, "[Bench]")) for nums, text in responses)})
+    proofread_responses = []
+    for chunk in chunks:
+        lines_map = {i + 1: {"source": sources[i], "target_original": f"[EN] {sources[i]}"} for i in chunk}
+        text = "\n".join(f"{n}. {lines_map[n]['target_original']} (rev.)" for n in lines_map)
+        text += f"\n{CHANGES_SUMMARY_START}\n" + "\n".join(f"{n}. Revised." for n in lines_map) + f"\n{CHANGES_SUMMARY_END}"
+        proofread_responses.append((lines_map, text))
+    stage("response_parsing_proofread", lambda: {"items": sum(len(parse_proofreading_response(text, lines_map, sorted(lines_map), quiet, "[Bench]"))
+                                                             for lines_map, text in proofread_responses)})
+    del responses, proofread_responses
+
+    targets = [f"[EN] {s}" for s in sources]
+    stage("output_generation", lambda: {"items": segments, "ok": OutputGenerationAgent().process(
+        sources, targets, os.path.join(folder, "output.txt"), quiet, "Translate", None, "Dutch", "English")})
+
+    def pipeline():
+        engine = TranslationEngine({}, quiet, projects_dir=folder)
+        result = engine.run_project({"settings": {"mode": "Translate", "provider": "Mock", "model": "mock-instant",
+                                                  "chunk_size": str(BENCHMARK_CHUNK_SIZE), "use_response_cache": False,
+                                                  "source_lang": "Dutch", "target_lang": "English"},
+                                     "file_paths": {"input_file": paths["input"], "output_file": os.path.join(folder, "pipeline.txt"),
+                                                    "tm_file": paths["tm"], "drawings_folder": paths["drawings"]}})
+        return {"items": result["segments"], "status": result["status"], "tm_hits": result["tm_hits"],
+                "llm_segments": result["llm_segments"]}
+    stage("pipeline_mock", pipeline)
+    stages["pipeline_mock"]["segments_per_second"] = round(segments / max(1e-9, stages["pipeline_mock"]["seconds"]), 1)
+    return stages
+
+def run_benchmark(sizes=BENCHMARK_SIZES, trace_memory=True, log_queue=None, work_dir=None):
+    """Run the suite for each size in a scratch folder; returns the JSON-ready report"""
+    import platform  # the benchmark modules are only loaded for --benchmark
+    import tempfile
+    log = log_queue or NullLog()
+    report = {"app_version": APP_VERSION, "created": datetime.datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count(),
+              "pillow": PIL_AVAILABLE, "trace_memory": trace_memory, "chunk_size": BENCHMARK_CHUNK_SIZE, "results": []}
+    for segments in sizes:
+        with tempfile.TemporaryDirectory(prefix="supervertaler-bench-", dir=work_dir) as folder:
+            started = time.perf_counter()
+            stages = run_benchmark_size(segments, folder, trace_memory, log)
+            report["results"].append({"segments": segments, "stages": stages})
+            log.put(f"[Benchmark] {segments} segments done in {time.perf_counter() - started:.1f}s.")
+    return report
+
+def compare_benchmarks(report, baseline):
+    """Lines comparing stage times with a baseline report (same sizes only)"""
+    lines = []
+    previous = {r["segments"]: r["stages"] for r in baseline.get("results", [])}
+    for run in report["results"]:
+        for name, figures in run["stages"].items():
+            before = previous.get(run["segments"], {}).get(name, {})
+            if "seconds" in figures and before.get("seconds"):
+                change = (figures["seconds"] - before["seconds"]) / before["seconds"] * 100
+                lines.append(f"{run['segments']:>7} {name:28} {before['seconds']:9.3f}s -> {figures['seconds']:9.3f}s ({change:+.0f}%)")
+    return lines
+
+def format_benchmark_report(report):
+    lines = []
+    for run in report["results"]:
+        lines.append(f"--- {run['segments']} segments ---")
+        for name, figures in run["stages"].items():
+            if "skipped" in figures:
+                lines.append(f"{name:28} skipped ({figures['skipped']})")
+                continue
+            memory = f"{figures['peak_memory_bytes'] / 1048576:8.1f} MB" if "peak_memory_bytes" in figures else ""
+            extra = f"  {figures['prompt_tokens_per_segment']} prompt tokens/segment" if "prompt_tokens_per_segment" in figures else ""
+            lines.append(f"{name:28} {figures['seconds']:9.3f}s {memory}{extra}")
+    return "\n".join(lines)
+
+# --- Command Line ---
+class ConsoleLog:
+    """log_queue stand-in for headless runs: prints each message to stderr as it is put"""
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+        self.lock = threading.Lock()
+
+    def put(self, msg):
+        if not self.quiet:
+            with self.lock:
+                print(msg, file=sys.stderr, flush=True)
+
+def api_keys_with_env(api_keys):
+    """api_keys.txt values, falling back to the providers' usual environment variables (handy for cron/CI)"""
+    keys = dict(api_keys)
+    for name, env_vars in (("google", ("GOOGLE_API_KEY", "GEMINI_API_KEY")), ("claude", ("ANTHROPIC_API_KEY",)),
+                           ("openai", ("OPENAI_API_KEY",))):
+        if not keys.get(name):
+            keys[name] = next((os.environ[v] for v in env_vars if os.environ.get(v)), "")
+    return keys
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        prog="Supervertaler", description="Run a translation/proofreading job without the GUI. "
+        "Settings come from a saved project JSON and/or the options below (options win).",
+        epilog=f"Exit codes: {EXIT_SUCCESS} success, {EXIT_PARTIAL} partial (some lines failed), "
+               f"{EXIT_FAILED} failed, {EXIT_USAGE} bad arguments. Run without arguments to start the GUI.")
+    parser.add_argument("--project", help="project JSON saved from the GUI (projects/<name>.json)")
+    parser.add_argument("--input", dest="input_file", help="input TXT (source lines, or source<TAB>target for Proofread)")
+    parser.add_argument("--inputs", nargs="+", metavar="PATH",
+                        help="job queue: several input files and/or folders (their .txt files), run with shared clients and TM")
+    parser.add_argument("--output-dir", help="job queue: folder for the outputs (default: next to each input)")
+    parser.add_argument("--jobs", dest="jobs_file",
+                        help="job queue: JSON list of per-job settings (input_file, output_file and any project setting)")
+    parser.add_argument("--tracked-changes", nargs="+", metavar="FILE", help="tracked changes (DOCX or TSV) used as context")
+    parser.add_argument("--cpu-workers", help="worker processes for parsing inputs, TM, DOCX and drawings "
+                                              "(number or 'auto' = one per core; 1 = in-process)")
+    parser.add_argument("--output", dest="output_file", help="output TXT (a .tmx is written next to it in Translate mode)")
+    parser.add_argument("--mode", choices=("Translate", "Proofread"))
+    parser.add_argument("--provider", choices=("Claude", "Gemini", "OpenAI", "Mock"),
+                        help="Mock is an offline simulator (models: " + ", ".join(MOCK_MODELS) + "; see SUPERVERTALER_MOCK)")
+    parser.add_argument("--model")
+    parser.add_argument("--source-lang", dest="source_lang")
+    parser.add_argument("--target-lang", dest="target_lang")
+    parser.add_argument("--tm", dest="tm_file", help="translation memory (TMX or TXT)")
+    parser.add_argument("--drawings", dest="drawings_folder", help="folder with figure images")
+    parser.add_argument("--chunk-size", dest="chunk_size")
+    parser.add_argument("--parallel", dest="parallel_requests", help="parallel requests (number or 'auto')")
+    parser.add_argument("--dispatch", dest="dispatch_mode", choices=LLMChunkDispatcher.DISPATCH_MODES)
+    parser.add_argument("--retry-attempts", dest="retry_attempts")
+    parser.add_argument("--context-strategy", dest="context_strategy", choices=CONTEXT_STRATEGIES)
+    parser.add_argument("--context-token-cap", dest="context_token_cap")
+    parser.add_argument("--no-cache", dest="use_response_cache", action="store_const", const=False,
+                        help="bypass the LLM response cache")
+    parser.add_argument("--resume", action="store_const", const=True, help="resume from the checkpoint journal")
+    parser.add_argument("--stream", dest="streaming", action="store_const", const=True, help="stream responses")
+    parser.add_argument("--metrics", dest="write_metrics", action="store_const", const=True,
+                        help="write per-request metrics (tokens, latency, cost) to <output>.metrics.jsonl")
+    parser.add_argument("--trace", dest="trace", action="store_const", const=True,
+                        help="save a trace of the pipeline stages and LLM calls to <output>.trace.json (Chrome trace format)")
+    parser.add_argument("--profile", dest="profile", choices=[p for p in PROFILERS if p != "off"],
+                        help="profile the run and save the report to <output>.profile.txt")
+    parser.add_argument("--failover-provider", dest="failover_provider", choices=("Claude", "Gemini", "OpenAI", "Mock"),
+                        help="hedge slow calls with, and send failed calls to, this provider (needs --failover-model)")
+    parser.add_argument("--failover-model", dest="failover_model")
+    parser.add_argument("--hedge-percentile", dest="hedge_percentile",
+                        help=f"hedge a call once it is slower than this percentile of recent calls (default {HEDGE_PERCENTILE:g}; 0 = only fail over)")
+    parser.add_argument("--bulk", dest="execution", action="store_const", const="bulk",
+                        help="send all chunks through the provider's batch API (Claude/OpenAI) and wait for the results")
+    parser.add_argument("--batch-base-url", dest="batch_base_url", help="batch API base URL (e.g. a local stand-in server)")
+    parser.add_argument("--batch-poll-seconds", dest="batch_poll_seconds", help=f"batch status poll interval (default {BATCH_POLL_SECONDS})")
+    parser.add_argument("--batch-max-wait", dest="batch_max_wait",
+                        help="seconds to wait for a batch before exiting (0 = submit only; run again to collect)")
+    parser.add_argument("--serve", metavar="[HOST:]PORT", nargs="?", const=str(SERVICE_DEFAULT_PORT),
+                        help=f"run the local HTTP job service (default {SERVICE_DEFAULT_HOST}:{SERVICE_DEFAULT_PORT}); "
+                             "the project and the options above are the defaults for submitted jobs")
+    parser.add_argument("--service-workers", type=int, default=SERVICE_WORKERS, help=f"job service: jobs run at once (default {SERVICE_WORKERS})")
+    parser.add_argument("--max-queued", type=int, default=SERVICE_MAX_QUEUED,
+                        help=f"job service: jobs waiting for a worker before new ones are refused (default {SERVICE_MAX_QUEUED})")
+    parser.add_argument("--benchmark", metavar="SIZES", nargs="?", const=",".join(map(str, BENCHMARK_SIZES)),
+                        help="run the offline benchmark suite at these segment counts (comma-separated, default "
+                             f"{','.join(map(str, BENCHMARK_SIZES))}) and save the results as JSON")
+    parser.add_argument("--benchmark-output", help="benchmark: JSON file for the results (default benchmark_<version>_<time>.json)")
+    parser.add_argument("--benchmark-baseline", help="benchmark: earlier results JSON to compare stage times with")
+    parser.add_argument("--benchmark-no-memory", action="store_true",
+                        help="benchmark: skip the second, tracemalloc-traced pass that measures peak memory")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON on the last stdout line")
+    parser.add_argument("--result-file", help="also write the JSON result to this file")
+    parser.add_argument("--quiet", action="store_true", help="do not print the processing log to stderr")
+    parser.add_argument("--startup-report", action="store_true",
+                        help="print startup timings (module load, API keys, library imports) to stderr")
+    return parser
+
+def run_benchmark_cli(args, parser):
+    try:
+        sizes = [int(size) for size in args.benchmark.split(",") if size.strip()]
+        assert sizes and all(size > 0 for size in sizes)
+    except (ValueError, AssertionError):
+        parser.error("--benchmark takes positive segment counts, e.g. 1000,10000")
+    baseline = None
+    if args.benchmark_baseline:
+        try:
+            with open(args.benchmark_baseline, "r", encoding="utf-8") as f:
+                baseline = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Cannot read benchmark baseline {args.benchmark_baseline}: {e}", file=sys.stderr)
+            return EXIT_USAGE
+    report = run_benchmark(sizes, trace_memory=not args.benchmark_no_memory, log_queue=ConsoleLog(quiet=args.quiet))
+    output_f = args.benchmark_output or f"benchmark_{APP_VERSION}_{datetime.datetime.now():%Y%m%d-%H%M%S}.json"
+    with open(output_f, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(format_benchmark_report(report), flush=True)
+    if baseline is not None:
+        print(f"--- compared with {args.benchmark_baseline} ({baseline.get('app_version', '?')}) ---")
+        print("\n".join(compare_benchmarks(report, baseline)) or "No stages in common.", flush=True)
+    print(f"Results saved to {output_f}", flush=True)
+    return EXIT_SUCCESS
+
+def run_cli(argv):
+    """Headless entry point; returns the process exit code"""
+    parser = build_arg_parser()
+    args = parser.parse_args(argv)
+    if args.benchmark:
+        return run_benchmark_cli(args, parser)
+    project_data = {}
+    if args.project:
+        try:
+            with open(args.project, "r", encoding="utf-8") as f:
+                project_data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Cannot read project {args.project}: {e}", file=sys.stderr)
+            return EXIT_USAGE
+    overrides = {k: v for k, v in vars(args).items() if k not in ("project", "json", "result_file", "quiet", "startup_report",
+                                                                  "inputs", "output_dir", "jobs_file", "tracked_changes",
+                                                                  "cpu_workers", "serve", "service_workers", "max_queued",
+                                                                  "benchmark", "benchmark_output", "benchmark_baseline",
+                                                                  "benchmark_no_memory")}
+    if overrides.get("provider") and not overrides.get("model") and project_data.get("settings", {}).get("provider") != overrides["provider"]:
+        parser.error("--model is required when --provider differs from the project's provider")
+    jobs = None
+    if args.serve and (args.inputs or args.jobs_file or overrides.get("input_file") or overrides.get("output_file")):
+        parser.error("--serve takes its inputs over HTTP; drop --input/--output/--inputs/--jobs")
+    if args.inputs or args.jobs_file:
+        if overrides.get("input_file") or overrides.get("output_file"):
+            parser.error("--input/--output cannot be combined with --inputs/--jobs")
+        mode = overrides.get("mode") or project_data.get("settings", {}).get("mode", "Translate")
+        jobs = [{"input_file": f, "output_file": default_output_path(f, mode, args.output_dir)}
+                for f in collect_job_inputs(args.inputs or [])]
+        if args.jobs_file:
+            try:
+                with open(args.jobs_file, "r", encoding="utf-8") as f:
+                    job_entries = json.load(f)
+                assert isinstance(job_entries, list) and all(isinstance(e, dict) and e.get("input_file") for e in job_entries)
+            except (OSError, ValueError, AssertionError) as e:
+                print(f"Cannot read jobs file {args.jobs_file}: {e or 'expected a list of objects with input_file'}", file=sys.stderr)
+                return EXIT_USAGE
+            for entry in job_entries:
+                entry_mode = entry.get("mode", mode)
+                jobs.append(dict(entry, output_file=entry.get("output_file") or default_output_path(entry["input_file"], entry_mode, args.output_dir)))
+        if not jobs:
+            parser.error("no input files found for the job queue")
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+
     try:
+        resolve_cpu_workers(args.cpu_workers)
+    except ValueError as e:
+        parser.error(str(e))
+    cpu_pool = get_cpu_pool(args.cpu_workers) if len(args.tracked_changes or []) > 1 else None
+    log = ConsoleLog(quiet=args.quiet)
+    engine = TranslationEngine(api_keys_with_env(get_api_keys()), log, cpu_workers=args.cpu_workers)
+    engine.tracked_changes_agent.load_files(args.tracked_changes or [], cpu_pool)
+    if args.serve:
+        host, _, port = args.serve.rpartition(":")
+        try:
+            service = JobService(engine.api_keys, log, project_data, {k: v for k, v in overrides.items() if v is not None},
+                                 workers=args.service_workers, max_queued=args.max_queued,
+                                 tracked_changes_agent=engine.tracked_changes_agent)
+            server = create_job_server(service, host or SERVICE_DEFAULT_HOST, int(port))
+        except (ValueError, OSError) as e:
+            print(f"Cannot start the job service on {args.serve}: {e}", file=sys.stderr)
+            return EXIT_USAGE
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            service.stop()
+        return EXIT_SUCCESS
+    if jobs is not None:
+        # Per-job settings win over the command-line options, which win over the project
+        results = engine.run_jobs(project_data, [dict(overrides, **job) for job in jobs], project_path=args.project)
+        exit_code = queue_exit_code(results)
+        output = json.dumps({"status": {EXIT_SUCCESS: "success", EXIT_FAILED: "error"}.get(exit_code, "partial"),
+                             "exit_code": exit_code, "jobs": results}, ensure_ascii=False)
+        if args.result_file:
+            with open(args.result_file, "w", encoding="utf-8") as f:
+                f.write(output + "\n")
+        if args.json:
+            print(output, flush=True)
+        else:
+            for result in results:
+                print(f"{result['status']:8} {result['input_file']} -> {result['output_file'] or '-'}"
+                      + (f" ({result['error_title']}: {result['message']})" if result["error_title"] else ""), flush=True)
+        if args.startup_report:
+            print(startup_report(), file=sys.stderr, flush=True)
+        return exit_code
+    result = engine.run_project(project_data, overrides, project_path=args.project)
+    if result["error_title"]:
+        print(f"{result['error_title']}: {result['message']}", file=sys.stderr)
+    output = json.dumps(result, ensure_ascii=False)
+    if args.result_file:
+        with open(args.result_file, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    if args.json:
+        print(output, flush=True)
+    elif not result["error_title"]:
+        print(result["message"], flush=True)
+    if args.startup_report:
+        print(startup_report(), file=sys.stderr, flush=True)
+    return result["exit_code"]
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv:
+        return run_cli(argv)
+    global GUI_ACTIVE
+    if not TKINTER_AVAILABLE:
+        print("tkinter is not available; run with --help for headless usage.", file=sys.stderr)
+        return EXIT_USAGE
+    try:
+        started = time.perf_counter()
         root = tk.Tk()
+        GUI_ACTIVE = True
         app = TranslationApp(root)
+        record_startup_timing("GUI", time.perf_counter() - started)
+        app.update_log(f"[Startup] {startup_report()}")
         root.mainloop()
     except Exception as e:
-        print(f"Fatal startup error: {e}")
\ No newline at end of file
+        print(f"Fatal startup error: {e}")
+        return EXIT_FAILED
+    return EXIT_SUCCESS
+
+record_startup_timing("module load", time.perf_counter() - _MODULE_LOAD_STARTED)
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()  # CPU worker pool in frozen (PyInstaller) builds
+    sys.exit(main())